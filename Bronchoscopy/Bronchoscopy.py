@@ -3,11 +3,27 @@ import unittest
 from __main__ import vtk, qt, ctk, slicer
 import numpy
 import numpy.linalg
-from vtk.util.numpy_support import vtk_to_numpy
+from vtk.util.numpy_support import vtk_to_numpy, numpy_to_vtk, get_vtk_array_type
 import csv
 import math
 import time
 import SimpleITK as sitk
+from BronchoscopyLib.VideoPreprocessing import ImagePreprocessingStage, ENDOSCOPE_CROP_REGIONS, DEFAULT_ENDOSCOPE_MODEL
+from BronchoscopyLib.RegistrationCache import RegistrationCache, imageSignature
+from BronchoscopyLib.VideoRecorder import VideoRecorder
+from slicer.ScriptedLoadableModule import ScriptedLoadableModuleLogic, ScriptedLoadableModuleTest
+from BronchoscopyLib import CenterlineIO, CenterlineEngine, LabelMapCropping, Skeletonization, SubtreeExtraction
+from BronchoscopyLib.CaseCache import CaseCache, caseKey
+from BronchoscopyLib.CenterlineFrames import CenterlineFrames
+from BronchoscopyLib.CenterlinePointSet import CenterlinePointSet
+from BronchoscopyLib.LandmarkRegistration import registerLandmarks
+from BronchoscopyLib.PathPlanning import PlanningCache
+from BronchoscopyLib.PlanningSession import PlanningSession
+from BronchoscopyLib.ObserverManager import ObserverManager, CoalescedCall
+from BronchoscopyLib.ViewStateManager import ViewStateManager
+from BronchoscopyLib.SliceViewController import SliceViewController
+from BronchoscopyLib.TrajectoryRegistration import TrajectoryRefinement
+from BronchoscopyLib.WallDistanceField import WallDistanceField
 
 #
 # Bronchoscopy
@@ -40,9 +56,9 @@ class BronchoscopyWidget:
       self.parent = parent
 
 
-    self.pendingUpdate = False
-    self.updatingFiducials = False
-    self.observeTags = []
+    # Scene and ROI list observers; bursts of events update the ROIs combobox once
+    self.observerManager = ObserverManager()
+    self.comboBoxUpdate = CoalescedCall(self.wrappedNodeAddedUpdate)
 
     self.addNewPathPoints = False
     
@@ -51,8 +67,12 @@ class BronchoscopyWidget:
     self.cameraNodeObserverTag = None
     self.cameraObserverTag = None
 
-    self.centerlinePointsList = []
-    self.centerline = None
+    # Computations, shared with scripts and tests
+    self.logic = BronchoscopyLogic()
+
+    self.centerlinePoints = CenterlinePointSet()
+    # orientation of the navigation camera at each centerline point, updated when tracking starts
+    self.centerlineFrames = CenterlineFrames()
     self.fiducialNode = None
     self.uploadedCenterlineModel = None
 
@@ -60,7 +80,22 @@ class BronchoscopyWidget:
 
     self.pathModelNamesList = []
 
+    # Smoothed centerline of each path model, by model name. Path models show
+    # this polyline; the tube mesh is built (and cached) only for the selected path
+    self.pathPolylines = {}
+    self.pathTubes = {}
+    # stages of the path of each ROI, so that planning again runs only those whose inputs changed
+    self.planningCache = PlanningCache()
+
+    # centerline, paths and fields of the cases opened before, kept across scene closes; the
+    # least recently used spill to the temporary directory beyond the budget set in the Input section
+    self.caseCache = CaseCache(1024 << 20, os.path.join(slicer.app.temporaryPath, 'BronchoscopyCases'),
+                               (CenterlinePointSet, CenterlineFrames, PlanningSession, WallDistanceField), diskBudget=8 << 30)
+
     self.bifurcationPointsList = []
+    # branch (start, stop, parent) rows and bifurcations of a centerline extracted by skeletonization
+    self.centerlineBranches = []
+    self.centerlineBifurcations = []
 
     #
     # Sensor Tracking Variables
@@ -75,7 +110,28 @@ class BronchoscopyWidget:
     self.checkStreamingTimer.setInterval(1)
     self.checkStreamingTimer.connect('timeout()', self.showVideoStreaming)
 
-    self.previousMatrixSigns = []
+    # the camera looks along +1 or -1 times the centerline tangent, whichever way the probe points;
+    # viewUpSign is changed by the flip button and cameraRoll by the image registrations
+    self.viewDirectionSign = 1
+    self.viewUpSign = 1
+    self.cameraRoll = 0.0
+
+    # sensor positions read with the probe on each registration fiducial, in order
+    self.trackerRegistrationPoints = []
+
+    # names of the sensors tracked with the probe, and their compensation transforms, created on demand
+    self.additionalSensorNames = []
+    self.sensorCompensationTransforms = {}
+
+    # drift correction refined in the background while tracking, and the last one applied
+    self.trajectoryRefinement = None
+    self.driftCorrectionGeneration = 0
+    self.driftCorrectionMatrix = None
+    self.driftCorrectionTransform = None
+
+    # signed distance from the airway wall, built from the label when tracking starts
+    self.wallDistance = None
+    self.offLumenWarningTime = 0.0
     
     self.flipCompensationTransform = None
     self.probeCalibrationTransform = None
@@ -94,10 +150,30 @@ class BronchoscopyWidget:
     self.probeToTrackerTransformNode = None
     self.videoStreamingNode = None
 
+    # Optional BronchoscopyLib.LoadTest.StreamLoadMonitor, set by the load-test harness
+    self.loadMonitor = None
+
+    # Preprocessing stages (crop/flip/luminance) reused by every registration
+    self.videoPreprocessing = ImagePreprocessingStage(ENDOSCOPE_CROP_REGIONS[DEFAULT_ENDOSCOPE_MODEL])
+    self.renderedPreprocessing = ImagePreprocessingStage(None)
+    self.renderWindowGrabber = None
+    self.videoNodeObserverTag = None
+
+    # Optional recording of the incoming video frames
+    self.videoRecorder = None
+    self.videoRecorderObserverTag = None
+
+    # Recent image registration results, keyed by bifurcation and camera pose
+    self.registrationCache = RegistrationCache()
+
     self.customLayoutId = 501
     self.three3DViewsLayoutId = 502    
 
     self.layoutManager = slicer.app.layoutManager()
+    # Layout, 3D cameras and CT window/level are only changed when updateGUI asks for something new
+    self.viewState = ViewStateManager(self.layoutManager, ctk.ctkAxesWidget().Anterior)
+    # Red/Yellow/Green logics, moved together; during tracking they follow the probe at sliceFollowRateSpinBox
+    self.sliceViews = SliceViewController(self.layoutManager)
     
     self.setThree3Dviews()
     self.setLayout()
@@ -166,7 +242,8 @@ class BronchoscopyWidget:
                     " </item>"
                     "</layout>")
     self.layoutManager.layoutLogic().GetLayoutNode().AddLayoutDescription(self.customLayoutId, customLayout)
-    self.layoutManager.setLayout(self.customLayoutId)
+    # the description may have replaced the one of the layout already shown
+    self.viewState.setLayout(self.customLayoutId, force=True)
 
   def setThree3Dviews(self):
     layout = ("<layout type=\"vertical\" split=\"true\" >"
@@ -219,35 +296,29 @@ class BronchoscopyWidget:
     #self.layoutManager.setLayout(self.three3DViewsLayoutId)
 
   def cleanup(self):
-    pass
+    self.observerManager.removeObservers()
 
   def updateGUI(self):
     if(self.thirdThreeDView):
-      self.layoutManager.setLayout(19)
-      self.layoutManager.setLayout(self.three3DViewsLayoutId)
-      self.thirdThreeDView.resetFocalPoint()
-      self.thirdThreeDView.lookFromViewAxis(ctk.ctkAxesWidget().Anterior)
+      layoutId = self.three3DViewsLayoutId
     else:
-      self.layoutManager.setLayout(19)
-      self.layoutManager.setLayout(self.customLayoutId)
+      layoutId = self.customLayoutId
+    views = [self.firstThreeDView, self.secondThreeDView, self.thirdThreeDView]
 
-    self.firstThreeDView.resetFocalPoint()
-    self.firstThreeDView.lookFromViewAxis(ctk.ctkAxesWidget().Anterior)
+    # cameras are framed again only when the airway model changes (or the layout is rebuilt)
+    inputSelector = getattr(self, 'inputSelector', None)
+    airwayModel = inputSelector.currentNode() if inputSelector else None
+    cameraKey = airwayModel.GetID() if airwayModel else None
 
-    self.secondThreeDView.resetFocalPoint()
-    self.secondThreeDView.lookFromViewAxis(ctk.ctkAxesWidget().Anterior)  
-
-    red_logic = slicer.app.layoutManager().sliceWidget("Red").sliceLogic()
+    red_logic = self.layoutManager.sliceWidget("Red").sliceLogic()
     red_cn = red_logic.GetSliceCompositeNode()
     volumeID = red_cn.GetBackgroundVolumeID()
-    if volumeID:
-      self.improveCTContrast(volumeID)
+    volume = slicer.util.getNode(volumeID) if volumeID else None
+
+    self.viewState.refresh(layoutId, views, cameraKey, volume)
       
   def improveCTContrast(self, volID):
-    volume = slicer.util.getNode(volID)
-    displayNode = volume.GetDisplayNode()
-    displayNode.SetAutoWindowLevel(0)
-    displayNode.SetWindowLevel(1400,-500)
+    self.viewState.setWindowLevel(slicer.util.getNode(volID))
 
   def setup(self):
     #
@@ -301,6 +372,38 @@ class BronchoscopyWidget:
     self.labelSelector.setToolTip( "Pick the 3D input model to the algorithm." )
     IOFormLayout.addRow("Airway Label: ", self.labelSelector)
 
+    self.centerlineEngineComboBox = qt.QComboBox()
+    self.centerlineEngineComboBox.addItem("Centerline Extraction CLI")
+    self.centerlineEngineComboBox.addItem("Skeletonization")
+    self.centerlineEngineComboBox.addItem("Skeletonization, Parallel per Lobe")
+    self.centerlineEngineComboBox.toolTip = "Skeletonization thins the airway label in-process, giving ordered centerline points and the bifurcations directly, without building a centerline model. The parallel mode splits whole-lung trees at the lobar bronchi and thins each lobe in its own process."
+    IOFormLayout.addRow("Centerline Engine: ", self.centerlineEngineComboBox)
+
+    self.cropMarginSpinBox = qt.QDoubleSpinBox()
+    self.cropMarginSpinBox.setRange(-1, 100)
+    self.cropMarginSpinBox.value = 5
+    self.cropMarginSpinBox.suffix = " mm"
+    self.cropMarginSpinBox.specialValueText = "No cropping"
+    self.cropMarginSpinBox.toolTip = "The centerline is extracted from the airway label cut to its bounding box plus this margin."
+    IOFormLayout.addRow("Label Crop Margin: ", self.cropMarginSpinBox)
+
+    self.extractionSpacingSpinBox = qt.QDoubleSpinBox()
+    self.extractionSpacingSpinBox.setRange(0, 5)
+    self.extractionSpacingSpinBox.singleStep = 0.1
+    self.extractionSpacingSpinBox.value = 0
+    self.extractionSpacingSpinBox.suffix = " mm"
+    self.extractionSpacingSpinBox.specialValueText = "Original"
+    self.extractionSpacingSpinBox.toolTip = "Isotropic spacing the airway label is resampled to before the centerline extraction."
+    IOFormLayout.addRow("Extraction Spacing: ", self.extractionSpacingSpinBox)
+
+    self.caseCacheBudgetSpinBox = qt.QSpinBox()
+    self.caseCacheBudgetSpinBox.setRange(0, 65536)
+    self.caseCacheBudgetSpinBox.singleStep = 256
+    self.caseCacheBudgetSpinBox.value = self.caseCache.budget >> 20
+    self.caseCacheBudgetSpinBox.suffix = " MB"
+    self.caseCacheBudgetSpinBox.toolTip = "Memory kept for the centerlines, paths, snapping indices, orientation frames and wall distances of the cases closed before, so that opening one of them again restores them at once. Beyond it, the cases used least recently are moved to disk."
+    IOFormLayout.addRow("Case Cache: ", self.caseCacheBudgetSpinBox)
+
     ####################################################################################
     #### Optional Collapsible Button To Select An Uploaded Centerline Fiducials List ###
     ####################################################################################
@@ -310,7 +413,7 @@ class BronchoscopyWidget:
     self.fiducialsCollapsibleButton = ctk.ctkCollapsibleButton()
     self.fiducialsCollapsibleButton.text = "Centerline Fiducials List/ Centerline Model"
     self.fiducialsCollapsibleButton.setChecked(False)
-    self.fiducialsCollapsibleButton.setFixedSize(400,100)
+    self.fiducialsCollapsibleButton.setFixedSize(400,130)
     self.fiducialsCollapsibleButton.enabled = True
     boxLayout.addWidget(self.fiducialsCollapsibleButton, 0, 4)
     fiducialFormLayout = qt.QFormLayout(self.fiducialsCollapsibleButton)
@@ -339,6 +442,11 @@ class BronchoscopyWidget:
     self.centerlineModelSelector.setToolTip( "Select uploaded centerline model" )
     fiducialFormLayout.addRow("Centerline Model: ", self.centerlineModelSelector)
 
+    self.loadCenterlineButton = qt.QPushButton("Load Centerline File")
+    self.loadCenterlineButton.toolTip = "Load a centerline saved as .npy, .vtp, .fcsv or CenterlinePositions.txt as a centerline model."
+    self.loadCenterlineButton.setFixedSize(200,25)
+    fiducialFormLayout.addRow(self.loadCenterlineButton)
+
     ########################################################################################################
     #### Optional Push Button To Create A List Of Fiducial Starting From The Extracted Centerline Points ###
     ########################################################################################################
@@ -347,7 +455,7 @@ class BronchoscopyWidget:
     self.CreateFiducialListButton.toolTip = "Create a list of fiducial points starting from the extracted centerline of the 3D model."
     self.CreateFiducialListButton.setFixedSize(250,25)
 
-    if self.centerlinePointsList != []:
+    if len(self.centerlinePoints) > 0:
       self.CreateFiducialListButton.enabled = True
     else:
       self.CreateFiducialListButton.enabled = False
@@ -371,6 +479,11 @@ class BronchoscopyWidget:
     boxLayout.addWidget(self.ExtractCenterlineButton,0,4)
     boxLayout.addWidget(self.CreateFiducialListButton,0,4)
 
+    self.binaryCenterlineCheckBox = qt.QCheckBox("Also save as .npy and .vtp")
+    self.binaryCenterlineCheckBox.checked = False
+    self.binaryCenterlineCheckBox.toolTip = "Save the centerline in binary form too, for fast reloading through the centerline model selector."
+    boxLayout.addWidget(self.binaryCenterlineCheckBox,0,4)
+
     ####################################################################################
     ############  Create Path Towards An ROI Section (Procedure Planning)  #############
     ####################################################################################
@@ -478,7 +591,7 @@ class BronchoscopyWidget:
     self.PathCreationButton.setFixedSize(300,50)
     self.PathCreationButton.enabled = False
 
-    '''if self.inputSelector.currentNode() and self.pointsListSelector.currentNode() and self.centerlinePointsList != []:
+    '''if self.inputSelector.currentNode() and self.pointsListSelector.currentNode() and len(self.centerlinePoints) > 0:
         self.PathCreationButton.enabled = True
         self.PathCreationButton.setStyleSheet("background-color: rgb(255,246,142)")
     else:
@@ -490,6 +603,19 @@ class BronchoscopyWidget:
     pathCreationFormLayout.addRow(bLayout)
     bLayout.addWidget(self.PathCreationButton,0,4)
 
+    sessionBox = qt.QHBoxLayout()
+    pathCreationFormLayout.addRow(sessionBox)
+
+    self.savePlanningSessionButton = qt.QPushButton("Save Planning Session")
+    self.savePlanningSessionButton.toolTip = "Save centerline, ROIs, waypoints and planned paths to a single file."
+    self.savePlanningSessionButton.setFixedSize(147,25)
+    sessionBox.addWidget(self.savePlanningSessionButton)
+
+    self.loadPlanningSessionButton = qt.QPushButton("Load Planning Session")
+    self.loadPlanningSessionButton.toolTip = "Restore a saved planning session without extracting the centerline or planning the paths again."
+    self.loadPlanningSessionButton.setFixedSize(147,25)
+    sessionBox.addWidget(self.loadPlanningSessionButton)
+
     #################################################################################
     ################ Path Visualization And Distance To Target Info #################
     #################################################################################
@@ -586,6 +712,31 @@ class BronchoscopyWidget:
     registrationFormLayout.addRow(registrationBox)
     registrationBox.addWidget(self.RegFidListButton,0,4)
 
+    # Tracker to CT registration in the module: the probe touches the registration fiducials in order
+    trackerPointsBox = qt.QHBoxLayout()
+    registrationFormLayout.addRow(trackerPointsBox)
+
+    self.collectTrackerPointButton = qt.QPushButton("Collect Tracker Point")
+    self.collectTrackerPointButton.toolTip = "Read the sensor position from the ProbeConnector, with the probe on the next registration fiducial."
+    self.collectTrackerPointButton.setFixedSize(200,35)
+    self.collectTrackerPointButton.enabled = False
+
+    self.clearTrackerPointsButton = qt.QPushButton("Clear Tracker Points")
+    self.clearTrackerPointsButton.toolTip = "Forget the sensor positions collected so far."
+    self.clearTrackerPointsButton.setFixedSize(200,35)
+
+    trackerPointsBox.addWidget(self.collectTrackerPointButton)
+    trackerPointsBox.addWidget(self.clearTrackerPointsButton)
+
+    self.registerTrackerButton = qt.QPushButton("Register Tracker To CT")
+    self.registerTrackerButton.toolTip = "Compute the TrackerToCT transform from the registration fiducials and the collected sensor positions."
+    self.registerTrackerButton.setFixedSize(150,45)
+    self.registerTrackerButton.enabled = False
+    registrationBox.addWidget(self.registerTrackerButton,0,4)
+
+    self.trackerRegistrationLabel = qt.QLabel()
+    registrationFormLayout.addRow("Tracker Registration: ", self.trackerRegistrationLabel)
+
     #############################################################################################
     ###########################  Sensor Tracker Collapsible Button  #############################
     #############################################################################################
@@ -611,8 +762,30 @@ class BronchoscopyWidget:
 
     trackerFormLayout.addRow(trackerButtonLayout)
 
+    self.sliceFollowRateSpinBox = qt.QSpinBox()
+    self.sliceFollowRateSpinBox.setRange(0, 240)
+    self.sliceFollowRateSpinBox.value = 20
+    self.sliceFollowRateSpinBox.suffix = " Hz"
+    self.sliceFollowRateSpinBox.toolTip = "Maximum rate at which the Red, Yellow and Green slices follow the probe. With 0 they follow every tracking update."
+    trackerFormLayout.addRow("Slice Follow Rate: ", self.sliceFollowRateSpinBox)
+
+    self.snapOutsideLumenCheckBox = qt.QCheckBox()
+    self.snapOutsideLumenCheckBox.checked = False
+    self.snapOutsideLumenCheckBox.toolTip = "Show the probe where the sensor is while it is inside the airway lumen, and snap it to the centerline only when it leaves the lumen. Needs the airway label."
+    trackerFormLayout.addRow("Snap Only Outside Lumen: ", self.snapOutsideLumenCheckBox)
+
+    self.trajectoryRefinementCheckBox = qt.QCheckBox()
+    self.trajectoryRefinementCheckBox.checked = False
+    self.trajectoryRefinementCheckBox.toolTip = "Correct the drift of the tracker registration during tracking, by registering the recent sensor trajectory to the centerline in the background."
+    trackerFormLayout.addRow("Refine Registration On Centerline: ", self.trajectoryRefinementCheckBox)
+
+    self.additionalSensorsLineEdit = qt.QLineEdit()
+    self.additionalSensorsLineEdit.setPlaceholderText("e.g. ToolToTracker, ReferenceToTracker")
+    self.additionalSensorsLineEdit.toolTip = "Names of further sensor transforms received by the ProbeConnector, comma separated. Each is snapped to the centerline with the probe, through its own <name>Compensation transform, which moves the model named <name>Model if there is one."
+    trackerFormLayout.addRow("Additional Sensors: ", self.additionalSensorsLineEdit)
+
     # Enable ProbeTracKButton
-    if self.centerlinePointsList != []:
+    if len(self.centerlinePoints) > 0:
       self.ProbeTrackButton.enabled = True
     else:
       self.ProbeTrackButton.enabled = False
@@ -674,6 +847,31 @@ class BronchoscopyWidget:
 
     VSButtonBox.addWidget(self.VideoRegistrationButton, 0, 4)
 
+    self.endoscopeModelSelector = qt.QComboBox()
+    self.endoscopeModelSelector.addItems(sorted(ENDOSCOPE_CROP_REGIONS.keys()))
+    self.endoscopeModelSelector.setCurrentIndex(self.endoscopeModelSelector.findText(DEFAULT_ENDOSCOPE_MODEL))
+    self.endoscopeModelSelector.toolTip = "Endoscope model, selects the region of the video frame that shows the airway."
+    videoStreamingFormLayout.addRow("Endoscope Model: ", self.endoscopeModelSelector)
+
+    self.cropVideoDisplayCheckBox = qt.QCheckBox()
+    self.cropVideoDisplayCheckBox.checked = False
+    self.cropVideoDisplayCheckBox.toolTip = "Show the video cropped to the same region used for image registration."
+    videoStreamingFormLayout.addRow("Crop Video Display: ", self.cropVideoDisplayCheckBox)
+
+    self.recordingFramesSpinBox = qt.QSpinBox()
+    self.recordingFramesSpinBox.setRange(0, 1000000)
+    self.recordingFramesSpinBox.value = 0
+    self.recordingFramesSpinBox.toolTip = "Number of frames preallocated in frames.npy. With 0 the recording is written in chunks of unlimited total length."
+    videoStreamingFormLayout.addRow("Preallocated Frames: ", self.recordingFramesSpinBox)
+
+    self.recordVideoButton = qt.QPushButton("Start Video Recording")
+    self.recordVideoButton.toolTip = "Record the video frames and their timestamps to a folder."
+    self.recordVideoButton.setFixedSize(270,50)
+    self.recordVideoButton.enabled = True
+    self.recordVideoButton.checkable = True
+
+    VSButtonBox.addWidget(self.recordVideoButton, 0, 4)
+
     ########################################################################################
     ################################ Image Registration ####################################
     ########################################################################################
@@ -694,13 +892,19 @@ class BronchoscopyWidget:
     self.selectFolderButton.connect('clicked(bool)', self.onSelectFolderButton)
     self.createRegistrationFiducialsButton.connect('clicked(bool)', self.onCreateRegFidList)
     self.RegFidListButton.connect('clicked(bool)', self.onSaveRegistrationPoints)
+    self.collectTrackerPointButton.connect('clicked(bool)', self.onCollectTrackerPoint)
+    self.clearTrackerPointsButton.connect('clicked(bool)', self.onClearTrackerPoints)
+    self.registerTrackerButton.connect('clicked(bool)', self.onRegisterTracker)
 
     self.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.labelSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
+    self.labelSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onLabelSelect)
+    self.caseCacheBudgetSpinBox.connect('valueChanged(int)', self.onCaseCacheBudgetChanged)
     self.ExtractCenterlineButton.connect('clicked(bool)', self.onExtractCenterlineButton)
     self.fiducialListSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.centerlineModelSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.CreateFiducialListButton.connect('clicked(bool)',self.onCreateAndSaveFiducialList)
+    self.loadCenterlineButton.connect('clicked(bool)', self.onLoadCenterlineButton)
 
     #self.pointsListSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.createROIFiducialsButton.connect('clicked(bool)', self.onCreateROIFiducialsList)
@@ -715,15 +919,21 @@ class BronchoscopyWidget:
     self.createNewPathPointsButton.connect('clicked(bool)', self.startAddingNewPathPoints)
     
     self.PathCreationButton.connect('clicked(bool)', self.onPathCreationButton)
+    self.savePlanningSessionButton.connect('clicked(bool)', self.onSavePlanningSession)
+    self.loadPlanningSessionButton.connect('clicked(bool)', self.onLoadPlanningSession)
     self.pathModelSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onPathSelect)
 
     self.ProbeTrackButton.connect('toggled(bool)', self.onProbeTrackButtonToggled)
+    self.additionalSensorsLineEdit.connect('editingFinished()', self.onAdditionalSensorsChanged)
     self.newLayoutImageButton.connect('toggled(bool)', self.onChangeLayoutButtonToggled)
     self.FlipImageButton.connect('clicked(bool)', self.onFlipImageButton)
 
     self.ImageRegistrationButton.connect('toggled(bool)',self.onStartImageRegistrationButtonPressed)
 
     self.VideoRegistrationButton.connect('toggled(bool)',self.startVideoStreaming)
+    self.endoscopeModelSelector.connect('currentIndexChanged(QString)', self.onEndoscopeModelChanged)
+    self.cropVideoDisplayCheckBox.connect('toggled(bool)', self.onCropVideoDisplayToggled)
+    self.recordVideoButton.connect('toggled(bool)', self.onRecordVideoToggled)
     
     #
     # Add Vertical Spacer
@@ -742,12 +952,94 @@ class BronchoscopyWidget:
 
   def updateList(self):
     '''Observe the mrml scene for changes that we wish to respond to.'''
-    tag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, self.clearROIsComboBox)
-    tag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeAddedEvent, self.requestNodeAddedUpdate)
-    self.observeTags.append((slicer.mrmlScene,tag))
+    self.observerManager.addObserver(slicer.mrmlScene, slicer.mrmlScene.StartCloseEvent, self.onSceneStartClose)
+    self.observerManager.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndCloseEvent, self.clearROIsComboBox)
+    self.observerManager.addObserver(slicer.mrmlScene, slicer.mrmlScene.NodeAddedEvent, self.onNodeAdded)
+    self.observerManager.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndBatchProcessEvent, self.onEndBatchProcess)
+    self.addFiducialObservers()
 
-  def clearROIsComboBox(self):
+  def clearROIsComboBox(self, caller=None, event=None):
     self.ROIsPoints.clear()    
+    self.removeFiducialObservers()
+
+  def onSceneStartClose(self, caller=None, event=None):
+    '''Keeps what was computed for the case being closed in the case cache, and starts the next one from nothing'''
+    self.stashCase()
+    # new objects: the cached case holds the old ones
+    self.centerlinePoints = CenterlinePointSet()
+    self.centerlineFrames = CenterlineFrames()
+    self.centerlineBranches = []
+    self.centerlineBifurcations = []
+    self.wallDistance = None
+    self.pathModelNamesList = []
+    self.pathPolylines = {}
+    self.pathTubes = {}
+    self.planningCache.clear()
+    self.pathCreated = 0
+
+  def stashCase(self):
+    '''Puts the centerline, paths and fields computed for the current airway label in the case cache'''
+    labelVolume = self.labelSelector.currentNode()
+    if not labelVolume or labelVolume.GetImageData() is None or len(self.centerlinePoints) == 0:
+      return
+    session = self.planningSession()
+    # the centerline is kept once, with its snapping indices
+    session.centerline = numpy.zeros((0, 3))
+    artifacts = {
+      'centerline': self.centerlinePoints,
+      'frames': self.centerlineFrames,
+      'session': session,
+      'branches': numpy.asarray(self.centerlineBranches, dtype=numpy.int64).reshape(-1, 3),
+      'bifurcations': numpy.asarray(self.centerlineBifurcations, dtype=numpy.float64).reshape(-1, 3),
+    }
+    if self.wallDistance is not None:
+      artifacts['wallDistance'] = self.wallDistance
+    self.caseCache.put(self.logic.caseKey(labelVolume), artifacts)
+
+  def restoreCase(self):
+    '''Takes what was computed for the current airway label from the case cache, if its case was closed before'''
+    labelVolume = self.labelSelector.currentNode()
+    if not labelVolume or labelVolume.GetImageData() is None or len(self.centerlinePoints) > 0:
+      return False
+    artifacts = self.caseCache.get(self.logic.caseKey(labelVolume))
+    if artifacts is None:
+      return False
+    self.centerlinePoints = artifacts['centerline']
+    self.centerlineFrames = artifacts['frames']
+    self.centerlineBranches = artifacts['branches']
+    self.centerlineBifurcations = artifacts['bifurcations']
+    self.wallDistance = artifacts.get('wallDistance')
+    # ROIs and paths saved with the scene are kept
+    session = artifacts['session']
+    if not slicer.util.getNode('ROIFiducials') and len(session.rois) > 0:
+      self.applyPlanningSession(session)
+    self.onSelect()
+    return True
+
+  def onLabelSelect(self, node):
+    # the wall distances are those of the previous label
+    self.wallDistance = None
+    if not slicer.mrmlScene.IsBatchProcessing():
+      self.restoreCase()
+
+  def onCaseCacheBudgetChanged(self, value):
+    self.caseCache.budget = value << 20
+    self.caseCache.enforceBudget()
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeAdded(self, caller, event, node):
+    '''Only the ROI list is of interest; nodes added while a scene loads are handled once, at the end'''
+    if slicer.mrmlScene.IsBatchProcessing():
+      return
+    if node and node.IsA('vtkMRMLMarkupsFiducialNode') and node.GetName() == 'ROIFiducials':
+      self.addFiducialObservers()
+      self.requestNodeAddedUpdate()
+
+  def onEndBatchProcess(self, caller, event):
+    self.restoreCase()
+    if slicer.util.getNode('ROIFiducials'):
+      self.addFiducialObservers()
+      self.requestNodeAddedUpdate()
   
   def onSelect(self):
     self.updateGUI()
@@ -762,7 +1054,7 @@ class BronchoscopyWidget:
       self.ExtractCenterlineButton.enabled = True
       self.ExtractCenterlineButton.setStyleSheet("background-color: rgb(175,255,253)")
    
-      if self.centerlinePointsList != []:
+      if len(self.centerlinePoints) > 0:
         self.ProbeTrackButton.enabled = True
       else:
         self.ProbeTrackButton.enabled = False
@@ -783,6 +1075,9 @@ class BronchoscopyWidget:
     else:
       self.RegFidListButton.enabled = False
 
+    self.collectTrackerPointButton.enabled = self.registrationSelector.currentNode() != None
+    self.registerTrackerButton.enabled = self.registrationSelector.currentNode() != None and len(self.trackerRegistrationPoints) >= 3
+
     ROIfids = slicer.util.getNode('ROIFiducials')
     if self.ROIsPoints.currentIndex == -1 and ROIfids:
       self.fillComboBox(ROIfids)
@@ -791,7 +1086,7 @@ class BronchoscopyWidget:
       self.createLabelsFiducialsButton.enabled = True
       self.createNewPathPointsButton.enabled = True
 
-      if self.inputSelector.currentNode() and self.centerlinePointsList != []:
+      if self.inputSelector.currentNode() and len(self.centerlinePoints) > 0:
          self.PathCreationButton.enabled = True
          self.PathCreationButton.setStyleSheet("background-color: rgb(255,246,142)")
       else:
@@ -803,7 +1098,7 @@ class BronchoscopyWidget:
        self.PathCreationButton.enabled = False
        self.PathCreationButton.setStyleSheet("background-color: rgb(255,255,255)")
 
-    if self.centerlinePointsList != []:
+    if len(self.centerlinePoints) > 0:
       self.CreateFiducialListButton.enabled = True
 
   def fillComboBox(self, ROIfiducials):
@@ -819,7 +1114,7 @@ class BronchoscopyWidget:
       self.createLabelsFiducialsButton.enabled = True
       self.createNewPathPointsButton.enabled = True
 
-      if self.inputSelector.currentNode() and self.centerlinePointsList != []:
+      if self.inputSelector.currentNode() and len(self.centerlinePoints) > 0:
          self.PathCreationButton.enabled = True
          self.PathCreationButton.setStyleSheet("background-color: rgb(255,246,142)")
       else:
@@ -837,6 +1132,8 @@ class BronchoscopyWidget:
     self.selectFolderButton.setStyleSheet("background-color: rgb(255,255,255)")
     self.createRegistrationFiducialsButton.enabled = False
     self.RegFidListButton.enabled = False
+    self.collectTrackerPointButton.enabled = False
+    self.registerTrackerButton.enabled = False
     self.ExtractCenterlineButton.enabled = False
     self.ExtractCenterlineButton.setStyleSheet("background-color: rgb(255,255,255)")    
     self.CreateFiducialListButton.enabled = False
@@ -937,6 +1234,62 @@ class BronchoscopyWidget:
 
     return True
 
+  def startProbeConnector(self):
+    if self.cNode == None:
+      cNodes = slicer.mrmlScene.GetNodesByName('ProbeConnector')
+      if cNodes.GetNumberOfItems() == 0:
+        self.cNode = slicer.vtkMRMLIGTLConnectorNode()
+        slicer.mrmlScene.AddNode(self.cNode)
+        self.cNode.SetName('ProbeConnector')
+      else:
+        self.cNode = cNodes.GetItemAsObject(0)
+
+    if self.cNode.GetState() == 0:
+      self.cNode.SetType(1)
+      self.cNode.SetTypeServer(18944)
+      self.cNode.Start()
+
+  def onCollectTrackerPoint(self):
+    # the connector is started on the first click; the sensor position arrives shortly after
+    self.startProbeConnector()
+    probeToTracker = slicer.util.getNode('ProbeToTracker')
+    if self.cNode.GetState() != 2 or probeToTracker == None:
+      messageBox = qt.QMessageBox()
+      messageBox.warning(None,'Warning!', 'No sensor position received yet from the ProbeConnector, please try again.')
+      return
+
+    matrix = vtk.vtkMatrix4x4()
+    probeToTracker.GetMatrixTransformToParent(matrix)
+    self.trackerRegistrationPoints.append([matrix.GetElement(0,3), matrix.GetElement(1,3), matrix.GetElement(2,3)])
+    fiducialsNumber = self.registrationSelector.currentNode().GetNumberOfFiducials()
+    self.trackerRegistrationLabel.setText('%d of %d fiducials collected' % (len(self.trackerRegistrationPoints), fiducialsNumber))
+    self.onSelect()
+
+  def onClearTrackerPoints(self):
+    self.trackerRegistrationPoints = []
+    self.trackerRegistrationLabel.setText('')
+    self.onSelect()
+
+  def onRegisterTracker(self):
+    fiducialNode = self.registrationSelector.currentNode()
+    if fiducialNode.GetNumberOfFiducials() != len(self.trackerRegistrationPoints):
+      messageBox = qt.QMessageBox()
+      messageBox.warning(None,'Warning!', 'Please collect one sensor position for each of the %d registration fiducials (%d collected).' % (
+        fiducialNode.GetNumberOfFiducials(), len(self.trackerRegistrationPoints)))
+      return
+
+    transformNode, report = self.logic.registerTracker(fiducialNode, self.trackerRegistrationPoints)
+
+    # the sensor positions read during tracking are then in CT coordinates
+    probeToTracker = slicer.util.getNode('ProbeToTracker')
+    if probeToTracker:
+      probeToTracker.SetAndObserveTransformNodeID(transformNode.GetID())
+
+    text = 'FRE %.2f mm' % report['fre']
+    if report['outliers']:
+      text += ', fiducial(s) %s rejected' % ', '.join(str(index + 1) for index in report['outliers'])
+    self.trackerRegistrationLabel.setText(text)
+
   def onSelectFolderButton(self):
     self.disableButtonsAndSelectors()
     self.folderPathSelection.setText(qt.QFileDialog.getExistingDirectory())
@@ -957,7 +1310,7 @@ class BronchoscopyWidget:
     self.enableSelectors()
     self.onSelect()
 
-    if self.centerlinePointsList != []:
+    if len(self.centerlinePoints) > 0:
       self.CreateFiducialListButton.enabled = True
 
     # Update GUI
@@ -965,226 +1318,58 @@ class BronchoscopyWidget:
 
   def extractCenterline(self,labelVolume):
 
+    margin = self.cropMarginSpinBox.value if self.cropMarginSpinBox.value >= 0 else None
+    spacing = self.extractionSpacingSpinBox.value or None
+
     if self.fiducialListSelector.currentNode():  # if a centerline fiducial list was uploaded, all that follows is not necessary!
       self.fiducialNode = self.fiducialListSelector.currentNode()
     elif self.centerlineModelSelector.currentNode():
       self.uploadedCenterlineModel = self.centerlineModelSelector.currentNode()
-    else:
-      self.centerline = slicer.vtkMRMLScalarVolumeNode()
-      slicer.mrmlScene.AddNode( self.centerline )
-
-      centerlineExtraction = slicer.modules.centerlineextractioncli
-      parameters = {
-          "inputVolume": labelVolume.GetID(),
-          "outputVolume": self.centerline.GetID(),	  
-          }
-      slicer.cli.run( centerlineExtraction,None,parameters,wait_for_completion=True )
-
-      # create 3D model of the centerline
-      hierarchyList = slicer.mrmlScene.GetNodesByName('CenterlineModelHierarchy')
-      if hierarchyList.GetNumberOfItems() == 0:
-        modelHierarchy = slicer.vtkMRMLModelHierarchyNode()
-        modelHierarchy.SetName('CenterlineModelHierarchy')
-        slicer.mrmlScene.AddNode(modelHierarchy)
+    elif self.centerlineEngineComboBox.currentIndex in (1, 2):
+      if self.centerlineEngineComboBox.currentIndex == 1:
+        extract = self.logic.extractCenterlineSkeleton
       else:
-        modelHierarchy = hierarchyList.GetItemAsObject(0)
-
-      parameters = {}
-      parameters["InputVolume"] = self.centerline.GetID()
-      parameters["ModelSceneFile"] = modelHierarchy.GetID()
-      parameters["Name"] = 'CenterlineModel'
-      #parameters["FilterType"] = 'Laplacian'
-      parameters["Smooth"] = 0
-      parameters["Decimate"] = 0.00
-    
-      modelMaker = slicer.modules.modelmaker
-      slicer.cli.run(modelMaker, None, parameters,True)
-
-      # turn off visibility of the created centerline model   
-      modelsCollection = slicer.mrmlScene.GetNodesByClass('vtkMRMLModelNode')
-      numberOfItems = modelsCollection.GetNumberOfItems()
-      self.centerlineModel = modelsCollection.GetItemAsObject(numberOfItems-1)
-      displayNode = self.centerlineModel.GetDisplayNode()
-      displayNode.SetVisibility(0)
-
-      centerlinePolydata = self.centerlineModel.GetPolyData()
+        extract = self.logic.extractCenterlineParallel
+      points, self.centerlineBranches, self.centerlineBifurcations = extract(labelVolume, margin=margin, spacing=spacing)
+      self.centerlinePoints.extend(points)
+      print len(self.centerlinePoints), 'centerline points,', len(self.centerlineBifurcations), 'bifurcations'
+    else:
+      self.centerlineModel = self.logic.extractCenterlineModel(labelVolume, margin, spacing)
 
       iterations = 3
-      self.Smoothing(centerlinePolydata, iterations)
+      self.Smoothing(self.centerlineModel.GetPolyData(), iterations)
 
     if self.fiducialNode:
       disNode = self.fiducialNode.GetDisplayNode()
       disNode.SetVisibility(0)
-      for i in xrange(self.fiducialNode.GetNumberOfFiducials()):
-        point = [0,0,0]
-        self.fiducialNode.GetNthFiducialPosition(i,point)
-        self.centerlinePointsList.append(point)
+      if hasattr(slicer.util, 'arrayFromMarkupsControlPoints'):
+        self.centerlinePoints.extend(slicer.util.arrayFromMarkupsControlPoints(self.fiducialNode))
+      else:
+        for i in xrange(self.fiducialNode.GetNumberOfFiducials()):
+          point = [0,0,0]
+          self.fiducialNode.GetNthFiducialPosition(i,point)
+          self.centerlinePoints.append(point)
       slicer.mrmlScene.RemoveNode(self.fiducialNode)
     elif self.uploadedCenterlineModel:
       displayNode = self.uploadedCenterlineModel.GetDisplayNode()
       displayNode.SetVisibility(0)
       centerlinePolydata = self.uploadedCenterlineModel.GetPolyData()
-      iterations = 3
-      self.Smoothing(centerlinePolydata, iterations)
+      if CenterlineIO.isCenterlinePolyData(centerlinePolydata):
+        # saved by this module, already ordered and smoothed
+        self.centerlinePoints.extend(CenterlineIO.polyDataPoints(centerlinePolydata))
+      else:
+        iterations = 3
+        self.Smoothing(centerlinePolydata, iterations)
       slicer.mrmlScene.RemoveNode(self.uploadedCenterlineModel)
 
     self.ProbeTrackButton.enabled = True
     #self.CreateFiducialListButton.enabled = True    
 
-    if self.centerline != None:
-      slicer.mrmlScene.RemoveNode(self.centerline)
-
     return True
 
   def Smoothing(self, centModel, iterationsNumber):
-    
-    NumberOfCells = centModel.GetNumberOfCells()
-    print centModel.GetNumberOfPoints()
-
-    pointsList = []
-    distancePointsAbove = []
-    distancePointsBelow = []
-    modelPoints = vtk.vtkPoints()
-
-    for iteration in range(0, iterationsNumber):
-      if iteration == 0:
-        centralPoint = [0,0,0]
-        for i in range(NumberOfCells-10,10,-4):
-          cell = centModel.GetCell(i)
-          points = cell.GetPoints()
-          if points.GetNumberOfPoints() % 2 == 0:
-            centralPointPosition = points.GetNumberOfPoints()/2
-          else:
-            centralPointPosition = int(points.GetNumberOfPoints())/2
-
-          points.GetPoint(centralPointPosition,centralPoint)
-     
-          p = [centralPoint[0],centralPoint[1],centralPoint[2]]
-          pointsList.append(p)
-          if i == NumberOfCells-10:
-            modelPoints.InsertPoint(0, p)
-      else:
-        point = [0,0,0]
-        pointsList = []
-        for i in range(0,modelPoints.GetNumberOfPoints()):
-          modelPoints.GetPoint(i,point)
-          p = [point[0],point[1],point[2]]
-          pointsList.append(p) 
-
-      for n in range(1,len(pointsList)-1):
-        
-        actualPoint = pointsList[n]
-        actualPoint = numpy.asarray(actualPoint)
-
-        #
-        # closest above point 
-        #
-        pointsAbove = pointsList[:n]
-        followingPointsList = pointsList[n+1:n+200]
-        pointsAbove = pointsAbove + followingPointsList
-        distancePointsAbove = ((pointsAbove-actualPoint)**2).sum(axis=1)
-        ndxAbove = distancePointsAbove.argsort()
-        prevPoint =  pointsAbove[ndxAbove[0]]
-
-        applySmooth = 1
-
-        prevFound = 1
-        count = 1
-        if abs(actualPoint[0]-prevPoint[0]) > 3 and abs(actualPoint[1]-prevPoint[1]) > 2:
-          prevFound = 0 
-          if abs(actualPoint[2]-prevPoint[2]) > 4:     
-            while abs(actualPoint[0]-prevPoint[0]) > 3 and abs(actualPoint[1]-prevPoint[1]) > 2 and abs(actualPoint[2]-prevPoint[2]) > 4 and count < len(ndxAbove) and prevFound == 0:
-              prevPoint = pointsAbove[ndxAbove[count]]
-              if abs(actualPoint[0]-prevPoint[0]) <= 3 and abs(actualPoint[1]-prevPoint[1]) <= 2 and abs(actualPoint[2]-prevPoint[2]) <= 4:
-                 prevFound = 1
-              count += 1
-          else:
-             while abs(actualPoint[0]-prevPoint[0]) > 3 and abs(actualPoint[1]-prevPoint[1]) > 2 and count < len(ndxAbove) and prevFound == 0:
-               prevPoint = pointsAbove[ndxAbove[count]]
-               if abs(actualPoint[0]-prevPoint[0]) <= 3 and abs(actualPoint[1]-prevPoint[1]) <= 2 and abs(actualPoint[2]-prevPoint[2]) <= 4:
-                 prevFound = 1
-               count += 1
-        elif abs(actualPoint[0]-prevPoint[0]) > 3 or abs(actualPoint[1]-prevPoint[1]) > 2:
-          prevFound = 0 
-          if abs(actualPoint[0]-prevPoint[0]) > 3:
-            while abs(actualPoint[0]-prevPoint[0]) > 3 and count < len(ndxAbove) and prevFound == 0:
-              prevPoint = pointsAbove[ndxAbove[count]]
-              if abs(actualPoint[0]-prevPoint[0]) <= 3 and abs(actualPoint[1]-prevPoint[1]) <= 2 and abs(actualPoint[2]-prevPoint[2]) <= 4:
-                 prevFound = 1
-              count += 1
-          elif abs(actualPoint[1]-prevPoint[1]) > 2:
-            while abs(actualPoint[0]-prevPoint[0]) > 2 and count < len(ndxAbove) and prevFound == 0:
-              prevPoint = pointsAbove[ndxAbove[count]]
-              if abs(actualPoint[0]-prevPoint[0]) <= 3 and abs(actualPoint[1]-prevPoint[1]) <= 2 and abs(actualPoint[2]-prevPoint[2]) <= 4:
-                 prevFound = 1
-              count += 1
-
-        # 
-        # closest below point
-        #
-        k = n+1
-        pointsBelow = pointsList[k:]
-        previousPointsList = pointsList[n-100:n]
-        pointsBelow = pointsBelow + previousPointsList
-        distancePointsBelow = ((pointsBelow-actualPoint)**2).sum(axis=1)
-        ndxBelow = distancePointsBelow.argsort()
-        nextPoint = pointsBelow[ndxBelow[0]]      
-
-        count = 1
-        nextFound = 1
-
-        if abs(actualPoint[0]-nextPoint[0]) > 3 and abs(actualPoint[1]-nextPoint[1]) > 2:
-          nextFound = 0
-          if abs(actualPoint[2]-nextPoint[2]) > 4:
-	    while abs(actualPoint[0]-nextPoint[0]) > 3 and abs(actualPoint[1]-nextPoint[1]) > 2 and abs(actualPoint[2]-nextPoint[2]) > 4 and count < len(ndxBelow) and nextFound == 0:
-              nextPoint = pointsBelow[ndxBelow[count]]
-              if abs(actualPoint[0]-nextPoint[0]) <= 3 and abs(actualPoint[1]-nextPoint[1]) <= 2 and abs(actualPoint[2]-nextPoint[2]) <= 4:
-                 nextFound = 1
-              count += 1
-          else:
-             while abs(actualPoint[0]-nextPoint[0]) > 3 and abs(actualPoint[1]-nextPoint[1]) > 2 and count < len(ndxBelow) and nextFound == 0:
-               nextPoint = pointsBelow[ndxBelow[count]]
-               if abs(actualPoint[0]-nextPoint[0]) <= 3 and abs(actualPoint[1]-nextPoint[1]) <= 2 and abs(actualPoint[2]-nextPoint[2]) <= 4:
-                 nextFound = 1
-               count += 1
-        elif abs(actualPoint[0]-nextPoint[0]) > 3 or abs(actualPoint[1]-nextPoint[1]) > 2:
-          nextFound = 0
-          if abs(actualPoint[0]-nextPoint[0]) > 3:
-            while abs(actualPoint[0]-nextPoint[0]) > 3 and count < len(ndxBelow) and nextFound == 0:
-              nextPoint = pointsBelow[ndxBelow[count]]
-              if abs(actualPoint[0]-nextPoint[0]) <= 3 and abs(actualPoint[1]-nextPoint[1]) <= 2 and abs(actualPoint[2]-nextPoint[2]) <= 4:
-                 nextFound = 1
-              count += 1
-          elif abs(actualPoint[1]-nextPoint[1]) > 2:
-            while abs(actualPoint[0]-nextPoint[0]) > 2 and count < len(ndxBelow) and nextFound == 0:
-              nextPoint = pointsBelow[ndxBelow[count]]
-              if abs(actualPoint[0]-nextPoint[0]) <= 3 and abs(actualPoint[1]-nextPoint[1]) <= 2 and abs(actualPoint[2]-nextPoint[2]) <= 4:
-                 nextFound = 1
-              count += 1
- 
-        if nextFound == 0 or prevFound == 0:
-          applySmooth = 0
-
-        actualPoint = actualPoint.tolist()
-
-        relaxation = 0.5
-        
-        if applySmooth == 1:
-          actualPoint[0] += relaxation * (0.5 * (prevPoint[0] + nextPoint[0]) - actualPoint[0]);
-          actualPoint[1] += relaxation * (0.5 * (prevPoint[1] + nextPoint[1]) - actualPoint[1]);
-          actualPoint[2] += relaxation * (0.5 * (prevPoint[2] + nextPoint[2]) - actualPoint[2]);
-
-        if iteration == 0:
-          modelPoints.InsertNextPoint(actualPoint)
-        else:
-          modelPoints.InsertPoint(n, actualPoint)
-
-    print modelPoints.GetNumberOfPoints()
-    for i in range(0,modelPoints.GetNumberOfPoints()):
-      modelPoints.GetPoint(i,point)
-      p = [point[0],point[1],point[2]]
-      self.centerlinePointsList.append(p)
-    print len(self.centerlinePointsList)
+    self.centerlinePoints.extend(self.logic.smoothCenterline(centModel, iterationsNumber))
+    print len(self.centerlinePoints)
 
 ########################################################################################################
 ######################## Create A Fiducial List With A Fiducial On Each Point ##########################  
@@ -1194,45 +1379,39 @@ class BronchoscopyWidget:
 
     self.disableButtonsAndSelectors()
 
-    fiducialList = []
-
-    for n in xrange(len(self.centerlinePointsList)):
-      point = self.centerlinePointsList[n]
-      ID =  'vtkMRMLMarkupsFiducialNode_' + str(n)
-      associatedNodeID = 'CenterlineFiducials-' + str(n+1)
-      line = [ID,point[0],point[1],point[2],0,0,0,1,1,1,0,associatedNodeID,'','']
-      fiducialList.append(line)
-
     localDirectory = qt.QFileDialog.getExistingDirectory()
-    fileName = localDirectory + '/CenterlineFiducials.fcsv'
-    a =[]
-    with open(fileName, "wb") as f:
-      writer = csv.writer(f,)
+    if localDirectory:
+      points = self.centerlinePoints.array
       version = slicer.app.applicationVersion
-      firstRow = '# Markups fiducial file version = ' + str(version[0:3])
-      a.append(firstRow)
-      writer.writerow(a)
-      writer.writerow(['# CoordinateSystem = 0'])
-      writer.writerow(['# columns = id']+['x']+['y']+['z']+['ow']+['ox']+['oy']+['oz']+['vis']+['sel']+['lock']+['label']+['desc']+['associatedNodeID'])
-      writer.writerows(fiducialList)  
-
-    fiducialList = []
-    for n in xrange(len(self.centerlinePointsList)):
-      point = self.centerlinePointsList[n]
-      line = [point[0],point[1],point[2]]
-      fiducialList.append(line)
-
-    fileSecondName = localDirectory + '/CenterlinePositions.txt'
-    a = []
-    with open(fileSecondName, "wb") as f:
-      writer = csv.writer(f,)
-      writer.writerows(fiducialList)    
+      CenterlineIO.writeCenterlineFiles(points, localDirectory, version[0:3])
+      if self.binaryCenterlineCheckBox.checked:
+        CenterlineIO.savePoints(localDirectory + '/Centerline.npy', points)
+        CenterlineIO.writePolyData(localDirectory + '/Centerline.vtp', points)
 
     self.enableSelectors()
 
     self.onSelect()
 
 
+  def onLoadCenterlineButton(self):
+    fileName = qt.QFileDialog.getOpenFileName(None, 'Load Centerline', '', 'Centerline (*.npy *.vtp *.vtk *.fcsv *.txt)')
+    if not fileName:
+      return
+    extension = os.path.splitext(fileName)[1].lower()
+    if extension in ('.vtp', '.vtk'):
+      # models not saved by this module are still smoothed by extractCenterline
+      polyData = CenterlineIO.readPolyData(fileName)
+    else:
+      polyData = CenterlineIO.centerlinePolyData(CenterlineIO.readCenterline(fileName))
+
+    centerlineModel = slicer.vtkMRMLModelNode()
+    centerlineModel.SetName(slicer.mrmlScene.GenerateUniqueName('CenterlineModel'))
+    centerlineModel.SetAndObservePolyData(polyData)
+    slicer.mrmlScene.AddNode(centerlineModel)
+    centerlineModel.CreateDefaultDisplayNodes()
+    centerlineModel.GetDisplayNode().SetVisibility(0)
+    self.centerlineModelSelector.setCurrentNode(centerlineModel)
+
 #######################################################################################################
 ##################################### PATH CREATION AND INFO ########################################## 
 #######################################################################################################
@@ -1298,36 +1477,24 @@ class BronchoscopyWidget:
     self.crosshairNode.SetCrosshairRAS(ras)
 
   def fitSlicesToBackground(self):
-    lm = slicer.app.layoutManager()
-    redWidget = lm.sliceWidget('Red')
-    redLogic = redWidget.sliceLogic()
-    yellowWidget = lm.sliceWidget('Yellow')
-    yellowLogic = yellowWidget.sliceLogic()
-    greenWidget = lm.sliceWidget('Green')
-    greenLogic = greenWidget.sliceLogic()
-
-    redLogic.FitSliceToBackground(1,1)
-    yellowLogic.FitSliceToBackground(1,1)
-    greenLogic.FitSliceToBackground(1,1)
+    self.sliceViews.fitToBackground()
 
   def addFiducialObservers(self):
-    '''Add observers to all fiducialLists in scene so we will know when new markups are added'''
-    self.removeFiducialObservers()
+    '''Observe the ROI list so we will know when new markups are added (once, however often this is called)'''
     fiducialList = slicer.util.getNode('ROIFiducials')
-    tag = fiducialList.AddObserver(fiducialList.MarkupAddedEvent, self.requestNodeAddedUpdate)
-    self.observeTags.append((fiducialList,tag))
+    self.removeFiducialObservers(fiducialList)
+    if fiducialList:
+      self.observerManager.addObserver(fiducialList, fiducialList.MarkupAddedEvent, self.requestNodeAddedUpdate)
 
-  def removeFiducialObservers(self):
-    '''Remove any existing observer'''
-    for obj,tag in self.observeTags:
-      obj.RemoveObserver(tag)
-    self.obsverTags = []
+  def removeFiducialObservers(self, keep=None):
+    '''Remove the observers on markup lists other than keep; the scene observers stay'''
+    for caller, tag in list(self.observerManager.observers.values()):
+      if caller is not slicer.mrmlScene and caller is not keep:
+        self.observerManager.removeObservers(caller)
 
-  def requestNodeAddedUpdate(self,caller,event):
-    '''Start a SingleShot timer that will check the fiducials in the scene and add them to the list'''
-    if not self.pendingUpdate:
-      qt.QTimer.singleShot(0,self.wrappedNodeAddedUpdate)
-      self.pendingUpdate = True
+  def requestNodeAddedUpdate(self,caller=None,event=None):
+    '''Update the ROIs list on the next event-loop iteration, once for any number of requests'''
+    self.comboBoxUpdate.request()
 
   def wrappedNodeAddedUpdate(self):
     try:
@@ -1338,12 +1505,6 @@ class BronchoscopyWidget:
       qt.QMessageBox.warning(slicer.util.mainWindow(),
                              "Node Added", 'Exception!\n\n' + str(e) + "\n\nSee Python Console for Stack Trace")
   def nodeAddedUpdate(self):
-    if self.updatingFiducials:
-      return
-    
-    self.updatingFiducials = True
-    self.pendingUpdate = False
-    self.updatingFiducials = False
     fiducialList = slicer.util.getNode('ROIFiducials')
     if fiducialList:
       self.updateComboBox()
@@ -1355,9 +1516,10 @@ class BronchoscopyWidget:
     activeList = slicer.util.getNode(activeListID)
 
     if activeList and activeList.GetName() == 'ROIFiducials':
-      if activeList.GetNumberOfFiducials() > 0:
-        lastElement = activeList.GetNumberOfFiducials() - 1
-        self.ROIsPoints.addItem(activeList.GetNthFiducialLabel(lastElement))
+      # several markups may have been added since the last update
+      if activeList.GetNumberOfFiducials() > self.ROIsPoints.count:
+        for i in xrange(self.ROIsPoints.count, activeList.GetNumberOfFiducials()):
+          self.ROIsPoints.addItem(activeList.GetNthFiducialLabel(i))
         self.ROIsPoints.setCurrentIndex(self.ROIsPoints.count-1)
 
     self.onPathCreationSelection()
@@ -1368,17 +1530,7 @@ class BronchoscopyWidget:
     fidPosition = [0,0,0]
     ROIsList.GetNthFiducialPosition(fidIndex, fidPosition)
 
-    lm = slicer.app.layoutManager()
-    yellowWidget = lm.sliceWidget('Yellow')
-    yellowLogic = yellowWidget.sliceLogic()
-    greenWidget = lm.sliceWidget('Green')
-    greenLogic = greenWidget.sliceLogic()
-    redWidget = lm.sliceWidget('Red')
-    redLogic = redWidget.sliceLogic() 
-    
-    yellowLogic.SetSliceOffset(fidPosition[0])
-    greenLogic.SetSliceOffset(fidPosition[1])
-    redLogic.SetSliceOffset(fidPosition[2])
+    self.sliceViews.setOffsets(fidPosition)
     
   def onCreateLabelsFiducialsList(self):
 
@@ -1419,17 +1571,7 @@ class BronchoscopyWidget:
     fidPosition = [0,0,0]
     ROIsList.GetNthFiducialPosition(fidIndex, fidPosition)
 
-    lm = slicer.app.layoutManager()
-    yellowWidget = lm.sliceWidget('Yellow')
-    yellowLogic = yellowWidget.sliceLogic()
-    greenWidget = lm.sliceWidget('Green')
-    greenLogic = greenWidget.sliceLogic()
-    redWidget = lm.sliceWidget('Red')
-    redLogic = redWidget.sliceLogic() 
-    
-    yellowLogic.SetSliceOffset(fidPosition[0])
-    greenLogic.SetSliceOffset(fidPosition[1])
-    redLogic.SetSliceOffset(fidPosition[2])
+    self.sliceViews.setOffsets(fidPosition)
     
     #self.updateGUI()
 
@@ -1477,22 +1619,12 @@ class BronchoscopyWidget:
 
     AddedPathPointsList.AddFiducial(fidPosition[0],fidPosition[1],fidPosition[2])
 
-    lm = slicer.app.layoutManager()
-    yellowWidget = lm.sliceWidget('Yellow')
-    yellowLogic = yellowWidget.sliceLogic()
-    greenWidget = lm.sliceWidget('Green')
-    greenLogic = greenWidget.sliceLogic()
-    redWidget = lm.sliceWidget('Red')
-    redLogic = redWidget.sliceLogic() 
-    
-    yellowLogic.SetSliceOffset(fidPosition[0])
-    greenLogic.SetSliceOffset(fidPosition[1])
-    redLogic.SetSliceOffset(fidPosition[2])
+    self.sliceViews.setOffsets(fidPosition)
     
     #self.updateGUI()
   def onDefaultLayoutButton(self):
     self.fitSlicesToBackground()
-    self.layoutManager.setLayout(self.customLayoutId)
+    self.viewState.setLayout(self.customLayoutId)
 
     viewNode1 = slicer.util.getNode('vtkMRMLViewNode1')
     viewNode2 = slicer.util.getNode('vtkMRMLViewNode2')
@@ -1506,20 +1638,11 @@ class BronchoscopyWidget:
       fidPosition = [0,0,0]
       ROIsList.GetNthFiducialPosition(fidIndex, fidPosition)
 
-      yellowWidget = self.layoutManager.sliceWidget('Yellow')
-      yellowLogic = yellowWidget.sliceLogic()
-      greenWidget = self.layoutManager.sliceWidget('Green')
-      greenLogic = greenWidget.sliceLogic()
-      redWidget = self.layoutManager.sliceWidget('Red')
-      redLogic = redWidget.sliceLogic()
-
-      yellowLogic.SetSliceOffset(fidPosition[0])
-      greenLogic.SetSliceOffset(fidPosition[1])
-      redLogic.SetSliceOffset(fidPosition[2])
+      self.sliceViews.setOffsets(fidPosition)
 
   def onRedViewButton(self):
     self.fitSlicesToBackground()
-    self.layoutManager.setLayout(6)
+    self.viewState.setLayout(6)
 
     fidIndex = self.ROIsPoints.currentIndex
     ROIsList = slicer.util.getNode('ROIFiducials')
@@ -1527,14 +1650,11 @@ class BronchoscopyWidget:
       fidPosition = [0,0,0]
       ROIsList.GetNthFiducialPosition(fidIndex, fidPosition)
 
-      redWidget = self.layoutManager.sliceWidget('Red')
-      redLogic = redWidget.sliceLogic()
-
-      redLogic.SetSliceOffset(fidPosition[2])
+      self.sliceViews.setOffsets(fidPosition, ('Red',))
  
   def onYellowViewButton(self):
     self.fitSlicesToBackground()
-    self.layoutManager.setLayout(7)
+    self.viewState.setLayout(7)
 
     fidIndex = self.ROIsPoints.currentIndex
     ROIsList = slicer.util.getNode('ROIFiducials')
@@ -1542,14 +1662,11 @@ class BronchoscopyWidget:
       fidPosition = [0,0,0]
       ROIsList.GetNthFiducialPosition(fidIndex, fidPosition)
 
-      yellowWidget = self.layoutManager.sliceWidget('Yellow')
-      yellowLogic = yellowWidget.sliceLogic()
-
-      yellowLogic.SetSliceOffset(fidPosition[0])
+      self.sliceViews.setOffsets(fidPosition, ('Yellow',))
 
   def onGreenViewButton(self):
     self.fitSlicesToBackground()
-    self.layoutManager.setLayout(8)
+    self.viewState.setLayout(8)
 
     fidIndex = self.ROIsPoints.currentIndex
     ROIsList = slicer.util.getNode('ROIFiducials')
@@ -1557,10 +1674,7 @@ class BronchoscopyWidget:
       fidPosition = [0,0,0]
       ROIsList.GetNthFiducialPosition(fidIndex, fidPosition)
 
-      greenWidget = self.layoutManager.sliceWidget('Green')
-      greenLogic = greenWidget.sliceLogic()
-
-      greenLogic.SetSliceOffset(fidPosition[1])
+      self.sliceViews.setOffsets(fidPosition, ('Green',))
 
   def onPathCreationButton(self):
 
@@ -1568,104 +1682,30 @@ class BronchoscopyWidget:
     self.createLabelsFiducialsButton.setStyleSheet("background-color: rgb(255,255,255)")
     self.createNewPathPointsButton.setStyleSheet("background-color: rgb(255,255,255)")
 
-    if len(self.pathModelNamesList) > 0:
-      for n in xrange(len(self.pathModelNamesList)):
-        name = self.pathModelNamesList[n]
-        model = slicer.util.getNode(name)
-        slicer.mrmlScene.RemoveNode(model)
-      self.pathModelNamesList = []
-    
     labelFiducials = slicer.util.getNode('LabelPoints')
 
     if labelFiducials:
       self.disableButtonsAndSelectors()
 
       # Create Centerline Path   
-      if self.centerlinePointsList != []:
+      if len(self.centerlinePoints) > 0:
         self.CreateFiducialListButton.enabled = True
-      pos = [0,0,0]
+      airwayPolyData = self.inputSelector.currentNode().GetPolyData()
       targetPos = [0,0,0]
       for i in xrange(self.ROIsPoints.count):
         labelFiducials.GetNthFiducialPosition(i,targetPos)
-        firstPath = self.pathComputation(self.inputSelector.currentNode(), targetPos)
-        
-        listName = 'AddedPathPointsList-' + str(i+1)
-        AddedPathPointsList = slicer.util.getNode(listName)
-
-        if AddedPathPointsList:
-          if AddedPathPointsList.GetNumberOfFiducials() > 0:
-            firstPath.GetPoint(0,targetPos)
-            AddedPathPointsList.AddFiducial(targetPos[0],targetPos[1],targetPos[2])
-
-            listOfFiducials = []
-            distance = []
-            p=[0,0,0]
-            point=[0,0,0]
-            for n in xrange( AddedPathPointsList.GetNumberOfFiducials() ):
-              AddedPathPointsList.GetNthFiducialPosition(n,point)
-              p = [point[0],point[1],point[2]]
-              listOfFiducials.append(p)
-            
-            listOfFiducials = numpy.asarray(listOfFiducials)
-            targetPos = numpy.asarray(targetPos)
-            distance = ((listOfFiducials-targetPos)**2).sum(axis=1)
-            ndx = distance.argsort()
-            orderedList = []
-            for t in xrange(len(listOfFiducials)):
-              if t==0:
-                orderedList.append(listOfFiducials[ndx[t]])
-              if t > 0 and (distance[ndx[t]]-distance[ndx[t-1]]) >= 40: # ensure that fiducials are not too close to each other
-                orderedList.append(listOfFiducials[ndx[t]])
-
-            if len(orderedList) == 1:
-              orderedList.append(listOfFiducials[0])
-
-            computedPath = self.computeAddedPath(orderedList)
-            secondPath = self.createAddedPath(computedPath)
-
-          # Merge the two path
-          appendFilter = vtk.vtkAppendPolyData()
-          appendFilter.AddInputData(firstPath)
-          appendFilter.AddInputData(secondPath)
-          appendFilter.Update()
-        
-        ############################ Smooth centerline ###########################
-        if AddedPathPointsList:
-          createdPath = self.pathSmoothing(appendFilter.GetOutput())
-        else:
-          createdPath = self.pathSmoothing(firstPath)
-        ############################ Make the path thicker #######################
-        tubeFilter = vtk.vtkTubeFilter()
-        tubeFilter.SetInputData(createdPath)
-        tubeFilter.SetRadius(0.12)
-        tubeFilter.SetNumberOfSides(50)
-        tubeFilter.Update()
-
-        ############################ Create The 3D Model Of The Path And Add It To The Scene ############################################# 
-
-        model = slicer.vtkMRMLModelNode()
-        model.SetScene(slicer.mrmlScene)
-        model.SetName(slicer.mrmlScene.GenerateUniqueName("PathModel"))
-        model.SetAndObservePolyData(tubeFilter.GetOutput())
-
-        # Create display node
-        modelDisplay = slicer.vtkMRMLModelDisplayNode()
-        modelDisplay.SetColor(0,1,0) # green
-        modelDisplay.SetScene(slicer.mrmlScene)
-        modelDisplay.LightingOff()
-        modelDisplay.SetSliceIntersectionVisibility(1)
-        modelDisplay.SetSliceIntersectionThickness(10)
-        slicer.mrmlScene.AddNode(modelDisplay)
-        model.SetAndObserveDisplayNodeID(modelDisplay.GetID())
-
-        # Add to scene
-        if vtk.VTK_MAJOR_VERSION <= 5:
-          # shall not be needed.
-          modelDisplay.SetInputPolyData(model.GetPolyData())
-        slicer.mrmlScene.AddNode(model)
-
-        self.pathModelNamesList.append(model.GetName()) # Save names to delete models before creating the new ones.
-      
+
+        # Hermite path through the waypoints, merged with the centerline path and smoothed;
+        # only the stages whose inputs changed since the last planning run again
+        AddedPathPointsList = slicer.util.getNode('AddedPathPointsList-' + str(i+1))
+        waypoints = self.markupsPositions(AddedPathPointsList) if AddedPathPointsList else None
+        createdPath = self.logic.planPath(airwayPolyData, self.centerlinePoints[0], targetPos, waypoints, self.planningCache, i)
+
+        self.setPathModel(i, createdPath)
+
+      # paths of the ROIs removed since the last planning
+      self.removePathModels(self.ROIsPoints.count)
+
       self.pathCreated = 1
       
       #slicer.mrmlScene.RemoveNode(labelFiducials)
@@ -1697,218 +1737,165 @@ class BronchoscopyWidget:
 
     self.fitSlicesToBackground()
 
-  def pathComputation(self, inputModel, targetPosition):
-    """
-    Run the actual algorithm to create the path between the 2 fiducials
-    """
-    import vtkSlicerPathExtractionClassesModuleLogic as vmtkLogic
-        
-    inputPolyData = inputModel.GetPolyData()
-
-    sourceId = vtk.vtkIdList()
-    sourceId.SetNumberOfIds(1)
-
-    sourcePosition = self.centerlinePointsList[0]
-
-    source = inputPolyData.FindPoint(sourcePosition)
-
-    sourceId.InsertId(0,source)
-
-    targetId = vtk.vtkIdList()
-    targetId.SetNumberOfIds(1)
-
-    for i in xrange(0, 1):  
-      target = inputPolyData.FindPoint(targetPosition)
-      targetId.InsertId(i,target)
-
-    pathCreation = vmtkLogic.vtkSlicerPathExtractionClassesPolyDataCenterlinesLogic()
-
-    # Multiple paths for different ROIs are created!
-
-    self.createdPath = None
-    for t in xrange(targetId.GetNumberOfIds()):
-
-      tempTargetId = vtk.vtkIdList()
-      tempTargetId.SetNumberOfIds(1)
-      tempTargetId.InsertId(0,targetId.GetId(t))
+  def removePathModels(self, keep=0):
+    """ Removes the path models, but those of the first keep ROIs """
+    for name in self.pathModelNamesList[keep:]:
+      model = slicer.util.getNode(name)
+      if model:
+        slicer.mrmlScene.RemoveNode(model)
+      self.pathPolylines.pop(name, None)
+      self.pathTubes.pop(name, None)
+    self.pathModelNamesList = self.pathModelNamesList[:keep]
+    self.planningCache.retain(xrange(keep))
+
+  def setPathModel(self, roi, pathPolyData):
+    """ Shows pathPolyData in the path model of ROI roi, reusing the model planned for it before """
+    name = self.pathModelNamesList[roi] if roi < len(self.pathModelNamesList) else None
+    model = slicer.util.getNode(name) if name else None
+    if model is None:
+      model = self.createPathModel(pathPolyData)
+      if name:
+        # createPathModel appended the new name; it replaces the one of the removed model
+        self.pathPolylines.pop(name, None)
+        self.pathTubes.pop(name, None)
+        self.pathModelNamesList[roi] = self.pathModelNamesList.pop()
+      return model
+    if self.pathPolylines.get(name) is not pathPolyData:
+      # a new path: its tube is built again when it is selected
+      self.pathPolylines[name] = pathPolyData
+      self.pathTubes.pop(name, None)
+      model.SetAndObservePolyData(pathPolyData)
+    return model
+
+  def createPathModel(self, pathPolyData, name="PathModel"):
+    ############################ Create The 3D Model Of The Path And Add It To The Scene ############################################# 
+    # The model shows the polyline; onPathSelect makes the selected path thicker
+
+    model = slicer.vtkMRMLModelNode()
+    model.SetScene(slicer.mrmlScene)
+    model.SetName(slicer.mrmlScene.GenerateUniqueName(name))
+    model.SetAndObservePolyData(pathPolyData)
+    self.pathPolylines[model.GetName()] = pathPolyData
+
+    # Create display node
+    modelDisplay = slicer.vtkMRMLModelDisplayNode()
+    modelDisplay.SetColor(0,1,0) # green
+    modelDisplay.SetScene(slicer.mrmlScene)
+    modelDisplay.LightingOff()
+    modelDisplay.SetSliceIntersectionVisibility(1)
+    modelDisplay.SetSliceIntersectionThickness(10)
+    slicer.mrmlScene.AddNode(modelDisplay)
+    model.SetAndObserveDisplayNodeID(modelDisplay.GetID())
+
+    # Add to scene
+    if vtk.VTK_MAJOR_VERSION <= 5:
+      # shall not be needed.
+      modelDisplay.SetInputPolyData(model.GetPolyData())
+    slicer.mrmlScene.AddNode(model)
 
-      pathCreation.SetInputData(inputPolyData)
-      pathCreation.SetSourceSeedIds(sourceId)
-      pathCreation.SetTargetSeedIds(tempTargetId)
-      pathCreation.SetRadiusArrayName('MaximumInscribedSphereRadius')
-      pathCreation.SimplifyVoronoiOff();
-      pathCreation.CenterlineResamplingOn()
-      pathCreation.SetCostFunction('1/R')
-      pathCreation.GenerateDelaunayTessellationOn()
-      pathCreation.Update()
-    
-      createdPath = pathCreation.GetOutput()
+    self.pathModelNamesList.append(model.GetName()) # Save names to delete models before creating the new ones.
+    return model
 
-      #self.pathSmoothing(self.createdPath)
+  def onSavePlanningSession(self):
+    fileName = qt.QFileDialog.getSaveFileName(None, 'Save Planning Session', '', 'Planning session (*.npz)')
+    if not fileName:
+      return
+    if not fileName.lower().endswith('.npz'):
+      fileName += '.npz'
 
-    return pathCreation.GetOutput()
-     
-  def pathSmoothing(self, pathModel):
-      
-    import vtkSlicerPathExtractionClassesModuleLogic as vmtkLogic
-    
-    NumberOfPoints = pathModel.GetNumberOfPoints()
-    position = NumberOfPoints-1
-    startingPoint = [0,0,0]
-    pathModel.GetPoint(position,startingPoint)
-    targetPosition = [0,0,0]
-    pathModel.GetPoint(1,targetPosition)
-           
-    squaredDist = vtk.vtkMath.Distance2BetweenPoints(startingPoint,targetPosition)
-    
-    '''if (squaredDist < 10.000) :
-      smoothfactor = 1
-      iterations = 100
-    else:
-      smoothfactor = 1
-      iterations = 10'''
+    self.planningSession().save(fileName)
 
-    smoothfactor = 1
-    iterations = 10
-      
-    centerlineSmoothing = vmtkLogic.vtkSlicerPathExtractionClassesCenterlineSmoothingLogic()
-    centerlineSmoothing.SetInputData(pathModel)
-    centerlineSmoothing.SetNumberOfSmoothingIterations(iterations)
-    centerlineSmoothing.SetSmoothingFactor(smoothfactor)
-    centerlineSmoothing.Update()
-    
-    return centerlineSmoothing.GetOutput()
+  def planningSession(self):
+    '''PlanningSession of the centerline, ROIs, waypoints and paths in the scene'''
+    session = PlanningSession()
+    session.centerline = self.centerlinePoints.array
 
+    ROINode = slicer.util.getNode('ROIFiducials')
+    if ROINode:
+      session.rois = self.markupsPositions(ROINode)
+      session.roiLabels = [ROINode.GetNthFiducialLabel(i) for i in xrange(ROINode.GetNumberOfFiducials())]
+      for i in xrange(ROINode.GetNumberOfFiducials()):
+        waypointsNode = slicer.util.getNode('AddedPathPointsList-' + str(i+1))
+        session.waypoints.append(self.markupsPositions(waypointsNode) if waypointsNode else numpy.zeros((0,3)))
+    labelFiducials = slicer.util.getNode('LabelPoints')
+    if labelFiducials:
+      session.labelPoints = self.markupsPositions(labelFiducials)
 
-  def computeAddedPath(self, fiducialList, dl=0.5):
+    for name in self.pathModelNamesList:
+      polyline = self.pathPolylines[name]
+      session.addPath(name, CenterlineIO.polyDataPoints(polyline), CenterlineIO.polyDataLines(polyline))
+    return session
 
-    self.dl = dl # desired world space step size (in mm)
-    self.dt = dl # current guess of parametric stepsize
-    self.fids = fiducialList
+  def onLoadPlanningSession(self):
+    fileName = qt.QFileDialog.getOpenFileName(None, 'Load Planning Session', '', 'Planning session (*.npz)')
+    if not fileName:
+      return
+    session = PlanningSession.load(fileName)
+
+    self.centerlinePoints.clear()
+    self.centerlinePoints.extend(session.centerline)
+    self.centerlineFrames.clear()
+    self.applyPlanningSession(session)
+
+  def applyPlanningSession(self, session):
+    '''ROIs, label points, waypoints and path models of session, replacing those in the scene'''
+    ROINode = self.createMarkupsList('ROIFiducials', session.rois, session.roiLabels, 5, 3)
+    labelFiducials = self.createMarkupsList('LabelPoints', session.labelPoints, None, 3, 0, (0.0,1.0,1.0))
+    labelFiducials.SetDisplayVisibility(0)
+    for i in xrange(len(session.waypoints)):
+      waypointsNode = self.createMarkupsList('AddedPathPointsList-' + str(i+1), session.waypoints[i], None, 3, 0, (1.0,1.0,0.0))
+      waypointsNode.SetDisplayVisibility(0)
+
+    self.removePathModels()
+    for i in xrange(len(session.paths)):
+      self.createPathModel(CenterlineIO.polylinePolyData(session.paths[i], session.pathLines[i]), session.pathNames[i])
+    self.pathCreated = 1 if len(session.paths) > 0 else 0
+
+    self.ROIsPoints.clear()
+    self.fillComboBox(ROINode)
+    self.onSelect()
 
-    # hermite interpolation functions
-    self.h00 = lambda t: 2*t**3 - 3*t**2     + 1
-    self.h10 = lambda t:   t**3 - 2*t**2 + t
-    self.h01 = lambda t:-2*t**3 + 3*t**2
-    self.h11 = lambda t:   t**3 -   t**2
+  def markupsPositions(self, markupsNode):
+    if hasattr(slicer.util, 'arrayFromMarkupsControlPoints'):
+      return slicer.util.arrayFromMarkupsControlPoints(markupsNode)
+    positions = []
+    for i in xrange(markupsNode.GetNumberOfFiducials()):
+      point = [0,0,0]
+      markupsNode.GetNthFiducialPosition(i, point)
+      positions.append(point)
+    return numpy.array(positions).reshape(-1,3)
+
+  def createMarkupsList(self, name, positions, labels, glyphScale, textScale, selectedColor=None):
+    '''Markups fiducial list called name holding positions, replacing any list with that name'''
+    existingNode = slicer.util.getNode(name)
+    if existingNode:
+      slicer.mrmlScene.RemoveNode(existingNode)
+    markupsList = slicer.vtkMRMLMarkupsFiducialNode()
+    markupsList.SetName(name)
+    slicer.mrmlScene.AddNode(markupsList)
+    for i in xrange(len(positions)):
+      markupsList.AddFiducial(positions[i][0], positions[i][1], positions[i][2])
+      if labels:
+        markupsList.SetNthFiducialLabel(i, labels[i])
+    displayNode = markupsList.GetDisplayNode()
+    displayNode.SetGlyphScale(glyphScale)
+    displayNode.SetTextScale(textScale)
+    if selectedColor:
+      displayNode.SetSelectedColor(*selectedColor)
+    return markupsList
+
+  def pathTube(self, pathName):
+    """ Tube mesh around the path polyline, built the first time the path is shown """
+    if pathName not in self.pathTubes:
+      tubeFilter = vtk.vtkTubeFilter()
+      tubeFilter.SetInputData(self.pathPolylines[pathName])
+      tubeFilter.SetRadius(0.12)
+      tubeFilter.SetNumberOfSides(50)
+      tubeFilter.Update()
+      self.pathTubes[pathName] = tubeFilter.GetOutput()
+    return self.pathTubes[pathName]
 
-    # n is the number of control points in the piecewise curve
-    self.n = len(fiducialList)
-    n = self.n
-    if n == 0:
-      return
-    # get fiducial positions
-    # sets self.p
-    self.p = numpy.zeros((n,3))
-    for i in xrange(n):
-      #coord = [0.0, 0.0, 0.0]
-      self.p[i] = self.fids[i]
-
-    # calculate the tangent vectors
-    # - fm is forward difference
-    # - m is average of in and out vectors
-    # - first tangent is out vector, last is in vector
-    # - sets self.m
-    n = self.n
-    fm = numpy.zeros((n,3))
-    for i in xrange(0,n-1):
-      fm[i] = self.p[i+1] - self.p[i]
-    self.m = numpy.zeros((n,3))
-    for i in xrange(1,n-1):
-      self.m[i] = (fm[i-1] + fm[i]) / 2.
-    self.m[0] = fm[0]
-    self.m[n-1] = fm[n-2]
-
-    self.AddedPath = [self.p[0]]
-    self.calculateAddedPath()
-    
-    return self.AddedPath
 
-  def calculateAddedPath(self):
-    """ Generate a flight path for of steps of length dl """
-    #
-    # calculate the actual path
-    # - take steps of self.dl in world space
-    # -- if dl steps into next segment, take a step of size "remainder" in the new segment
-    # - put resulting points into self.path
-    #
-    n = self.n
-    segment = 0 # which first point of current segment
-    t = 0 # parametric current parametric increment
-    remainder = 0 # how much of dl isn't included in current step
-    while segment < n-1:
-      t, p, remainder = self.addedPathStep(segment, t, self.dl)
-      if remainder != 0 or t == 1.:
-        segment += 1
-        t = 0
-        if segment < n-1:
-          t, p, remainder = self.addedPathStep(segment, t, remainder)
-      self.AddedPath.append(p)
-
-  def AddedPoint(self,segment,t):
-    return (self.h00(t)*self.p[segment] +
-              self.h10(t)*self.m[segment] +
-              self.h01(t)*self.p[segment+1] +
-              self.h11(t)*self.m[segment+1])
-
-  def addedPathStep(self,segment,t,dl):
-    """ Take a step of dl and return the path point and new t
-      return:
-      t = new parametric coordinate after step
-      p = point after step
-      remainder = if step results in parametic coordinate > 1.0, then
-        this is the amount of world space not covered by step
-    """
-    p0 = self.AddedPath[self.AddedPath.__len__() - 1] # last element in path
-    remainder = 0
-    ratio = 100
-    count = 0
-    while abs(1. - ratio) > 0.05:
-      t1 = t + self.dt
-      pguess = self.AddedPoint(segment,t1)
-      dist = numpy.linalg.norm(pguess - p0)
-      ratio = self.dl / dist
-      self.dt *= ratio
-      if self.dt < 0.00000001:
-        return
-      count += 1
-      if count > 500:
-        return (t1, pguess, 0)
-    if t1 > 1.:
-      t1 = 1.
-      p1 = self.AddedPoint(segment, t1)
-      remainder = numpy.linalg.norm(p1 - pguess)
-      pguess = p1
-    return (t1, pguess, remainder)
-
-  def createAddedPath(self,path):
-
-    scene = slicer.mrmlScene
-
-    points = vtk.vtkPoints()
-    polyData = vtk.vtkPolyData()
-    polyData.SetPoints(points)
-
-    lines = vtk.vtkCellArray()
-    polyData.SetLines(lines)
-    linesIDArray = lines.GetData()
-    linesIDArray.Reset()
-    linesIDArray.InsertNextTuple1(0)
-
-    polygons = vtk.vtkCellArray()
-    polyData.SetPolys( polygons )
-    idArray = polygons.GetData()
-    idArray.Reset()
-    idArray.InsertNextTuple1(0)
-
-    for point in path:
-      pointIndex = points.InsertNextPoint(*point)
-      linesIDArray.InsertNextTuple1(pointIndex)
-      linesIDArray.SetTuple1( 0, linesIDArray.GetNumberOfTuples() - 1 )
-      lines.SetNumberOfCells(1)
-
-    return polyData
-   
   def onPathSelect(self):
     #self.updateGUI()
     # Hide all paths and fiducials...
@@ -1918,6 +1905,10 @@ class BronchoscopyWidget:
         pathModel = slicer.util.getNode(pathName)
         displayNode = pathModel.GetDisplayNode()
         displayNode.SetVisibility(0)
+        # hidden paths go back to their polyline, the tube stays cached
+        polyline = self.pathPolylines.get(pathName)
+        if polyline is not None and pathModel.GetPolyData() is not polyline:
+          pathModel.SetAndObservePolyData(polyline)
 
     fidNode =  slicer.util.getNode('ROIFiducials')
     fidDisplayNode = fidNode.GetDisplayNode()
@@ -1930,21 +1921,17 @@ class BronchoscopyWidget:
      
     # ...and show only the selected one
     pathModel = self.pathModelSelector.currentNode()
+    pathPolydata = self.pathPolylines.get(pathModel.GetName(), pathModel.GetPolyData())
+    if pathModel.GetName() in self.pathPolylines:
+      pathModel.SetAndObservePolyData(self.pathTube(pathModel.GetName()))
     displayNode = pathModel.GetDisplayNode()
     displayNode.SetVisibility(1)
 
     # Merge Centerline Points with Path Points 
-    if self.centerlinePointsList != []:
-      pathPolydata = pathModel.GetPolyData()
-      pathPoints = pathPolydata.GetPoints()
-      for j in xrange(pathPoints.GetNumberOfPoints()):
-        point = pathPoints.GetPoint(j)
-        p = [point[0],point[1],point[2]]
-        self.centerlinePointsList.append(point)
-
-      # Avoid repetition of the same point twice
-      self.centerlinePointsList = numpy.array([list(x) for x in set(tuple(x) for x in self.centerlinePointsList)])
-      self.centerlinePointsList = self.centerlinePointsList.tolist()
+    if len(self.centerlinePoints) > 0:
+      # only points not already in the centerline are added, once per path
+      pathKey = (pathModel.GetName(), pathPolydata.GetMTime())
+      self.centerlinePoints.mergePath(pathKey, vtk_to_numpy(pathPolydata.GetPoints().GetData()))
 
     # Display fiducial corresponding to the selected path
     name = pathModel.GetName()
@@ -1952,20 +1939,10 @@ class BronchoscopyWidget:
     #fidNode =  self.pointsListSelector.currentNode()
     fidNode.SetNthFiducialVisibility(idx,1)
 
-    self.pathInfo(pathModel, fidDisplayNode)
+    self.pathInfo(pathPolydata, fidDisplayNode)
 
-  def pathInfo(self, model, dispNode):
-    polyData = model.GetPolyData()
-    numberOfPoints = polyData.GetNumberOfPoints()
-    
-    firstPoint = [0,0,0]
-    polyData.GetPoint(numberOfPoints-1, firstPoint)
-    lastPoint = [0,0,0]
-    polyData.GetPoint(1, lastPoint)
-
-    squaredLength = vtk.vtkMath.Distance2BetweenPoints(firstPoint, lastPoint)
-    length = math.sqrt(squaredLength)
-    length = int(length)
+  def pathInfo(self, polyData, dispNode):
+    length = self.logic.pathLength(polyData)
     if length == 0:
       dispNode.SetSelectedColor(0.22,1.0,1.0)
     else:
@@ -2021,18 +1998,7 @@ class BronchoscopyWidget:
 
         self.ProbeTrackButton.text = "Stop Tracking"
 
-        if self.cNode == None:
-          cNodes = slicer.mrmlScene.GetNodesByName('ProbeConnector')
-          if cNodes.GetNumberOfItems() == 0:
-            self.cNode = slicer.vtkMRMLIGTLConnectorNode()
-            slicer.mrmlScene.AddNode(self.cNode)
-            self.cNode.SetName('ProbeConnector')
-          else:
-            self.cNode = cNodes.GetItemAsObject(0)
-
-        self.cNode.SetType(1)
-        self.cNode.SetTypeServer(18944)
-        self.cNode.Start()
+        self.startProbeConnector()
 
         ################## Transform matrix to compensate for possible flipping of the 3D image #####################
 
@@ -2101,12 +2067,20 @@ class BronchoscopyWidget:
             probeNode.SetAndObserveTransformNodeID(self.probeCalibrationTransform.GetID())
             #probePositionIndicator.SetAndObserveTransformNodeID(self.probeCalibrationTransform.GetID())
 
-        ################## Camera 1 and 3 (if any) are initialized and connected to the transform #####################
+        ################## Camera 1 and 3 (if any) are initialized; CheckCurrentPosition places them in RAS #####################
          
         self.initializeCamera()
-        self.cameraForNavigation.SetAndObserveTransformNodeID(self.probeCalibrationTransform.GetID())
+        self.cameraForNavigation.SetAndObserveTransformNodeID(None)
         if self.thirdCamera:
-          self.thirdCamera.SetAndObserveTransformNodeID(self.probeCalibrationTransform.GetID())
+          self.thirdCamera.SetAndObserveTransformNodeID(None)
+        self.centerlineFrames.update(self.centerlinePoints.array)
+
+        ####### Drift correction from the sensor trajectory, refined in the background ######
+        if self.trajectoryRefinementCheckBox.checked:
+          if self.trajectoryRefinement == None or len(self.trajectoryRefinement.centerline) != len(self.centerlinePoints):
+            self.trajectoryRefinement = TrajectoryRefinement(self.centerlinePoints.array)
+            self.driftCorrectionGeneration = 0
+          self.trajectoryRefinement.start()
       
         ####################### Set clipping range for first and third (if any) cameras ####################
         camera = self.cameraForNavigation.GetCamera()
@@ -2125,13 +2099,13 @@ class BronchoscopyWidget:
 
         ####### Red, yellow, and green positions are modified to follow the probe on the CT ###### 
  
-        lm = slicer.app.layoutManager()
-        yellowWidget = lm.sliceWidget('Yellow')
-        self.yellowLogic = yellowWidget.sliceLogic()
-        redWidget = lm.sliceWidget('Red')
-        self.redLogic = redWidget.sliceLogic() 
-        greenWidget = lm.sliceWidget('Green')
-        self.greenLogic = greenWidget.sliceLogic()
+        rate = self.sliceFollowRateSpinBox.value
+        self.sliceViews.followInterval = 1.0 / rate if rate else 0.0
+
+        ####### Wall distances of the airway label, for the in-lumen checks of every sensor position ######
+        labelVolume = self.labelSelector.currentNode()
+        if self.wallDistance is None and labelVolume:
+          self.wallDistance = self.logic.wallDistanceField(labelVolume)
  
         self.sensorTimer.start()
        
@@ -2149,6 +2123,10 @@ class BronchoscopyWidget:
       self.ImageRegistrationButton.hide()
 
       self.sensorTimer.stop()
+      if self.trajectoryRefinement:
+        self.trajectoryRefinement.stop()
+      # leave the slices at the last probe position
+      self.sliceViews.flush()
       
       if self.cNode:
         self.cNode.Stop()
@@ -2170,7 +2148,7 @@ class BronchoscopyWidget:
       self.enableSelectors()
       self.onSelect()
 
-      if self.centerlinePointsList != []:
+      if len(self.centerlinePoints) > 0:
         self.CreateFiducialListButton.enabled = True
 
       self.ProbeTrackButton.text = "Track Sensor"      
@@ -2183,17 +2161,93 @@ class BronchoscopyWidget:
 
 	###################### Centerline Compensation #########################
 
+        # every sensor is read, the probe (name None) first, all in CT coordinates once the tracker is
+        # registered (ProbeToTracker under TrackerToCT)
+        sensors = []
         if self.probeToTrackerTransformNode:
           transformMatrix = vtk.vtkMatrix4x4()
-          self.probeToTrackerTransformNode.GetMatrixTransformToParent(transformMatrix)
+          self.probeToTrackerTransformNode.GetMatrixTransformToWorld(transformMatrix)
+          sensors.append((None, transformMatrix))
 
           #if self.probeCalibrationTransform.GetTransformNodeID() == None:
             #self.probeCalibrationTransform.SetAndObserveTransformNodeID(self.centerlineCompensationTransform.GetID())
           if self.flipCompensationTransform.GetTransformNodeID() == None:
             self.flipCompensationTransform.SetAndObserveTransformNodeID(self.centerlineCompensationTransform.GetID())
 
-          self.CheckCurrentPosition(transformMatrix)
-  
+        for name in self.additionalSensorNames:
+          sensorNode = slicer.util.getNode(name)
+          if sensorNode:
+            sensorMatrix = vtk.vtkMatrix4x4()
+            sensorNode.GetMatrixTransformToWorld(sensorMatrix)
+            sensors.append((name, sensorMatrix))
+
+        if not sensors:
+          return
+
+        tickStart = time.time()
+        if self.trajectoryRefinement and self.trajectoryRefinement.thread:
+          sensors = [(name, self.applyDriftCorrection(matrix, name == None)) for name, matrix in sensors]
+
+        # one lookup in the shared centerline index for all the sensors
+        positions = [[matrix.GetElement(0,3), matrix.GetElement(1,3), matrix.GetElement(2,3)] for name, matrix in sensors]
+        indices, points = self.centerlinePoints.nearestMany(positions)
+        for (name, matrix), index, point in zip(sensors, indices, points):
+          if name == None:
+            self.CheckCurrentPosition(matrix, (index, point))
+          else:
+            self.placeSensor(name, matrix, point)
+        if self.loadMonitor:
+          self.loadMonitor.recordProcessing('tracking', time.time() - tickStart)
+
+  def onAdditionalSensorsChanged(self):
+    self.additionalSensorNames = [name.strip() for name in self.additionalSensorsLineEdit.text.split(',') if name.strip()]
+
+  def placeSensor(self, name, tMatrix, closestPoint):
+    # an additional sensor: snapped position, sensor rotation, through <name>Compensation
+    compensationTransform = self.sensorCompensationTransforms.get(name)
+    if compensationTransform == None:
+      compensationTransform = slicer.util.getNode(name + 'Compensation')
+      if compensationTransform == None:
+        compensationTransform = slicer.vtkMRMLLinearTransformNode()
+        compensationTransform.SetName(name + 'Compensation')
+        slicer.mrmlScene.AddNode(compensationTransform)
+      self.sensorCompensationTransforms[name] = compensationTransform
+      modelNode = slicer.util.getNode(name + 'Model')
+      if modelNode:
+        modelNode.SetAndObserveTransformNodeID(compensationTransform.GetID())
+
+    tMatrix.SetElement(0,3,closestPoint[0])
+    tMatrix.SetElement(1,3,closestPoint[1])
+    tMatrix.SetElement(2,3,closestPoint[2])
+    compensationTransform.SetMatrixTransformToParent(tMatrix)
+
+  def applyDriftCorrection(self, transformMatrix, record=True):
+    # records the raw probe position for the refinement, and applies the last correction it published
+    if record:
+      self.trajectoryRefinement.add([transformMatrix.GetElement(0,3), transformMatrix.GetElement(1,3), transformMatrix.GetElement(2,3)])
+    generation, correction, report = self.trajectoryRefinement.published
+    if generation == 0:
+      return transformMatrix
+
+    if generation != self.driftCorrectionGeneration:
+      self.driftCorrectionGeneration = generation
+      self.driftCorrectionMatrix = vtk.vtkMatrix4x4()
+      for row in range(4):
+        for column in range(4):
+          self.driftCorrectionMatrix.SetElement(row, column, correction[row, column])
+      # shown in the scene only: the correction is applied below, not through the ProbeToTracker, TrackerToCT chain
+      if self.driftCorrectionTransform == None:
+        self.driftCorrectionTransform = slicer.util.getNode('TrackerDriftCorrection')
+        if self.driftCorrectionTransform == None:
+          self.driftCorrectionTransform = slicer.vtkMRMLLinearTransformNode()
+          self.driftCorrectionTransform.SetName('TrackerDriftCorrection')
+          slicer.mrmlScene.AddNode(self.driftCorrectionTransform)
+      self.driftCorrectionTransform.SetMatrixTransformToParent(self.driftCorrectionMatrix)
+
+    correctedMatrix = vtk.vtkMatrix4x4()
+    vtk.vtkMatrix4x4.Multiply4x4(self.driftCorrectionMatrix, transformMatrix, correctedMatrix)
+    return correctedMatrix
+
   def initializeCamera(self):
     cameraNodes = slicer.mrmlScene.GetNodesByName('Default Scene Camera')
     self.cameraForNavigation = cameraNodes.GetItemAsObject(0)
@@ -2249,7 +2303,7 @@ class BronchoscopyWidget:
     if checked:
       self.newLayoutImageButton.text = "Return To Default Layout"  
       self.fitSlicesToBackground()
-      self.layoutManager.setLayout(self.three3DViewsLayoutId)
+      self.viewState.setLayout(self.three3DViewsLayoutId)
       if self.firstThreeDView == None:
         viewNode1 = slicer.util.getNode('vtkMRMLViewNode1')
         self.firstThreeDView = self.layoutManager.viewWidget(viewNode1).threeDView()
@@ -2263,8 +2317,8 @@ class BronchoscopyWidget:
       cameraNodes = slicer.mrmlScene.GetNodesByName('Default Scene Camera')
       self.thirdCamera = cameraNodes.GetItemAsObject(2)
 
-      if self.probeCalibrationTransform:
-        self.thirdCamera.SetAndObserveTransformNodeID(self.probeCalibrationTransform.GetID())
+      # placed in RAS with the navigation camera during tracking
+      self.thirdCamera.SetAndObserveTransformNodeID(None)
 
       thirdCamera = self.thirdCamera.GetCamera()
       thirdCamera.SetClippingRange(0.7081381565016212, 708.1381565016211)
@@ -2286,8 +2340,26 @@ class BronchoscopyWidget:
       flipMatrix.SetElement(1,1,fifthElement*changeSign)
 
       self.flipCompensationTransform.SetMatrixTransformToParent(flipMatrix)
-
-  def CheckCurrentPosition(self, tMatrix):
+      self.viewUpSign = -self.viewUpSign
+
+  def warnOffLumen(self, wallDistance):
+    # at most once a second, as the sensor is read much faster
+    now = time.time()
+    if now - self.offLumenWarningTime >= 1.0:
+      self.offLumenWarningTime = now
+      slicer.util.showStatusMessage('Sensor outside the airway lumen, %.1f mm from the wall' % -wallDistance, 1000)
+
+  def placeCamera(self, cameraNode, position, focalPoint, viewUp):
+    # one modified event for the three changes, and the roll found by image registration on top
+    wasModifying = cameraNode.StartModify()
+    cameraNode.SetPosition(position[0],position[1],position[2])
+    cameraNode.SetFocalPoint(focalPoint[0],focalPoint[1],focalPoint[2])
+    cameraNode.SetViewUp(viewUp[0],viewUp[1],viewUp[2])
+    if self.cameraRoll:
+      cameraNode.GetCamera().Roll(self.cameraRoll)
+    cameraNode.EndModify(wasModifying)
+
+  def CheckCurrentPosition(self, tMatrix, closest=None):
 
     #################################
     ####### Check translation #######
@@ -2301,88 +2373,62 @@ class BronchoscopyWidget:
     originalCoord[2] = tMatrix.GetElement(2,3)
 
     originalCoord = numpy.asarray(originalCoord)
-    self.centerlinePointsList = numpy.asarray(self.centerlinePointsList)
 
-    distance = ((self.centerlinePointsList-originalCoord)**2).sum(axis=1)
-    ndx = distance.argsort()
-    closestPoint = self.centerlinePointsList[ndx[0]]
+    wallDistance = self.wallDistance.distance(originalCoord) if self.wallDistance else None
+    if wallDistance is not None and wallDistance <= 0:
+      self.warnOffLumen(wallDistance)
+
+    # (index, point) when already snapped with the other sensors
+    closestIndex, closestPoint = closest if closest is not None else self.centerlinePoints.nearest(originalCoord)
+    if wallDistance is not None and wallDistance > 0 and self.snapOutsideLumenCheckBox.checked:
+      # in the lumen: the probe stays where the sensor is, oriented as at the closest centerline point
+      closestPoint = originalCoord
 
     tMatrix.SetElement(0,3,closestPoint[0])
     tMatrix.SetElement(1,3,closestPoint[1])
     tMatrix.SetElement(2,3,closestPoint[2])
 
-    self.centerlinePointsList = self.centerlinePointsList.tolist()
-
-    ##################################################
-    ############ Keep rotation constant ##############
-    ##################################################
-    ISRotation = []
-    
-    firstRow  = [0.0,0.0]
-    secondRow = [0.0,0.0]
-    thirdRow  = [0.0,0.0]
-
-    firstRow[0] = tMatrix.GetElement(0,0)
-    firstRow[1] = tMatrix.GetElement(0,1)
-
-    ISRotation.append(firstRow)
-
-    secondRow[0] = tMatrix.GetElement(1,0)
-    secondRow[1] = tMatrix.GetElement(1,1)
-
-    ISRotation.append(secondRow)
-
-    thirdRow[0] = tMatrix.GetElement(2,0)
-    thirdRow[1] = tMatrix.GetElement(2,1)
-
-    ISRotation.append(thirdRow)
-
-    ISRotation = numpy.asarray(ISRotation)
-    newMatrixSigns = numpy.sign(ISRotation)
+    ####################################################################################################################
+    ######### Orientation from the frame precomputed at the centerline point, whichever way the sensor rotates #########
+    ####################################################################################################################
 
-    if len(self.previousMatrixSigns) == 0:
-      self.previousMatrixSigns = newMatrixSigns
+    if closestIndex >= len(self.centerlineFrames):
+      self.centerlineFrames.update(self.centerlinePoints.array)
+    tangent, normal = self.centerlineFrames.frame(closestIndex)
 
-    tMatrix.SetElement(0,0,abs(firstRow[0])  * self.previousMatrixSigns[0,0])
-    tMatrix.SetElement(0,1,abs(firstRow[1])  * self.previousMatrixSigns[0,1])
-    tMatrix.SetElement(1,0,abs(secondRow[0]) * self.previousMatrixSigns[1,0])
-    tMatrix.SetElement(1,1,abs(secondRow[1]) * self.previousMatrixSigns[1,1])
-    tMatrix.SetElement(2,0,abs(thirdRow[0])  * self.previousMatrixSigns[2,0])
-    tMatrix.SetElement(2,1,abs(thirdRow[1])  * self.previousMatrixSigns[2,1])
+    # the probe points along the sensor z axis; keep the last direction while it is across the centerline
+    alignment = tangent[0]*tMatrix.GetElement(0,2) + tangent[1]*tMatrix.GetElement(1,2) + tangent[2]*tMatrix.GetElement(2,2)
+    if abs(alignment) > 0.25:
+      self.viewDirectionSign = 1 if alignment > 0 else -1
+    tangent = tangent * self.viewDirectionSign
 
-    ####################################################################################################################
-    # Continuosly Update ViewUp Of The Camera To Always Have It On One Direction Orthogonal To The Locator's Long Axis #
-    ####################################################################################################################
+    # probe model: sensor z along the tangent and -x along the normal, the view-up of the calibrated camera
+    xAxis = -normal
+    yAxis = numpy.cross(tangent, xAxis)
+    for row in range(3):
+      tMatrix.SetElement(row,0,xAxis[row])
+      tMatrix.SetElement(row,1,yAxis[row])
+      tMatrix.SetElement(row,2,tangent[row])
 
     x = closestPoint[0]
     y = closestPoint[1]
     z = closestPoint[2]          
-    #c = (x+y)/z
-    #viewUp = [1,1,c]
-    #self.cameraForNavigation.SetViewUp(viewUp)
 
-    self.yellowLogic.SetSliceOffset(x)
-    self.greenLogic.SetSliceOffset(y)
-    self.redLogic.SetSliceOffset(z)
+    self.sliceViews.followPosition(closestPoint)
 
     self.centerlineCompensationTransform.SetMatrixTransformToParent(tMatrix)
 
-    # force the camera position to be a bit higher to better watch the path
-    self.cameraForNavigation.SetPosition(x,y,z-1)
+    position = numpy.asarray(closestPoint)
+    viewUp = normal * self.viewUpSign
+    self.placeCamera(self.cameraForNavigation, position, position + 4*tangent, viewUp)
 
     if self.thirdCamera:
-      if self.thirdCameraInitialized == 0:
-        self.thirdCamera.SetPosition(x-20,y+15,z+70)
-      fp = [0.0,0.0,0.0]
-      self.cameraForNavigation.GetFocalPoint(fp)
-      self.thirdCamera.SetFocalPoint(fp)
-      viewUp = [0.0,0.0,0.0]
-      self.cameraForNavigation.GetViewUp(viewUp)
-      self.thirdCamera.SetViewUp(viewUp)
+      # a bit behind and above the navigation camera, looking at the same point
+      self.placeCamera(self.thirdCamera, position - 20*tangent + 5*viewUp, position + 4*tangent, viewUp)
 
     if len(self.pathModelNamesList) > 0:
       pathModel = self.pathModelSelector.currentNode()
-      pathPolyData = pathModel.GetPolyData()
+      pathPolyData = self.pathPolylines.get(pathModel.GetName(), pathModel.GetPolyData())
       self.distanceToTargetComputation(pathPolyData, closestPoint)
 
     pos = [0,0,0]
@@ -2403,30 +2449,17 @@ class BronchoscopyWidget:
     ####################################################################################################################
     elapsedTime = time.time() - self.time
     if self.bifurcationPointsList != [] and elapsedTime >= 3:
-      self.bifurcationPointsList = numpy.asarray(self.bifurcationPointsList)
-      closestPoint = numpy.asarray(closestPoint)
-
-      euclDist = ((self.bifurcationPointsList-closestPoint)**2).sum(axis=1)
-      minDist = min(euclDist)
+      bifurcationIndex, minDist = self.logic.nearestBifurcation(self.bifurcationPointsList, closestPoint)
 
       print minDist
       if 20 <= minDist <= 30:
-        self.registerImage()
+        self.registerImage(bifurcationIndex, closestPoint)
 
-      self.bifurcationPointsList = self.bifurcationPointsList.tolist()
-      closestPoint = closestPoint.tolist()
       self.time = time.time()
 
   def distanceToTargetComputation(self, polyData, secondPoint):
 
-    numberOfPoints = polyData.GetNumberOfPoints()
-    
-    firstPoint = [0,0,0]
-    polyData.GetPoint(numberOfPoints-1, firstPoint)
-
-    squaredDistance = vtk.vtkMath.Distance2BetweenPoints(firstPoint, secondPoint)
-    self.length = math.sqrt(squaredDistance)
-    self.length = int(self.length)
+    self.length = self.logic.distanceToTarget(polyData, secondPoint)
     
     # Change color of the fiducial when close to the ROI
     ROIFiducialList = slicer.util.getNode('ROIFiducials')
@@ -2490,9 +2523,10 @@ class BronchoscopyWidget:
         self.checkStreamingTimer.start()
     else:
 
-      # Stop image registration and hide button 
+      # Stop image registration and recording, hide button 
       self.ImageRegistrationButton.checked = False
       self.ImageRegistrationButton.enabled = False
+      self.recordVideoButton.checked = False
 
       if self.videoStreamingNode != None:
         self.VideoRegistrationButton.setText("Start Video Streaming")
@@ -2504,13 +2538,80 @@ class BronchoscopyWidget:
       if self.videoStreamingNode.GetState() == 2:
         videoNode = slicer.util.getNode('Image_Reference')
         if videoNode:
-          realViewWidget = self.layoutManager.sliceWidget('RealView')
-          RVLogic = realViewWidget.sliceLogic()
-          RV_cn = RVLogic.GetSliceCompositeNode()
-          RV_cn.SetBackgroundVolumeID(videoNode.GetID())
-          RVLogic.FitSliceToVolume(videoNode,1,1)
+          self.videoPreprocessing.setInputConnection(videoNode.GetImageDataConnection())
+          self.showRealView(videoNode)
           self.checkStreamingTimer.stop()
 
+  def showRealView(self, videoNode):
+    realViewWidget = self.layoutManager.sliceWidget('RealView')
+    RVLogic = realViewWidget.sliceLogic()
+    RV_cn = RVLogic.GetSliceCompositeNode()
+
+    if self.videoNodeObserverTag:
+      self.videoNodeObserverTag[0].RemoveObserver(self.videoNodeObserverTag[1])
+      self.videoNodeObserverTag = None
+
+    if self.cropVideoDisplayCheckBox.checked:
+      displayedNode = self.videoPreprocessing.updateDisplayNode('Image_Reference_Cropped')
+      # the cropped node is fed by the stage, so refresh it whenever a new frame arrives
+      tag = videoNode.AddObserver(slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onVideoFrameModified)
+      self.videoNodeObserverTag = (videoNode, tag)
+    else:
+      displayedNode = videoNode
+
+    RV_cn.SetBackgroundVolumeID(displayedNode.GetID())
+    RVLogic.FitSliceToVolume(displayedNode,1,1)
+
+  def onVideoFrameModified(self, caller, event):
+    if self.videoPreprocessing.displayNode:
+      self.videoPreprocessing.displayNode.Modified()
+
+  def onEndoscopeModelChanged(self, model):
+    self.videoPreprocessing.setEndoscopeModel(model)
+    videoNode = slicer.util.getNode('Image_Reference')
+    if videoNode and self.videoPreprocessing.inputConnection:
+      self.showRealView(videoNode)
+
+  def onCropVideoDisplayToggled(self, checked):
+    videoNode = slicer.util.getNode('Image_Reference')
+    if videoNode and self.videoPreprocessing.inputConnection:
+      self.showRealView(videoNode)
+
+  def onRecordVideoToggled(self, checked):
+    if checked:
+      videoNode = slicer.util.getNode('Image_Reference')
+      directory = qt.QFileDialog.getExistingDirectory() if videoNode else ''
+      if not directory:
+        if not videoNode:
+          qt.QMessageBox.warning(slicer.util.mainWindow(), 'Video Recording', 'No video is being streamed.')
+        self.recordVideoButton.checked = False
+        return
+      capacity = self.recordingFramesSpinBox.value or None
+      self.videoRecorder = VideoRecorder(directory, capacity=capacity)
+      tag = videoNode.AddObserver(slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onRecordVideoFrame)
+      self.videoRecorderObserverTag = (videoNode, tag)
+      self.recordingFramesSpinBox.enabled = False
+      self.recordVideoButton.setText("Stop Video Recording")
+      self.recordVideoButton.setStyleSheet("background-color: rgb(255,215,215)")
+    else:
+      if self.videoRecorderObserverTag:
+        self.videoRecorderObserverTag[0].RemoveObserver(self.videoRecorderObserverTag[1])
+        self.videoRecorderObserverTag = None
+      if self.videoRecorder:
+        self.videoRecorder.close()
+        print 'Video recording: ' + str(self.videoRecorder.stats())
+        self.videoRecorder = None
+      self.recordingFramesSpinBox.enabled = True
+      self.recordVideoButton.setText("Start Video Recording")
+      self.recordVideoButton.setStyleSheet("background-color: rgb(255,255,255)")
+
+  def onRecordVideoFrame(self, caller, event):
+    imageData = caller.GetImageData()
+    if imageData and self.videoRecorder:
+      dims = imageData.GetDimensions()
+      frame = vtk_to_numpy(imageData.GetPointData().GetScalars())
+      self.videoRecorder.addFrame(frame.reshape(dims[1], dims[0], -1), time.time())
+
   ###########################################################################################
   ################################## Image Registration #####################################
   ###########################################################################################
@@ -2518,64 +2619,44 @@ class BronchoscopyWidget:
     if checked: 
       fileName = qt.QFileDialog.getOpenFileName()
       print fileName
-      fileID = open(fileName, 'r')
-      for line in fileID:
-        line = eval('['+line+']')
-        self.bifurcationPointsList.append(line)
+      if fileName:
+        fileID = open(fileName, 'r')
+        for line in fileID:
+          line = eval('['+line+']')
+          self.bifurcationPointsList.append(line)
+      else:
+        # no file chosen: use the bifurcations found by the skeletonization, if any
+        self.bifurcationPointsList = [list(point) for point in self.centerlineBifurcations]
 
+      # cached solutions refer to indices in the bifurcation list just loaded
+      self.registrationCache.clear()
       self.time = time.time()
       self.ImageRegistrationButton.text = "Stop Image Registration"
     else:
       self.bifurcationPointsList = []
       self.ImageRegistrationButton.text = "Start Image Registration"
 
-  def registerImage(self):
+  def registerImage(self, bifurcationIndex=None, position=None):
     # Read the real image
     videoNode = slicer.util.getNode('Image_Reference')
 
-    # Crop image to remove the info part on the left side
-    VOIExtract = vtk.vtkExtractVOI()
-    VOIExtract.SetInputConnection(videoNode.GetImageDataConnection())
-    VOIExtract.SetVOI(180,571,58,430,0,0)
-    VOIExtract.Update()
-    
-    '''w = vtk.vtkPNGWriter()
-    w.SetInputConnection(VOIExtract.GetOutputPort())
-
-    w.SetFileName('C:/Users/Lab/Desktop/text.png')
-    w.Write()'''
-    
-    # Flip image about x
-    realImageFlipX = vtk.vtkImageFlip()
-    realImageFlipX.SetFilteredAxis(0)
-    realImageFlipX.SetInputConnection(VOIExtract.GetOutputPort())
-    #realImageFlipX.SetInputConnection(videoNode.GetImageDataConnection())
-
-    realImageFlipX.Update()
-    
-    # Convert image to gray-scale 
-    realExtract = vtk.vtkImageExtractComponents()
-    realExtract.SetComponents(0,1,2)
-    realLuminance = vtk.vtkImageLuminance()
-    
-    if vtk.VTK_MAJOR_VERSION <= 5:
-      realExtract.SetInput(realImageFlipX.GetOutput())
-      realLuminance.SetInput(realExtract.GetOutput())
-      realLuminance.GetOutput().Update() 
-    else:
-      realExtract.SetInputConnection(realImageFlipX.GetOutputPort())
-      realLuminance.SetInputConnection(realExtract.GetOutputPort())
-      realLuminance.Update()
+    # Crop image to remove the info part on the left side, flip it about x and convert it to gray-scale
+    self.videoPreprocessing.setInputConnection(videoNode.GetImageDataConnection())
+    realScalarVolume = self.videoPreprocessing.updateVolumeNode('fixedScalarImage')
 
-    realScalarVolume = slicer.vtkMRMLScalarVolumeNode()
-    realScalarVolume.SetName('fixedScalarImage')
-
-    if vtk.VTK_MAJOR_VERSION <= 5:
-      realScalarVolume.SetImageData(realLuminance.GetOutput())
-    else:
-      realScalarVolume.SetImageDataConnection(realLuminance.GetOutputPort())
-
-    slicer.mrmlScene.AddNode(realScalarVolume)
+    # Reuse the roll found the last time the probe was here if the video did not change
+    camera = self.cameraForNavigation.GetCamera()
+    cacheKey = None
+    if bifurcationIndex is not None:
+      realImage = realScalarVolume.GetImageData()
+      dims = realImage.GetDimensions()
+      signature = imageSignature(vtk_to_numpy(realImage.GetPointData().GetScalars()).reshape(dims[1],dims[0]))
+      cacheKey = self.registrationCache.key(bifurcationIndex, position, camera.GetDirectionOfProjection())
+      cachedRoll = self.registrationCache.lookup(cacheKey, signature)
+      if cachedRoll is not None:
+        self.cameraRoll += cachedRoll - camera.GetRoll()
+        camera.SetRoll(cachedRoll)
+        return
 
     # Grab 3D view
     pathModel = self.pathModelSelector.currentNode()
@@ -2584,59 +2665,613 @@ class BronchoscopyWidget:
     ROIfids = slicer.util.getNode('ROIFiducials')
     fidsDisplayNode = ROIfids.GetDisplayNode()
     fidsDisplayNode.SetVisibility(0)
-    
-    rw = self.firstThreeDView.renderWindow()
-    wti = vtk.vtkWindowToImageFilter()
-    wti.SetInput(rw)
+
+    if self.renderWindowGrabber == None:
+      self.renderWindowGrabber = vtk.vtkWindowToImageFilter()
+      self.renderedPreprocessing.setInputConnection(self.renderWindowGrabber.GetOutputPort())
+    self.renderWindowGrabber.SetInput(self.firstThreeDView.renderWindow())
     displayNode.SetVisibility(0)
     slicer.app.processEvents()
-    wti.Update()
+    self.renderWindowGrabber.Modified()
+    self.renderWindowGrabber.Update()
     displayNode.SetVisibility(1)
     fidsDisplayNode.SetVisibility(1)
     slicer.app.processEvents()
-    
-    # Convert image to gray-scale
-    movingExtract = vtk.vtkImageExtractComponents()
-    movingExtract.SetComponents(0,1,2)
-    movingLuminance = vtk.vtkImageLuminance()
-    if vtk.VTK_MAJOR_VERSION <= 5:
-      movingExtract.SetInput(wti.GetOutput())
-      movingLuminance.SetInput(movingExtract.GetOutput())
-      movingLuminance.GetOutput().Update() 
-    else:
-      movingExtract.SetInputConnection(wti.GetOutputPort())
-      movingLuminance.SetInputConnection(movingExtract.GetOutputPort())
-      movingLuminance.Update()
-
-    # Flip image about x
-    movingImageFlip = vtk.vtkImageFlip()
-    movingImageFlip.SetFilteredAxis(0)
-    movingImageFlip.SetInputData(movingLuminance.GetOutput())
-    movingImageFlip.Update()
-
-    movingScalarVolume = slicer.vtkMRMLScalarVolumeNode()
-    movingScalarVolume.SetName('movingScalarImage')
-   
-    if vtk.VTK_MAJOR_VERSION <= 5:
-      movingScalarVolume.SetImageData(movingImageFlip.GetOutput())
-    else:
-      movingScalarVolume.SetAndObserveImageData(movingImageFlip.GetOutput())
 
-    slicer.mrmlScene.AddNode(movingScalarVolume)
+    # Convert image to gray-scale and flip it about x
+    movingScalarVolume = self.renderedPreprocessing.updateVolumeNode('movingScalarImage')
 
     anglesNumber = 36
-    imageRegistration = slicer.modules.imageregistrationcli
+    angle = self.logic.registerImages(realScalarVolume, movingScalarVolume, anglesNumber)
+
+    camera.Roll(angle)
+    # kept when the camera is placed again along the centerline
+    self.cameraRoll += angle
+
+    if cacheKey is not None:
+      self.registrationCache.store(cacheKey, camera.GetRoll(), signature)
+
+#
+# BronchoscopyLogic
+#
+
+class BronchoscopyLogic(ScriptedLoadableModuleLogic):
+  """ The computations of the module, without any GUI.
+
+  Works on NumPy arrays, VTK polydata and MRML nodes, so it can be used from
+  scripts, benchmarks and Slicer started with --no-main-window:
+
+    from Bronchoscopy import BronchoscopyLogic
+    logic = BronchoscopyLogic()
+    centerline = logic.smoothCenterline(logic.extractCenterlineModel(labelVolume).GetPolyData())
+    path = logic.planPath(airwayPolyData, centerline[0], targetPosition)
+
+  The NumPy algorithms themselves are in BronchoscopyLib.CenterlineEngine.
+  """
+
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    # voxel reduction and timings of the last centerline extraction run on a reduced label
+    self.extractionReport = None
+
+  def ijkToRAS(self, volumeNode):
+    matrix = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(matrix)
+    return [[matrix.GetElement(row, column) for column in range(4)] for row in range(4)]
+
+  def reduceLabel(self, labelVolume, margin=5.0, spacing=None):
+    """ Label array cut to the airway bounding box grown by margin mm (and resampled to spacing mm), its IJK to RAS matrix and the LabelMapCropping report """
+    start = time.time()
+    labelArray, ijkToRAS, report = LabelMapCropping.cropLabel(slicer.util.array(labelVolume.GetID()), self.ijkToRAS(labelVolume), margin, spacing)
+    report['cropSeconds'] = time.time() - start
+    return labelArray, ijkToRAS, report
+
+  def caseKey(self, labelVolume):
+    """ Key of the case of the airway label in a CaseCache """
+    return caseKey(slicer.util.array(labelVolume.GetID()), self.ijkToRAS(labelVolume))
+
+  def wallDistanceField(self, labelVolume, band=10.0):
+    """ WallDistanceField of the airway label, built once per label and memory-mapped from the temporary directory afterwards """
+    directory = os.path.join(slicer.app.temporaryPath, 'BronchoscopyWallDistance')
+    return WallDistanceField.cached(slicer.util.array(labelVolume.GetID()), self.ijkToRAS(labelVolume), directory, band)
+
+  def registerTracker(self, fiducialNode, trackerPoints, transformNode=None):
+    """ Tracker to CT registration of the sensor positions on the fiducials, in the same order.
+
+    The matrix is written to transformNode (a 'TrackerToCT' node, created if
+    needed, when None); returns the node and the
+    LandmarkRegistration.registerLandmarks report.
+    """
+    fiducials = []
+    point = [0.0, 0.0, 0.0]
+    for index in range(fiducialNode.GetNumberOfFiducials()):
+      fiducialNode.GetNthFiducialPosition(index, point)
+      fiducials.append(list(point))
+    matrix, inliers, report = registerLandmarks(fiducials, trackerPoints)
+
+    if transformNode is None:
+      transformNode = slicer.util.getNode('TrackerToCT')
+      if transformNode is None:
+        transformNode = slicer.vtkMRMLLinearTransformNode()
+        transformNode.SetName('TrackerToCT')
+        slicer.mrmlScene.AddNode(transformNode)
+    trackerToCT = vtk.vtkMatrix4x4()
+    for row in range(4):
+      for column in range(4):
+        trackerToCT.SetElement(row, column, matrix[row, column])
+    transformNode.SetMatrixTransformToParent(trackerToCT)
+    print('Tracker registration on %d of %d fiducials: FRE %.2f mm' % (inliers.sum(), len(inliers), report['fre']))
+    return transformNode, report
+
+  def labelVolumeFromArray(self, labelArray, ijkToRAS, name):
+    """ New label map node holding a (k, j, i) array, placed by ijkToRAS """
+    if labelArray.dtype == bool:
+      labelArray = labelArray.astype(numpy.uint8)
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(labelArray.shape[2], labelArray.shape[1], labelArray.shape[0])
+    imageData.GetPointData().SetScalars(numpy_to_vtk(labelArray.ravel(), deep=True, array_type=get_vtk_array_type(labelArray.dtype)))
+    matrix = vtk.vtkMatrix4x4()
+    for row in range(4):
+      for column in range(4):
+        matrix.SetElement(row, column, ijkToRAS[row][column])
+    labelVolume = slicer.vtkMRMLLabelMapVolumeNode()
+    labelVolume.SetName(slicer.mrmlScene.GenerateUniqueName(name))
+    labelVolume.SetIJKToRASMatrix(matrix)
+    labelVolume.SetAndObserveImageData(imageData)
+    slicer.mrmlScene.AddNode(labelVolume)
+    return labelVolume
+
+  def _finishReport(self, report, extractionStart):
+    """ Adds the extraction time, and the time a run on the whole label would have taken more (assuming it scales with the voxels) """
+    report['extractionSeconds'] = time.time() - extractionStart
+    report['estimatedSavedSeconds'] = report['extractionSeconds'] * (1.0 / report['ratio'] - 1) - report['cropSeconds'] if report['ratio'] > 0 else 0.0
+    self.extractionReport = report
+    print('Centerline extraction on %d of %d voxels (%.1f%%), %.1f s; about %.1f s saved' % (
+      report['voxels'], report['originalVoxels'], 100 * report['ratio'], report['extractionSeconds'], report['estimatedSavedSeconds']))
+
+  def extractCenterlineModel(self, labelVolume, margin=None, spacing=None):
+    """ Runs the centerline extraction and model maker CLIs on the airway label; returns the (hidden) model node.
+
+    With a margin (mm) the CLIs run on the label cut to the airway bounding
+    box, resampled to spacing mm if given; the model is in RAS either way.
+    """
+    reducedLabel = None
+    if margin is not None or spacing:
+      labelArray, ijkToRAS, report = self.reduceLabel(labelVolume, margin or 0.0, spacing)
+      reducedLabel = labelVolume = self.labelVolumeFromArray(labelArray, ijkToRAS, labelVolume.GetName() + '-reduced')
+    extractionStart = time.time()
+
+    centerline = slicer.vtkMRMLScalarVolumeNode()
+    slicer.mrmlScene.AddNode(centerline)
+
+    centerlineExtraction = slicer.modules.centerlineextractioncli
     parameters = {
-          "fixedImage": realScalarVolume,
-          "movingImage": movingScalarVolume,
-          "anglesNumber": anglesNumber,
-          }
+        "inputVolume": labelVolume.GetID(),
+        "outputVolume": centerline.GetID(),
+        }
+    slicer.cli.run(centerlineExtraction, None, parameters, wait_for_completion=True)
+
+    # create 3D model of the centerline
+    hierarchyList = slicer.mrmlScene.GetNodesByName('CenterlineModelHierarchy')
+    if hierarchyList.GetNumberOfItems() == 0:
+      modelHierarchy = slicer.vtkMRMLModelHierarchyNode()
+      modelHierarchy.SetName('CenterlineModelHierarchy')
+      slicer.mrmlScene.AddNode(modelHierarchy)
+    else:
+      modelHierarchy = hierarchyList.GetItemAsObject(0)
+
+    parameters = {}
+    parameters["InputVolume"] = centerline.GetID()
+    parameters["ModelSceneFile"] = modelHierarchy.GetID()
+    parameters["Name"] = 'CenterlineModel'
+    parameters["Smooth"] = 0
+    parameters["Decimate"] = 0.00
+    slicer.cli.run(slicer.modules.modelmaker, None, parameters, True)
+    slicer.mrmlScene.RemoveNode(centerline)
+    if reducedLabel:
+      slicer.mrmlScene.RemoveNode(reducedLabel)
+      self._finishReport(report, extractionStart)
+
+    # the model maker output is the last model added
+    modelsCollection = slicer.mrmlScene.GetNodesByClass('vtkMRMLModelNode')
+    centerlineModel = modelsCollection.GetItemAsObject(modelsCollection.GetNumberOfItems()-1)
+    centerlineModel.GetDisplayNode().SetVisibility(0)
+    return centerlineModel
+
+  def extractCenterlineSkeleton(self, labelVolume, threads=None, margin=None, spacing=None):
+    """ Ordered centerline points, (start, stop, parent) branch rows and bifurcations of the airway label, in RAS.
+
+    The label is thinned in-process (BronchoscopyLib.Skeletonization) instead
+    of going through the centerline extraction and model maker CLIs; margin
+    and spacing reduce the label first, as for extractCenterlineModel.
+    """
+    if margin is None and not spacing:
+      return Skeletonization.centerlineFromMask(slicer.util.array(labelVolume.GetID()), self.ijkToRAS(labelVolume), threads)
+    labelArray, ijkToRAS, report = self.reduceLabel(labelVolume, margin or 0.0, spacing)
+    extractionStart = time.time()
+    centerline = Skeletonization.centerlineFromMask(labelArray, ijkToRAS, threads)
+    self._finishReport(report, extractionStart)
+    return centerline
+
+  def extractCenterlineParallel(self, labelVolume, depth=2, processes=None, margin=None, spacing=None):
+    """ extractCenterlineSkeleton, one airway subtree per process.
+
+    The tree is split at the branches of generation depth (the lobar bronchi
+    for 2) and the pieces are stitched back together, see
+    BronchoscopyLib.SubtreeExtraction.
+    """
+    report = None
+    if margin is None and not spacing:
+      labelArray, ijkToRAS = slicer.util.array(labelVolume.GetID()), self.ijkToRAS(labelVolume)
+    else:
+      labelArray, ijkToRAS, report = self.reduceLabel(labelVolume, margin or 0.0, spacing)
+    extractionStart = time.time()
+    points, branches, bifurcations, parallelReport = SubtreeExtraction.extractCenterlineParallel(labelArray, ijkToRAS, depth, processes)
+    print('%d subtrees: split in %.1f s, extracted in %.1f s (slowest part %.1f s, all parts %.1f s)' % (
+      parallelReport['subtrees'], parallelReport['splitSeconds'], parallelReport['extractionSeconds'],
+      max(parallelReport['regionSeconds']), sum(parallelReport['regionSeconds'])))
+    if report:
+      self._finishReport(report, extractionStart)
+    return points, branches, bifurcations
+
+  def centerlineModelPoints(self, polyData):
+    """ Central point of every 4th cell of the centerline model, from the end, as sampled by the smoothing """
+    numberOfCells = polyData.GetNumberOfCells()
+    cellIds = range(numberOfCells-10, 10, -4)
+    points = numpy.zeros((len(cellIds), 3))
+    for row, i in enumerate(cellIds):
+      cellPoints = polyData.GetCell(i).GetPoints()
+      points[row] = cellPoints.GetPoint(cellPoints.GetNumberOfPoints()//2)
+    return points
+
+  def smoothCenterline(self, polyData, iterations=3):
+    """ Ordered, smoothed centerline points of a centerline model """
+    return CenterlineEngine.smoothCenterline(self.centerlineModelPoints(polyData), iterations)
+
+  def computePath(self, airwayPolyData, sourcePosition, targetPosition):
+    """ Centerline of the airway model from the airway point closest to sourcePosition to the one closest to targetPosition """
+    import vtkSlicerPathExtractionClassesModuleLogic as vmtkLogic
+
+    sourceId = vtk.vtkIdList()
+    sourceId.InsertNextId(airwayPolyData.FindPoint(sourcePosition))
+    targetId = vtk.vtkIdList()
+    targetId.InsertNextId(airwayPolyData.FindPoint(targetPosition))
 
-    cliRegistrationNode = slicer.cli.run( imageRegistration,None,parameters,wait_for_completion=True )
-    angle = cliRegistrationNode.GetParameterDefault(0,2)
+    pathCreation = vmtkLogic.vtkSlicerPathExtractionClassesPolyDataCenterlinesLogic()
+    pathCreation.SetInputData(airwayPolyData)
+    pathCreation.SetSourceSeedIds(sourceId)
+    pathCreation.SetTargetSeedIds(targetId)
+    pathCreation.SetRadiusArrayName('MaximumInscribedSphereRadius')
+    pathCreation.SimplifyVoronoiOff()
+    pathCreation.CenterlineResamplingOn()
+    pathCreation.SetCostFunction('1/R')
+    pathCreation.GenerateDelaunayTessellationOn()
+    pathCreation.Update()
+    return pathCreation.GetOutput()
 
-    camera = self.cameraForNavigation.GetCamera()
-    camera.Roll(float(angle))
+  def smoothPath(self, pathPolyData, iterations=10, smoothFactor=1):
+    import vtkSlicerPathExtractionClassesModuleLogic as vmtkLogic
 
-    slicer.mrmlScene.RemoveNode(movingScalarVolume)
-    slicer.mrmlScene.RemoveNode(realScalarVolume)
+    centerlineSmoothing = vmtkLogic.vtkSlicerPathExtractionClassesCenterlineSmoothingLogic()
+    centerlineSmoothing.SetInputData(pathPolyData)
+    centerlineSmoothing.SetNumberOfSmoothingIterations(iterations)
+    centerlineSmoothing.SetSmoothingFactor(smoothFactor)
+    centerlineSmoothing.Update()
+    return centerlineSmoothing.GetOutput()
+
+  def addedPath(self, waypoints, target, dl=0.5):
+    """ Hermite path through the waypoints, ordered from target, as a polyline """
+    return CenterlineIO.polylinePolyData(CenterlineEngine.hermitePath(CenterlineEngine.orderWaypoints(waypoints, target), dl))
+
+  def planPath(self, airwayPolyData, sourcePosition, targetPosition, waypoints=None, cache=None, roi=0):
+    """ Smoothed path to targetPosition; with waypoints, the path is extended through them from its first point.
+
+    With a PlanningCache, the stages of roi whose inputs did not change since
+    the last call return the output they gave then, the same polydata.
+    """
+    if cache is None:
+      cache = PlanningCache()
+    # the MTime of a polydata changes with its content and differs from that of any other polydata
+    pathKey, path = cache.stage(roi, 'centerline', [airwayPolyData.GetMTime(), sourcePosition, targetPosition],
+                                lambda: self.computePath(airwayPolyData, sourcePosition, targetPosition))
+    if waypoints is not None and len(waypoints) > 0:
+      start = path.GetPoint(0)
+      waypoints = numpy.vstack((numpy.asarray(waypoints, dtype=numpy.float64).reshape(-1, 3), start))
+      addedKey, added = cache.hermitePath(roi, CenterlineEngine.orderWaypoints(waypoints, start))
+      def merge():
+        appendFilter = vtk.vtkAppendPolyData()
+        appendFilter.AddInputData(path)
+        appendFilter.AddInputData(CenterlineIO.polylinePolyData(added))
+        appendFilter.Update()
+        return appendFilter.GetOutput()
+      pathKey, path = cache.stage(roi, 'merged', [pathKey, addedKey], merge)
+    return cache.stage(roi, 'smoothed', [pathKey], lambda: self.smoothPath(path))[1]
+
+  def pathLength(self, pathPolyData):
+    """ Whole millimetres between the second and the last point of the path """
+    return CenterlineEngine.pathLength(CenterlineIO.polyDataPoints(pathPolyData))
+
+  def distanceToTarget(self, pathPolyData, position):
+    """ Whole millimetres from position to the end of the path """
+    return CenterlineEngine.distanceToTarget([pathPolyData.GetPoint(pathPolyData.GetNumberOfPoints()-1)], position)
+
+  def snapToCenterline(self, centerlinePoints, position):
+    """ Index and coordinates of the centerline point closest to position """
+    if not isinstance(centerlinePoints, CenterlinePointSet):
+      pointSet = CenterlinePointSet()
+      pointSet.extend(centerlinePoints)
+      centerlinePoints = pointSet
+    return centerlinePoints.nearest(position)
+
+  def nearestBifurcation(self, bifurcations, position):
+    return CenterlineEngine.nearestBifurcation(bifurcations, position)
+
+  def registerImages(self, fixedVolume, movingVolume, anglesNumber=36):
+    """ Roll angle (degrees) aligning the rendered view to the video frame """
+    parameters = {
+          "fixedImage": fixedVolume,
+          "movingImage": movingVolume,
+          "anglesNumber": anglesNumber,
+          }
+    cliRegistrationNode = slicer.cli.run(slicer.modules.imageregistrationcli, None, parameters, wait_for_completion=True)
+    return float(cliRegistrationNode.GetParameterDefault(0,2))
+
+
+class BronchoscopyTest(ScriptedLoadableModuleTest):
+  """ Checks the logic on synthetic data; runs without a main window """
+
+  def setUp(self):
+    slicer.mrmlScene.Clear(0)
+
+  def runTest(self):
+    self.setUp()
+    self.test_CenterlineEngine()
+    self.test_PathPolyData()
+    self.test_Snapping()
+    self.test_Skeletonization()
+    self.test_LabelCropping()
+    self.test_Stitching()
+    self.test_SubtreeExtraction()
+    self.test_WallDistance()
+    self.test_CenterlineFrames()
+    self.test_LandmarkRegistration()
+    self.test_TrajectoryRefinement()
+    self.test_PathPlanning()
+    self.test_CaseCache()
+
+  def test_CenterlineEngine(self):
+    t = numpy.linspace(0, 1, 200)
+    points = numpy.column_stack((10*numpy.sin(3*t), 10*numpy.cos(3*t), 100*t))
+    smoothed = CenterlineEngine.smoothCenterline(points, 3)
+    self.assertEqual(smoothed.shape, (199, 3))
+    self.assertTrue(numpy.allclose(smoothed[0], points[0]))
+
+    path = CenterlineEngine.hermitePath([[0, 0, 0], [0, 10, 0], [10, 20, 0]], dl=0.5)
+    steps = numpy.sqrt((numpy.diff(path, axis=0)**2).sum(axis=1))
+    self.assertTrue(numpy.allclose(path[0], [0, 0, 0]))
+    self.assertTrue(numpy.allclose(path[-1], [10, 20, 0], atol=0.5))
+    self.assertTrue(abs(numpy.median(steps) - 0.5) < 0.05)
+
+  def test_PathPolyData(self):
+    logic = BronchoscopyLogic()
+    waypoints = [[0, 0, 60], [0, 0, 20]]
+    path = logic.addedPath(waypoints, [0, 0, 0])
+    self.assertEqual(path.GetNumberOfCells(), 1)
+    self.assertTrue(path.GetNumberOfPoints() > 50)
+    self.assertEqual(logic.distanceToTarget(path, [0, 0, 0]), 60)
+
+  def test_Snapping(self):
+    logic = BronchoscopyLogic()
+    centerline = numpy.column_stack((numpy.zeros(101), numpy.zeros(101), numpy.arange(101.)))
+    index, point = logic.snapToCenterline(centerline, [1.0, 0.5, 42.2])
+    self.assertEqual(index, 42)
+    self.assertTrue(numpy.allclose(point, [0, 0, 42]))
+    # all sensors at once, one of them far from the centerline
+    pointSet = CenterlinePointSet()
+    pointSet.extend(centerline)
+    indices, points = pointSet.nearestMany([[1.0, 0.5, 42.2], [0, 3, 7.6], [50, 50, 200]])
+    self.assertEqual(list(indices), [42, 8, 100])
+    self.assertTrue(numpy.allclose(points[1], [0, 0, 8]))
+    # within a distance, several rings of cells away, and none beyond it
+    indices, distances = pointSet.nearestWithin([[1.0, 0.5, 42.2], [0, 9, 7.6], [50, 50, 200]], 10.0)
+    self.assertEqual(list(indices), [42, 8, -1])
+    self.assertAlmostEqual(distances[1], math.hypot(9, 0.4))
+    index, distance = logic.nearestBifurcation([[0, 0, 0], [0, 0, 50]], [0, 0, 45])
+    self.assertEqual((index, distance), (1, 25.0))
+
+  def tubesMask(self, shape, tubes):
+    """ Mask (k, j, i) of the union of (start, end, radius) tubes with round ends, in voxels """
+    kji = numpy.indices(shape).reshape(3, -1).T.astype(float)
+    mask = numpy.zeros(len(kji), dtype=bool)
+    for start, end, radius in tubes:
+      start, end = numpy.array(start, dtype=float), numpy.array(end, dtype=float)
+      t = numpy.clip(numpy.dot(kji - start, end - start) / numpy.dot(end - start, end - start), 0, 1)
+      mask |= ((kji - start - t[:, numpy.newaxis] * (end - start))**2).sum(axis=1) <= radius**2
+    return mask.reshape(shape)
+
+  def test_Skeletonization(self):
+    # a trachea along k splitting into two bronchi along j
+    k, j, i = numpy.indices((60, 60, 20))
+    mask = ((k >= 30) & ((j - 30)**2 + (i - 10)**2 <= 9)) | ((k >= 27) & (k <= 33) & (j >= 10) & (j <= 50) & (abs(i - 10) <= 3))
+    points, branches, bifurcations = Skeletonization.centerlineFromMask(mask)
+    self.assertEqual(len(branches), 3)
+    self.assertEqual(list(branches[:, 2]), [-1, 0, 0])
+    self.assertEqual(len(bifurcations), 1)
+    self.assertTrue(numpy.allclose(bifurcations[0], [10, 30, 30], atol=2))
+    # ordered from the top of the trachea
+    self.assertEqual(points[0][2], points[:, 2].max())
+
+    # a Y of tubes, a trachea of radius 6 and two bronchi of radius 4, cut flat at k = 95 and k = 8
+    mask = self.tubesMask((100, 80, 24), [((95, 40, 12), (55, 40, 12), 6), ((55, 40, 12), (8, 12, 12), 4), ((55, 40, 12), (8, 68, 12), 4)])
+    mask[96:] = False
+    mask[:8] = False
+    points, branches, bifurcations = Skeletonization.centerlineFromMask(mask)
+    self.assertEqual(len(branches), 3)
+    self.assertEqual(len(bifurcations), 1)
+    # the branches reach the ends of the label, within their radius
+    trachea = points[branches[0, 0]:branches[0, 1]]
+    self.assertTrue(trachea[:, 2].max() >= 95 - 6)
+    for start, stop, parent in branches[1:]:
+      self.assertTrue(points[start:stop, 2].min() <= 8 + 4)
+
+    # straight tubes 60 voxels long, oblique in k and j and in all three axes: one branch of about that length
+    for direction, radius in [((0.866, 0.5, 0), 8), ((0.707, 0.707, 0), 5), ((0.707, 0.707, 0), 10), ((0.577, 0.577, 0.577), 8)]:
+      start = numpy.array([radius + 3.0] * 3)
+      end = start + 60 * numpy.array(direction)
+      mask = self.tubesMask(tuple((end + radius + 4).astype(int)), [(start, end, radius)])
+      points, branches, bifurcations = Skeletonization.centerlineFromMask(mask)
+      self.assertEqual(len(branches), 1)
+      length = numpy.sqrt((numpy.diff(points, axis=0)**2).sum(axis=1)).sum()
+      self.assertTrue(abs(length - 60) < 5, (direction, radius, length))
+
+    # a staircase one voxel wide: its corners make 26-adjacency triangles, but it is one branch
+    skeleton = numpy.zeros((8, 8, 3), dtype=bool)
+    for step in range(7):
+      skeleton[step, step, 1] = skeleton[step, step + 1, 1] = True
+    branches, nodes = Skeletonization.skeletonBranches(skeleton)
+    self.assertEqual([len(branch) for branch in branches], [14])
+
+  def test_LabelCropping(self):
+    label = numpy.zeros((100, 120, 140), dtype=numpy.uint8)
+    label[40:60, 50:70, 60:90] = 1
+    ijkToRAS = [[0.5, 0, 0, -30], [0, 0.5, 0, -40], [0, 0, 2.0, -100], [0, 0, 0, 1]]
+    cropped, croppedToRAS, report = LabelMapCropping.cropLabel(label, ijkToRAS, margin=4.0)
+    self.assertEqual(cropped.shape, (24, 36, 46))
+    self.assertEqual(cropped.sum(), label.sum())
+    self.assertTrue(report['ratio'] < 0.05)
+    # the first voxel of the crop is where it was in the original volume
+    low = report['low']
+    self.assertTrue(numpy.allclose(numpy.dot(croppedToRAS, [0, 0, 0, 1]), numpy.dot(ijkToRAS, [low[2], low[1], low[0], 1])))
+    resampled, resampledToRAS, report = LabelMapCropping.cropLabel(label, ijkToRAS, margin=4.0, spacing=1.0)
+    self.assertEqual(report['spacing'], [1.0, 1.0, 1.0])
+    self.assertEqual(resampled.sum(), label.sum() * 0.5 * 0.5 * 2.0)
+
+  def test_Stitching(self):
+    # a trachea ending at z = 0 and two lobes starting 3 mm below its end
+    trachea = numpy.column_stack((numpy.zeros(11), numpy.zeros(11), numpy.arange(10, -1, -1.)))
+    central = (trachea, [[0, 11, -1]], numpy.zeros((0, 3)))
+    lobes = []
+    for side in (-1, 1):
+      lobe = numpy.column_stack((side * numpy.arange(1, 11.), numpy.zeros(10), -3 - numpy.arange(10.)))
+      lobes.append((lobe, [[0, 10, -1]], numpy.zeros((0, 3))))
+    points, branches, bifurcations = SubtreeExtraction.stitchCenterlines(central, lobes, spacing=1.0)
+    self.assertEqual(list(branches[:, 2]), [-1, 0, 0])
+    self.assertEqual(branches[-1][1], len(points))
+    # each lobe starts with a bridge from the end of the trachea
+    self.assertTrue(numpy.linalg.norm(points[branches[1][0]] - trachea[-1]) <= 1.0)
+    self.assertTrue(numpy.allclose(bifurcations, [[0, 0, 0]]))
+
+  def test_SubtreeExtraction(self):
+    # trachea, two main bronchi at 45 degrees and four lobar bronchi, (x, y, z) mm and radius mm, at 0.7 mm spacing
+    spacing = 0.7
+    airways = [((80, 40, 105), (80, 40, 60), 8), ((80, 40, 60), (52, 40, 32), 6), ((80, 40, 60), (108, 40, 32), 6),
+               ((52, 40, 32), (37, 20, 15), 4), ((52, 40, 32), (37, 60, 15), 4), ((108, 40, 32), (123, 20, 15), 4),
+               ((108, 40, 32), (123, 60, 15), 4)]
+    mask = self.tubesMask((150, 114, 192), [(numpy.array(start[::-1]) / spacing, numpy.array(end[::-1]) / spacing, radius / spacing)
+                                            for start, end, radius in airways])
+    ijkToRAS = numpy.diag([spacing, spacing, spacing, 1.0])
+    serialPoints, serialBranches, serialBifurcations = Skeletonization.centerlineFromMask(mask, ijkToRAS)
+    self.assertEqual(len(serialBranches), 7)
+    for depth in (1, 2):
+      points, branches, bifurcations, report = SubtreeExtraction.extractCenterlineParallel(mask, ijkToRAS, depth, processes=2)
+      self.assertEqual(report['subtrees'], 2 * depth)
+      self.assertEqual(len(branches), len(serialBranches))
+      # every branch starts where its parent ends
+      for start, stop, parent in branches[1:]:
+        self.assertTrue(numpy.linalg.norm(points[start] - points[branches[parent][1] - 1]) < 3)
+      # the same bifurcations as in one piece, none twice
+      self.assertEqual(len(bifurcations), len(serialBifurcations))
+      distances = numpy.sqrt(((serialBifurcations[:, numpy.newaxis] - bifurcations)**2).sum(axis=2))
+      self.assertTrue(distances.min(axis=1).max() < 3 and distances.min(axis=0).max() < 3)
+
+  def test_WallDistance(self):
+    # a tube of radius 10 voxels along k, 0.5 mm voxels
+    k, j, i = numpy.indices((40, 60, 60))
+    label = ((k >= 5) & (k < 35) & ((j - 30)**2 + (i - 30)**2 <= 100)).astype(numpy.uint8)
+    ijkToRAS = numpy.diag([0.5, 0.5, 0.5, 1.0])
+    field = WallDistanceField.build(label, ijkToRAS, band=5.0)
+    self.assertTrue(abs(field.distance([15, 15, 10]) - 5.0) < 0.5)
+    self.assertTrue(field.isInside([15, 15, 10]))
+    self.assertTrue(abs(field.distance([15, 22, 10]) + 2.0) < 0.5)
+    self.assertEqual(field.distance([100, 100, 100]), -5.0)
+    directory = os.path.join(slicer.app.temporaryPath, 'BronchoscopyTestWallDistance')
+    cached = WallDistanceField.cached(label, ijkToRAS, directory, band=5.0)
+    self.assertTrue(numpy.allclose(cached.distance([[15, 15, 10], [15, 22, 10]]), field.distance([[15, 15, 10], [15, 22, 10]])))
+
+  def test_CenterlineFrames(self):
+    # a helix, then a branch starting away from it
+    t = numpy.linspace(0, 10, 2000)
+    helix = numpy.column_stack((10*numpy.cos(t), 10*numpy.sin(t), -5*t))
+    branch = numpy.column_stack((numpy.arange(20.), numpy.zeros(20), 10 + numpy.zeros(20)))
+    frames = CenterlineFrames()
+    self.assertEqual(frames.update(helix), 2000)
+    self.assertEqual(frames.update(numpy.concatenate((helix, branch))), 20)
+    self.assertTrue(abs((frames.tangents * frames.normals).sum(axis=1)).max() < 1e-9)
+    # the normal turns smoothly along the helix: no flips from one point to the next
+    self.assertTrue((frames.normals[1:2000] * frames.normals[:1999]).sum(axis=1).min() > 0.99)
+    self.assertTrue(numpy.allclose(frames.binormals[0], numpy.cross(frames.tangents[0], frames.normals[0])))
+
+  def test_LandmarkRegistration(self):
+    # CT fiducials, and the tracker readings of a rotated and shifted tracker, one of them 15 mm off
+    random = numpy.random.RandomState(0)
+    fiducials = random.uniform(-50, 50, (8, 3))
+    angle = 0.7
+    rotation = numpy.array([[math.cos(angle), -math.sin(angle), 0], [math.sin(angle), math.cos(angle), 0], [0, 0, 1]])
+    trackerPoints = numpy.dot(fiducials - [10, 20, 30], rotation) + random.normal(0, 0.3, (8, 3))
+    trackerPoints[3] += [15, 0, 0]
+
+    fiducialNode = slicer.vtkMRMLMarkupsFiducialNode()
+    slicer.mrmlScene.AddNode(fiducialNode)
+    for point in fiducials:
+      fiducialNode.AddFiducial(point[0], point[1], point[2])
+    logic = BronchoscopyLogic()
+    transformNode, report = logic.registerTracker(fiducialNode, trackerPoints)
+    self.assertEqual(report['outliers'], [3])
+    self.assertTrue(report['fre'] < 1.0)
+    matrix = vtk.vtkMatrix4x4()
+    transformNode.GetMatrixTransformToParent(matrix)
+    self.assertTrue(numpy.allclose([matrix.GetElement(row, 3) for row in range(3)], [10, 20, 30], atol=1.0))
+
+  def test_TrajectoryRefinement(self):
+    # a trachea and a main bronchus, and a trajectory along them drifted by 3 degrees and 4 mm
+    trachea = numpy.column_stack((numpy.zeros(200), numpy.zeros(200), -0.5*numpy.arange(200)))
+    bronchus = numpy.column_stack((0.5*numpy.arange(1, 120), numpy.zeros(119), numpy.full(119, -99.5)))
+    centerline = numpy.concatenate((trachea, bronchus))
+    angle = math.radians(3)
+    rotation = numpy.array([[math.cos(angle), 0, math.sin(angle)], [0, 1, 0], [-math.sin(angle), 0, math.cos(angle)]])
+    raw = numpy.dot(centerline[::2] - [2, -1.5, 3], rotation)
+
+    refinement = TrajectoryRefinement(centerline)
+    refinement.add(raw[0])
+    refinement.add(raw[0] + 0.1)
+    self.assertEqual(refinement.count, 1)
+    self.assertFalse(refinement.refine())
+    for position in raw[1:]:
+      refinement.add(position)
+    self.assertTrue(refinement.refine())
+    generation, correction, report = refinement.published
+    self.assertEqual(generation, 1)
+    corrected = numpy.dot(raw, correction[:3, :3].T) + correction[:3, 3]
+    self.assertTrue(numpy.sqrt(((corrected - centerline[::2])**2).sum(axis=1)).max() < 0.5)
+
+  def test_PathPlanning(self):
+    waypoints = numpy.array([[0, 0, 0], [0, 10, 0], [10, 20, 0], [20, 20, 10], [30, 40, 10], [40, 40, 40]], dtype=float)
+    cache = PlanningCache()
+    key, points = cache.hermitePath(0, waypoints)
+    self.assertTrue(numpy.allclose(points, CenterlineEngine.hermitePath(waypoints)))
+    cache.hermitePath(1, waypoints)
+    # same waypoints: nothing runs again
+    self.assertTrue(cache.hermitePath(0, waypoints)[1] is points)
+    self.assertEqual(len(cache.computed), 2)
+    # a moved waypoint changes the segments on either side of it and their neighbours only
+    waypoints[4] += [2, 0, 0]
+    key, points = cache.hermitePath(0, waypoints)
+    self.assertEqual(cache.hermitePaths[0].computed, 3)
+    self.assertTrue(numpy.allclose(points, CenterlineEngine.hermitePath(waypoints)))
+    self.assertEqual(cache.computed, [(0, 'hermite'), (1, 'hermite'), (0, 'hermite')])
+    cache.retain([0])
+    self.assertEqual(list(cache.hermitePaths), [0])
+
+  def test_CaseCache(self):
+    directory = os.path.join(slicer.app.temporaryPath, 'BronchoscopyTestCases')
+    cache = CaseCache(16 << 20, directory, (CenterlinePointSet, CenterlineFrames))
+    t = numpy.linspace(0, 1, 20000)
+    keys = []
+    cases = []
+    for index in range(3):
+      points = numpy.column_stack((10*numpy.sin(3*t + index), 10*numpy.cos(3*t), 100*t))
+      pointSet = CenterlinePointSet()
+      pointSet.extend(points)
+      frames = CenterlineFrames()
+      frames.update(points[:1000])
+      keys.append(caseKey(numpy.full((2, 2, 2), index, dtype=numpy.uint8), numpy.identity(4)))
+      cases.append({'centerline': pointSet, 'frames': frames, 'bifurcations': points[::5000]})
+      cache.discard(keys[-1])
+      cache.put(keys[-1], cases[-1])
+    # with the hashes of their points, two cases of about 6.8 MB fit in 16 MB: the first one was spilled to disk
+    self.assertEqual(list(cache.entries), keys[1:])
+    self.assertEqual(cache.spills, 1)
+    self.assertTrue(keys[0] in cache)
+    # cases in memory come back as they were put, spilled ones are read back
+    self.assertTrue(cache.get(keys[2])['centerline'] is cases[2]['centerline'])
+    restored = cache.get(keys[0])
+    self.assertEqual(cache.loads, 1)
+    # restored from its sorted cells, the point set holds no hashes yet: the three cases fit
+    self.assertEqual(list(cache.entries), [keys[1], keys[2], keys[0]])
+    self.assertTrue(restored['centerline'].memoryBytes() < 1 << 20)
+    self.assertTrue(numpy.array_equal(restored['centerline'].array, cases[0]['centerline'].array))
+    self.assertTrue(numpy.allclose(restored['frames'].normals, cases[0]['frames'].normals))
+    self.assertTrue(numpy.array_equal(restored['bifurcations'], cases[0]['bifurcations']))
+    self.assertEqual(restored['centerline'].nearest([0, 10, 0])[0], cases[0]['centerline'].nearest([0, 10, 0])[0])
+    # put back unchanged, even as a copy of equal arrays, the case keeps its copy on disk
+    caseFile = os.path.join(directory, keys[0], 'case.json')
+    cache.put(keys[0], dict(restored, bifurcations=numpy.array(restored['bifurcations'])))
+    self.assertTrue(cache.entries[keys[0]][2] and os.path.exists(caseFile))
+    self.assertEqual(cache.spills, 1)
+    # extending it builds the hashes, so points already in the set are still recognized
+    self.assertEqual(restored['centerline'].extend(cases[0]['centerline'].array[:100]), 0)
+    self.assertEqual(restored['centerline'].extend([[0, 0, 200]]), 1)
+    self.assertTrue(restored['centerline'].memoryBytes() > 6 << 20)
+    # changed, it is no longer the case on disk
+    cache.put(keys[0], restored)
+    self.assertFalse(cache.entries[keys[0]][2] or os.path.exists(caseFile))
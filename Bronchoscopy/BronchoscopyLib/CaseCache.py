@@ -0,0 +1,218 @@
+"""
+Data derived for recently used cases, kept across scene closes.
+
+Closing the scene of one patient to open the next used to throw away the
+centerline, its snapping indices and orientation frames, the planned paths
+and the wall distance field, to be extracted, computed or loaded again when
+coming back to that patient. CaseCache keeps them per case, keyed by a hash
+of the airway label (caseKey), as a dict of artifacts: NumPy arrays, or
+objects with toArrays() and a fromArrays(arrays, metadata) class method
+(CenterlinePointSet, CenterlineFrames, PlanningSession, WallDistanceField).
+
+Cases in memory are kept in least recently used order. When the memory they
+hold exceeds budget (memoryBytes() of the artifacts that have one, such as
+the hashes of a CenterlinePointSet, the bytes of their arrays otherwise),
+the least recently used ones are spilled to directory, one .npy per array
+and a case.json describing the artifacts, and dropped from memory; the most
+recently used case always stays. A spilled case is memory-mapped back by
+get(), also in a later Slicer session, without computing anything again
+(a CenterlinePointSet is saved with its sorted cells), and written again
+only if it was replaced since: put() keeps the copy on disk when the
+artifacts give the arrays and metadata read from it (the same memory-mapped
+arrays, or equal ones). With diskBudget, the spilled cases used longest ago
+are deleted beyond that many bytes.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy
+
+FORMAT_VERSION = 1
+
+def caseKey(labelArray, ijkToRAS):
+  """ Hash of the label values and geometry identifying a case """
+  labelArray = numpy.ascontiguousarray(labelArray)
+  digest = hashlib.sha1()
+  digest.update(json.dumps([FORMAT_VERSION, list(labelArray.shape), str(labelArray.dtype)]).encode('ascii'))
+  digest.update(numpy.asarray(ijkToRAS, dtype=numpy.float64).tobytes())
+  digest.update(labelArray.view(numpy.uint8).data)
+  return digest.hexdigest()
+
+def _toArrays(value):
+  if isinstance(value, numpy.ndarray):
+    return {'array': value}, None
+  return value.toArrays()
+
+def artifactBytes(value):
+  """ Bytes held by an artifact: its memoryBytes(), or the bytes of its arrays """
+  if hasattr(value, 'memoryBytes'):
+    return int(value.memoryBytes())
+  return sum(int(numpy.asarray(array).nbytes) for array in _toArrays(value)[0].values())
+
+def _sameArray(array, read):
+  """ Whether array holds what the memory-mapped array read does: the same memory, or equal values """
+  array = numpy.asarray(array)
+  if array.shape != read.shape or array.dtype != read.dtype:
+    return False
+  return array.__array_interface__['data'][0] == read.__array_interface__['data'][0] or numpy.array_equal(array, read)
+
+def _directoryBytes(path):
+  return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+class CaseCache(object):
+  def __init__(self, budget=512 << 20, directory=None, types=(), diskBudget=None):
+    self.budget = budget
+    self.directory = directory
+    self.diskBudget = diskBudget
+    # classes of the object artifacts, by name, to build them again from spilled arrays
+    self.types = dict((cls.__name__, cls) for cls in types)
+    # key: (artifacts, bytes, whether the case on disk holds these artifacts), most recently used last
+    self.entries = collections.OrderedDict()
+    # key: {name: (arrays, metadata)} read from disk, for the cases in memory that hold them
+    self.read = {}
+    self.spills = 0
+    self.loads = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, key):
+    return key in self.entries or self._onDisk(key)
+
+  @property
+  def memoryBytes(self):
+    return sum(entry[1] for entry in self.entries.values())
+
+  def put(self, key, artifacts):
+    """ Keeps artifacts, a dict of name: artifact, as the case key, replacing what it held; its copy on disk stays if they did not change """
+    artifacts = dict(artifacts)
+    onDisk = key in self.entries and self.entries[key][2] and self._unchanged(key, artifacts)
+    if onDisk:
+      del self.entries[key]
+    else:
+      self.discard(key)
+    self.entries[key] = (artifacts, sum(artifactBytes(value) for value in artifacts.values()), onDisk)
+    self.enforceBudget()
+
+  def get(self, key):
+    """ Artifacts of the case key, from memory or from disk, or None """
+    entry = self.entries.pop(key, None)
+    if entry is None:
+      if not self._onDisk(key):
+        return None
+      artifacts, self.read[key] = self._load(key)
+      entry = (artifacts, sum(artifactBytes(value) for value in artifacts.values()), True)
+    self.entries[key] = entry
+    self.enforceBudget()
+    return entry[0]
+
+  def discard(self, key):
+    """ Forgets the case, in memory and on disk """
+    self.entries.pop(key, None)
+    self.read.pop(key, None)
+    if self._onDisk(key):
+      shutil.rmtree(self._path(key))
+
+  def enforceBudget(self):
+    """ Spills the least recently used cases, but the most recent one, until the others fit in budget """
+    total = self.memoryBytes
+    while total > self.budget and len(self.entries) > 1:
+      key, (artifacts, size, onDisk) = self.entries.popitem(last=False)
+      self.read.pop(key, None)
+      if self.directory is not None and not onDisk:
+        self._spill(key, artifacts)
+      total -= size
+
+  def clear(self):
+    """ Forgets the cases in memory; spilled cases stay on disk """
+    self.entries.clear()
+    self.read.clear()
+
+  def _path(self, key):
+    return os.path.join(self.directory, key)
+
+  def _onDisk(self, key):
+    return self.directory is not None and os.path.exists(os.path.join(self._path(key), 'case.json'))
+
+  def _unchanged(self, key, artifacts):
+    """ Whether artifacts give the arrays and metadata read from disk for the case key """
+    read = self.read.get(key)
+    if read is None or sorted(read) != sorted(artifacts):
+      return False
+    for name, value in artifacts.items():
+      arrays, metadata = _toArrays(value)
+      readArrays, readMetadata = read[name]
+      # compared as written to case.json
+      if sorted(arrays) != sorted(readArrays) or json.loads(json.dumps(metadata)) != readMetadata:
+        return False
+      if not all(_sameArray(arrays[arrayName], readArrays[arrayName]) for arrayName in arrays):
+        return False
+    return True
+
+  def _spill(self, key, artifacts):
+    path = self._path(key)
+    # written next to the case, then renamed, so a case.json is always complete
+    partial = path + '.partial'
+    for stale in (partial, path):
+      if os.path.isdir(stale):
+        shutil.rmtree(stale)
+    os.makedirs(partial)
+    description = {}
+    for name, value in artifacts.items():
+      arrays, metadata = _toArrays(value)
+      for arrayName, array in arrays.items():
+        numpy.save(os.path.join(partial, '%s.%s.npy' % (name, arrayName)), numpy.ascontiguousarray(array))
+      typeName = None if isinstance(value, numpy.ndarray) else type(value).__name__
+      description[name] = {'type': typeName, 'arrays': sorted(arrays), 'metadata': metadata}
+    with open(os.path.join(partial, 'case.json'), 'w') as f:
+      json.dump({'version': FORMAT_VERSION, 'spilled': time.time(), 'artifacts': description}, f)
+    os.rename(partial, path)
+    self.spills += 1
+    self._enforceDiskBudget()
+
+  def _load(self, key):
+    """ Artifacts of the spilled case key, and the {name: (arrays, metadata)} they were built from """
+    path = self._path(key)
+    with open(os.path.join(path, 'case.json')) as f:
+      case = json.load(f)
+    if case.get('version') != FORMAT_VERSION:
+      raise ValueError('Unsupported cached case version: %s' % case.get('version'))
+    artifacts, read = {}, {}
+    for name, description in case['artifacts'].items():
+      arrays = dict((arrayName, numpy.load(os.path.join(path, '%s.%s.npy' % (name, arrayName)), mmap_mode='r'))
+                    for arrayName in description['arrays'])
+      if description['type'] is None:
+        artifacts[name] = arrays['array']
+      elif description['type'] in self.types:
+        artifacts[name] = self.types[description['type']].fromArrays(arrays, description['metadata'])
+      else:
+        raise ValueError('Cached case %s holds an artifact of unknown type %s' % (key, description['type']))
+      read[name] = (arrays, description['metadata'])
+    # used now: the last to go when the disk budget is enforced
+    os.utime(os.path.join(path, 'case.json'), None)
+    self.loads += 1
+    return artifacts, read
+
+  def _enforceDiskBudget(self):
+    if self.diskBudget is None:
+      return
+    cases = []
+    for key in os.listdir(self.directory):
+      path = self._path(key)
+      if os.path.exists(os.path.join(path, 'case.json')):
+        cases.append((os.path.getmtime(os.path.join(path, 'case.json')), key, _directoryBytes(path)))
+    total = sum(case[2] for case in cases)
+    for used, key, size in sorted(cases):
+      if total <= self.diskBudget:
+        break
+      self.read.pop(key, None)
+      shutil.rmtree(self._path(key))
+      if key in self.entries:
+        artifacts, memory, onDisk = self.entries[key]
+        self.entries[key] = (artifacts, memory, False)
+      total -= size
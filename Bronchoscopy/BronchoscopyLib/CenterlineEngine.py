@@ -0,0 +1,174 @@
+"""
+Centerline and path computations on NumPy arrays.
+
+These are the algorithms of the module with no MRML, VTK or Qt in them, so
+they can be run from scripts, benchmarked and tested without Slicer:
+
+  smoothCenterline    relaxation of the points sampled on the centerline model
+  orderWaypoints      waypoints of an added path, ordered from the target
+  hermitePath         Hermite spline through waypoints, in steps of dl mm
+  hermiteSegment      one segment of it, between two control points
+  pathLength          straight-line length shown for a planned path
+  distanceToTarget    distance from the probe to the end of the path
+  nearestBifurcation  bifurcation closest to the probe
+
+BronchoscopyLogic (Bronchoscopy.py) applies them to polydata and MRML nodes.
+"""
+
+import numpy
+
+# the previous neighbour of a point is searched among all the points before it and the
+# NEIGHBOUR_WINDOW_AFTER ones after it, the next neighbour among all the points after it
+# and the NEIGHBOUR_WINDOW_BEFORE ones before it
+NEIGHBOUR_WINDOW_AFTER = 200
+NEIGHBOUR_WINDOW_BEFORE = 100
+
+RELAXATION = 0.5
+
+def _closeEnough(delta):
+  """ Within 3, 2 and 4 mm along x, y and z """
+  return delta[0] <= 3 and delta[1] <= 2 and delta[2] <= 4
+
+def _neighbour(point, candidates):
+  """ Closest candidate to point, walking further down the distance order while it is too far off-axis.
+
+  Returns the candidate and whether it was accepted.
+  """
+  order = ((candidates - point)**2).sum(axis=1).argsort()
+  neighbour = candidates[order[0]]
+  delta = abs(point - neighbour)
+  if delta[0] > 3 and delta[1] > 2:
+    if delta[2] > 4:
+      keepLooking = lambda delta: delta[0] > 3 and delta[1] > 2 and delta[2] > 4
+    else:
+      keepLooking = lambda delta: delta[0] > 3 and delta[1] > 2
+  elif delta[0] > 3:
+    keepLooking = lambda delta: delta[0] > 3
+  elif delta[1] > 2:
+    keepLooking = lambda delta: delta[0] > 2
+  else:
+    return neighbour, True
+
+  found = False
+  count = 1
+  while keepLooking(delta) and count < len(order) and not found:
+    neighbour = candidates[order[count]]
+    delta = abs(point - neighbour)
+    found = _closeEnough(delta)
+    count += 1
+  return neighbour, found
+
+def smoothCenterline(points, iterations=3):
+  """ Smoothed centerline from the points sampled on the centerline model.
+
+  Each interior point is moved halfway towards the midpoint of its previous
+  and next neighbours; points whose neighbours cannot be found within
+  3, 2 and 4 mm along x, y and z are left in place. The last sampled point is dropped,
+  as the original Smoothing did.
+  """
+  points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+  smoothed = points[:len(points) - 1].copy() if len(points) > 1 else points.copy()
+  for iteration in range(iterations):
+    source = points if iteration == 0 else smoothed.copy()
+    for n in range(1, len(source) - 1):
+      point = source[n]
+      above = numpy.concatenate((source[:n], source[n+1:n+NEIGHBOUR_WINDOW_AFTER]))
+      previousPoint, previousFound = _neighbour(point, above)
+      below = numpy.concatenate((source[n+1:], source[n-NEIGHBOUR_WINDOW_BEFORE:n]))
+      nextPoint, nextFound = _neighbour(point, below)
+      if previousFound and nextFound:
+        smoothed[n] = point + RELAXATION * (0.5 * (previousPoint + nextPoint) - point)
+      else:
+        smoothed[n] = point
+  return smoothed
+
+def orderWaypoints(waypoints, target, minimumSpacing=40):
+  """ Waypoints sorted by distance from target, dropping those closer than minimumSpacing (squared mm) to the previous one """
+  waypoints = numpy.asarray(waypoints, dtype=numpy.float64).reshape(-1, 3)
+  distance = ((waypoints - numpy.asarray(target, dtype=numpy.float64))**2).sum(axis=1)
+  order = distance.argsort()
+  ordered = [waypoints[order[0]]] if len(order) else []
+  for t in range(1, len(order)):
+    if distance[order[t]] - distance[order[t-1]] >= minimumSpacing:
+      ordered.append(waypoints[order[t]])
+  if len(ordered) == 1:
+    ordered.append(waypoints[0])
+  return numpy.asarray(ordered).reshape(-1, 3)
+
+def _hermite(p, m, segment, t):
+  return ((2*t**3 - 3*t**2 + 1) * p[segment] +
+          (t**3 - 2*t**2 + t) * m[segment] +
+          (-2*t**3 + 3*t**2) * p[segment+1] +
+          (t**3 - t**2) * m[segment+1])
+
+def hermiteTangents(controlPoints):
+  """ Tangents of the Hermite spline at its control points: average of the in and out vectors, out vector first, in vector last """
+  p = numpy.asarray(controlPoints, dtype=numpy.float64).reshape(-1, 3)
+  forward = numpy.diff(p, axis=0)
+  m = numpy.empty((len(p), 3))
+  m[1:-1] = (forward[:-1] + forward[1:]) / 2.
+  m[0] = forward[0]
+  m[-1] = forward[-1]
+  return m
+
+def hermiteSegment(start, end, startTangent, endTangent, dl=0.5):
+  """ Points dl mm apart along the Hermite curve from start (included) to end (excluded) """
+  p = numpy.array([start, end], dtype=numpy.float64)
+  m = numpy.array([startTangent, endTangent], dtype=numpy.float64)
+  points = [p[0]]
+
+  # parametric step, adapted so that each step covers dl in world space
+  dt = dl
+  t = 0.
+  while True:
+    ratio = 100
+    count = 0
+    while abs(1. - ratio) > 0.05:
+      t1 = t + dt
+      guess = _hermite(p, m, 0, t1)
+      ratio = dl / max(numpy.linalg.norm(guess - points[-1]), 1e-12)
+      dt *= ratio
+      if dt < 1e-8:
+        return numpy.asarray(points)
+      count += 1
+      if count > 500:
+        break
+    if t1 >= 1.:
+      # no step much shorter than dl before the end, which starts the next segment
+      if len(points) > 1 and numpy.linalg.norm(p[1] - points[-1]) < dl / 2.:
+        points.pop()
+      return numpy.asarray(points)
+    points.append(guess)
+    t = t1
+
+def hermitePath(controlPoints, dl=0.5):
+  """ Points along the Hermite spline through controlPoints, dl mm apart from each control point.
+
+  Each segment depends only on its two control points and their tangents,
+  so the path can be rebuilt a segment at a time (PathPlanning).
+  """
+  p = numpy.asarray(controlPoints, dtype=numpy.float64).reshape(-1, 3)
+  if len(p) < 2:
+    return p.copy()
+  m = hermiteTangents(p)
+  segments = [hermiteSegment(p[k], p[k+1], m[k], m[k+1], dl) for k in range(len(p) - 1)]
+  return numpy.concatenate(segments + [p[-1:]])
+
+def pathLength(points):
+  """ Whole millimetres between the second and the last point of a path """
+  points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+  if len(points) < 2:
+    return 0
+  return int(numpy.sqrt(((points[-1] - points[1])**2).sum()))
+
+def distanceToTarget(points, position):
+  """ Whole millimetres from position to the last point of the path """
+  points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+  return int(numpy.sqrt(((points[-1] - numpy.asarray(position, dtype=numpy.float64))**2).sum()))
+
+def nearestBifurcation(bifurcations, position):
+  """ Index of the bifurcation closest to position and its squared distance """
+  bifurcations = numpy.asarray(bifurcations, dtype=numpy.float64).reshape(-1, 3)
+  distance = ((bifurcations - numpy.asarray(position, dtype=numpy.float64))**2).sum(axis=1)
+  index = int(distance.argmin())
+  return index, float(distance[index])
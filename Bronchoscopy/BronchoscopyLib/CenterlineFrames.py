@@ -0,0 +1,136 @@
+"""
+Orientation frames along the centerline, for the navigation camera.
+
+Each centerline point gets a unit tangent and a unit normal perpendicular to
+it, carried from point to point by parallel transport (the double reflection
+method of Wang et al., "Computation of rotation minimizing frames", 2008):
+the normal turns only as much as the centerline bends, so a camera looking
+along the tangent with the normal as view-up does not roll or jitter from one
+tracking update to the next. The binormal is tangent x normal.
+
+Points are taken in the order of a CenterlinePointSet: runs of consecutive
+points no further apart than gap are polylines (centerline branches and
+merged paths); every other run starts with the normal of the closest point
+already framed, projected on its tangent, and the very first one with up.
+Frames are computed when points are added, for the new points only.
+"""
+
+import numpy
+
+# anterior in RAS: the view-up of the first run of points
+ANTERIOR = (0.0, 1.0, 0.0)
+
+def _unit(vectors):
+  norms = numpy.sqrt((vectors**2).sum(axis=-1))
+  return vectors / numpy.maximum(norms, 1e-12)[..., numpy.newaxis]
+
+def _perpendicular(vector, tangent):
+  """ vector made perpendicular to tangent and unit; some perpendicular unit vector if it is along tangent """
+  vector = vector - numpy.dot(vector, tangent) * tangent
+  if numpy.dot(vector, vector) < 1e-12:
+    axis = numpy.zeros(3)
+    axis[numpy.abs(tangent).argmin()] = 1.0
+    vector = axis - numpy.dot(axis, tangent) * tangent
+  return vector / numpy.sqrt(numpy.dot(vector, vector))
+
+def runStarts(points, gap):
+  """ Index of the first point of each run of points, consecutive points of a run being at most gap apart """
+  steps = numpy.sqrt((numpy.diff(points, axis=0)**2).sum(axis=1))
+  return numpy.concatenate(([0], numpy.flatnonzero(steps > gap) + 1))
+
+def runTangents(points, starts):
+  """ Unit tangents: central differences inside runs, one-sided at their ends, towards the previous point for single points """
+  stops = numpy.append(starts[1:], len(points))
+  following = numpy.minimum(numpy.arange(1, len(points) + 1), len(points) - 1)
+  previous = numpy.maximum(numpy.arange(-1, len(points) - 1), 0)
+  following[stops - 1] = stops - 1
+  previous[starts] = starts
+  single = starts[stops - starts == 1]
+  previous[single] = numpy.maximum(single - 1, 0)
+  following[single[single == 0]] = min(1, len(points) - 1)
+  return _unit(points[following] - points[previous])
+
+def transportNormal(normal, tangent, step, nextTangent):
+  """ normal at the next point, reflected along step then along the tangent difference (double reflection) """
+  lengthSquared = numpy.dot(step, step)
+  if lengthSquared > 1e-24:
+    normal = normal - (2.0 / lengthSquared) * numpy.dot(step, normal) * step
+    tangent = tangent - (2.0 / lengthSquared) * numpy.dot(step, tangent) * step
+  difference = nextTangent - tangent
+  lengthSquared = numpy.dot(difference, difference)
+  if lengthSquared > 1e-24:
+    normal = normal - (2.0 / lengthSquared) * numpy.dot(difference, normal) * difference
+  # keep it exactly perpendicular despite rounding
+  return _perpendicular(normal, nextTangent)
+
+class CenterlineFrames(object):
+  def __init__(self, gap=None, up=ANTERIOR):
+    # without a gap, it is found from the spacing of the first points framed
+    self.requestedGap = gap
+    self.up = numpy.asarray(up, dtype=numpy.float64)
+    self.clear()
+
+  def __len__(self):
+    return len(self.tangents)
+
+  def clear(self):
+    self.gap = self.requestedGap
+    self.points = numpy.zeros((0, 3))
+    self.tangents = numpy.zeros((0, 3))
+    self.normals = numpy.zeros((0, 3))
+
+  @property
+  def binormals(self):
+    return numpy.cross(self.tangents, self.normals)
+
+  def toArrays(self):
+    """ (arrays, metadata) from which fromArrays() restores the frames without computing them again """
+    arrays = {'points': self.points, 'tangents': self.tangents, 'normals': self.normals}
+    return arrays, {'requestedGap': self.requestedGap, 'gap': self.gap, 'up': self.up.tolist()}
+
+  @classmethod
+  def fromArrays(cls, arrays, metadata):
+    frames = cls(metadata['requestedGap'], metadata['up'])
+    frames.gap = metadata['gap']
+    frames.points = numpy.asarray(arrays['points'])
+    frames.tangents = numpy.asarray(arrays['tangents'])
+    frames.normals = numpy.asarray(arrays['normals'])
+    return frames
+
+  def update(self, points):
+    """ Frames for all points, computing only those added since the last call (all of them if points were removed) """
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+    if len(points) < len(self) or (len(self) and not numpy.array_equal(points[len(self) - 1], self.points[-1])):
+      self.clear()
+    new = points[len(self):]
+    if len(new) == 0:
+      return 0
+    if self.gap is None and len(points) > 1:
+      # a few times the usual spacing of the points
+      self.gap = 3.0 * float(numpy.median(numpy.sqrt((numpy.diff(points, axis=0)**2).sum(axis=1))))
+
+    starts = runStarts(new, self.gap or 0.0)
+    tangents = runTangents(new, starts)
+    normals = numpy.empty_like(new)
+    isStart = numpy.zeros(len(new), dtype=bool)
+    isStart[starts] = True
+    for index in range(len(new)):
+      if isStart[index]:
+        framed = numpy.concatenate((self.points, new[:index]))
+        framedNormals = numpy.concatenate((self.normals, normals[:index]))
+        if len(framed):
+          reference = framedNormals[((framed - new[index])**2).sum(axis=1).argmin()]
+        else:
+          reference = self.up
+        normals[index] = _perpendicular(reference, tangents[index])
+      else:
+        normals[index] = transportNormal(normals[index - 1], tangents[index - 1], new[index] - new[index - 1], tangents[index])
+
+    self.points = numpy.concatenate((self.points, new))
+    self.tangents = numpy.concatenate((self.tangents, tangents))
+    self.normals = numpy.concatenate((self.normals, normals))
+    return len(new)
+
+  def frame(self, index):
+    """ (tangent, normal) at point index """
+    return self.tangents[index], self.normals[index]
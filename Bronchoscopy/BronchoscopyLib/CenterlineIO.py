@@ -0,0 +1,178 @@
+"""
+Export and import of centerline points.
+
+writeCenterlineFiles streams CenterlineFiducials.fcsv and
+CenterlinePositions.txt from the point array in a single pass, formatting
+whole chunks of rows at once; the files are byte-for-byte what the csv based
+writer produced. Centerlines can also be saved as .npy or as VTK XML polydata
+(.vtp). Polydata written here carries a CENTERLINE_ARRAY_NAME field array,
+which tells extractCenterline that the points are already ordered and
+smoothed, so a centerline reloaded through the model selector skips the
+smoothing step.
+
+readCenterline loads any of these formats in bulk: .npy is memory-mapped,
+and the text files are parsed with a single numpy.fromstring call rather
+than row by row. Files that call does not parse whole, blank lines for
+instance, are read again with numpy.loadtxt, which reports the rows it
+cannot read.
+
+The VTK functions import vtk when called, so the text and .npy functions can
+be used without it.
+"""
+
+import os
+import re
+import warnings
+
+import numpy
+
+FIDUCIALS_FILE_NAME = 'CenterlineFiducials.fcsv'
+POSITIONS_FILE_NAME = 'CenterlinePositions.txt'
+
+# field data array marking an ordered, already smoothed centerline
+CENTERLINE_ARRAY_NAME = 'BronchoscopyCenterline'
+
+# csv.writer wrote floats with repr() and \r\n line ends
+FIDUCIAL_ROW = 'vtkMRMLMarkupsFiducialNode_%d,%r,%r,%r,0,0,0,1,1,1,0,CenterlineFiducials-%d,,\r\n'
+POSITION_ROW = '%r,%r,%r\r\n'
+
+# x,y,z columns of the data rows of a .fcsv file
+FIDUCIAL_COORDINATES = re.compile(br'^[^#,\r\n][^,\r\n]*,([^,\r\n]*,[^,\r\n]*,[^,\r\n]*),', re.M)
+
+def fiducialsHeader(version):
+  return ('# Markups fiducial file version = ' + str(version) + '\r\n'
+          '# CoordinateSystem = 0\r\n'
+          '# columns = id,x,y,z,ow,ox,oy,oz,vis,sel,lock,label,desc,associatedNodeID\r\n')
+
+def writeCenterlineFiles(points, directory, version, chunkRows=16384):
+  """ Writes the .fcsv fiducial list and the positions file in one pass over points """
+  points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+  fiducialsFileName = os.path.join(directory, FIDUCIALS_FILE_NAME)
+  positionsFileName = os.path.join(directory, POSITIONS_FILE_NAME)
+  with open(fiducialsFileName, 'wb') as fiducialsFile:
+    with open(positionsFileName, 'wb') as positionsFile:
+      fiducialsFile.write(fiducialsHeader(version).encode('ascii'))
+      for start in range(0, len(points), chunkRows):
+        chunk = points[start:start+chunkRows]
+        indices = numpy.arange(start, start + len(chunk), dtype=numpy.float64)
+        rows = numpy.column_stack((indices, chunk, indices + 1))
+        fiducialsFile.write(((FIDUCIAL_ROW * len(chunk)) % tuple(rows.ravel().tolist())).encode('ascii'))
+        positionsFile.write(((POSITION_ROW * len(chunk)) % tuple(chunk.ravel().tolist())).encode('ascii'))
+  return fiducialsFileName, positionsFileName
+
+def savePoints(fileName, points):
+  numpy.save(fileName, numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3))
+
+def polylinePolyData(points, lines=None):
+  """ Polydata with the given points and lines, by default a single polyline through the points.
+
+  lines is the legacy VTK connectivity (n0, id, id, ..., n1, id, ...), as returned by polyDataLines.
+  """
+  import vtk
+  from vtk.util.numpy_support import numpy_to_vtk
+  points = numpy.ascontiguousarray(points, dtype=numpy.float64).reshape(-1, 3)
+  vtkPoints = vtk.vtkPoints()
+  vtkPoints.SetData(numpy_to_vtk(points, deep=True))
+  if lines is None:
+    connectivity = numpy.empty(len(points) + 1, dtype=numpy.int64)
+    connectivity[0] = len(points)
+    connectivity[1:] = numpy.arange(len(points))
+    numberOfCells = 1 if len(points) else 0
+  else:
+    connectivity = numpy.ascontiguousarray(lines, dtype=numpy.int64)
+    numberOfCells = 0
+    index = 0
+    while index < len(connectivity):
+      index += connectivity[index] + 1
+      numberOfCells += 1
+  lines = vtk.vtkCellArray()
+  lines.SetCells(numberOfCells, numpy_to_vtk(connectivity, deep=True, array_type=vtk.VTK_ID_TYPE))
+  polyData = vtk.vtkPolyData()
+  polyData.SetPoints(vtkPoints)
+  polyData.SetLines(lines)
+  return polyData
+
+def centerlinePolyData(points):
+  """ Polyline through points, tagged as an ordered and smoothed centerline """
+  import vtk
+  polyData = polylinePolyData(points)
+  tag = vtk.vtkIntArray()
+  tag.SetName(CENTERLINE_ARRAY_NAME)
+  tag.InsertNextValue(1)
+  polyData.GetFieldData().AddArray(tag)
+  return polyData
+
+def writePolyData(fileName, points):
+  import vtk
+  writer = vtk.vtkXMLPolyDataWriter()
+  writer.SetFileName(fileName)
+  writer.SetDataModeToAppended()
+  writer.EncodeAppendedDataOff()
+  if vtk.VTK_MAJOR_VERSION <= 5:
+    writer.SetInput(centerlinePolyData(points))
+  else:
+    writer.SetInputData(centerlinePolyData(points))
+  writer.Write()
+
+def isCenterlinePolyData(polyData):
+  return polyData is not None and polyData.GetFieldData().GetArray(CENTERLINE_ARRAY_NAME) is not None
+
+def polyDataLines(polyData):
+  """ Legacy connectivity array of the lines of polyData """
+  from vtk.util.numpy_support import vtk_to_numpy
+  if polyData is None or polyData.GetLines() is None:
+    return numpy.zeros(0, dtype=numpy.int64)
+  return vtk_to_numpy(polyData.GetLines().GetData()).astype(numpy.int64)
+
+def polyDataPoints(polyData):
+  from vtk.util.numpy_support import vtk_to_numpy
+  if polyData is None or polyData.GetPoints() is None:
+    return numpy.zeros((0, 3))
+  return vtk_to_numpy(polyData.GetPoints().GetData()).astype(numpy.float64)
+
+def readPolyData(fileName):
+  import vtk
+  reader = vtk.vtkXMLPolyDataReader() if fileName.lower().endswith('.vtp') else vtk.vtkPolyDataReader()
+  reader.SetFileName(fileName)
+  reader.Update()
+  return reader.GetOutput()
+
+def _parseCoordinates(text):
+  """ Comma separated coordinates parsed in one call, None if text is not only numbers """
+  # unparsed text raises ValueError since NumPy 2, and only warns before
+  with warnings.catch_warnings():
+    warnings.simplefilter('error', DeprecationWarning)
+    try:
+      values = numpy.fromstring(text, dtype=numpy.float64, sep=',')
+    except (ValueError, DeprecationWarning):
+      return None
+  if values.size % 3 or values.size != text.count(b',') + 1 - text.endswith(b','):
+    return None
+  return values.reshape(-1, 3)
+
+def readPositions(fileName):
+  with open(fileName, 'rb') as f:
+    text = f.read().replace(b'\r\n', b',').replace(b'\n', b',').strip(b',')
+  points = _parseCoordinates(text) if text else numpy.zeros((0, 3))
+  if points is None:
+    points = numpy.loadtxt(fileName, delimiter=',', ndmin=2)
+  return points
+
+def readFiducials(fileName):
+  with open(fileName, 'rb') as f:
+    rows = FIDUCIAL_COORDINATES.findall(f.read())
+  points = _parseCoordinates(b','.join(rows)) if rows else numpy.zeros((0, 3))
+  if points is None:
+    points = numpy.loadtxt(fileName, delimiter=',', comments='#', usecols=(1, 2, 3), ndmin=2)
+  return points
+
+def readCenterline(fileName):
+  """ (n, 3) centerline points from a .npy, .vtp/.vtk, .fcsv or positions .txt file """
+  extension = os.path.splitext(fileName)[1].lower()
+  if extension == '.npy':
+    return numpy.load(fileName, mmap_mode='r')
+  if extension in ('.vtp', '.vtk'):
+    return polyDataPoints(readPolyData(fileName))
+  if extension == '.fcsv':
+    return readFiducials(fileName)
+  return readPositions(fileName)
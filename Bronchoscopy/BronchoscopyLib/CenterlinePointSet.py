@@ -0,0 +1,271 @@
+"""
+Ordered set of centerline points used for probe snapping.
+
+Points are kept in insertion order in a growing NumPy buffer. Two spatial
+hashes are maintained incrementally as points are added: a fine one, with
+cells the size of the merge tolerance, to drop points that are already in the
+set, and a coarse one used by nearest() to look only at the points around the
+probe. Adding n points therefore costs O(n) whatever the size of the set, and
+paths already merged are remembered so selecting them again adds nothing.
+
+nearestMany() looks up several probes at once, for all the tracked sensors
+of a tracking update. It uses the same coarse cells, as a sorted array of
+cell keys built when first needed after points were added, so the cells
+around every probe are found with one searchsorted and the candidates of
+all probes compared in one NumPy pass. nearestWithin() does the same over as
+many rings of cells as a maximum distance needs, for the ICP matching of
+TrajectoryRegistration.
+
+toArrays() saves the points with these sorted cells, so fromArrays() restores
+a set without hashing its points again: nearest() then uses the sorted cells
+too, and the two hashes are built only when points are added to it.
+"""
+
+import itertools
+import math
+import sys
+
+import numpy
+
+# coarse cell coordinates are packed in one int64 key, CELL_KEY_BITS bits each
+CELL_KEY_BITS = 20
+
+# probe to point distances computed at once when looking at all points
+FALLBACK_BLOCK = 1 << 20
+
+# bytes held by a hash entry, estimated: the key tuple of three ints and the list of its indices
+HASH_KEY_BYTES = 64 + 3 * 32 + 88
+# and by each index: its int, shared by the two hashes, and a slot in the list of each hash
+HASH_INDEX_BYTES = 32 + 2 * 8
+
+class CenterlinePointSet(object):
+  def __init__(self, tolerance=1e-3, cellSize=4.0, searchRings=2):
+    self.tolerance = float(tolerance)
+    self.cellSize = float(cellSize)
+    self.rings = [self._ring(ring) for ring in range(searchRings + 1)]
+    # cell offsets of the cubes searched by _nearestInCells, by number of rings
+    self.cubes = {}
+    self.buffer = numpy.empty((1024, 3), dtype=numpy.float64)
+    self.count = 0
+    self.pointKeys = {}
+    self.cells = {}
+    self.mergedPaths = set()
+    self.sortedCells = None
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, index):
+    return self.array[index]
+
+  @property
+  def array(self):
+    """ (n, 3) view of the points, in insertion order """
+    return self.buffer[:self.count]
+
+  def clear(self):
+    self.count = 0
+    self.pointKeys = {}
+    self.cells = {}
+    self.mergedPaths = set()
+    self.sortedCells = None
+
+  def extend(self, points):
+    """ Appends the points not yet in the set (within tolerance); returns how many were added """
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+    if len(points) == 0:
+      return 0
+    self._buildHashes()
+    # a restored buffer may be memory-mapped read-only
+    if self.count + len(points) > len(self.buffer) or not self.buffer.flags.writeable:
+      buffer = numpy.empty((max(2 * len(self.buffer), self.count + len(points)), 3), dtype=numpy.float64)
+      buffer[:self.count] = self.array
+      self.buffer = buffer
+
+    pointKeys = numpy.floor(points / self.tolerance).astype(numpy.int64).tolist()
+    cellKeys = numpy.floor(points / self.cellSize).astype(numpy.int64).tolist()
+    added = 0
+    for point, pointKey, cellKey in zip(points, pointKeys, cellKeys):
+      if self._contains(point, pointKey):
+        continue
+      index = self.count
+      self.buffer[index] = point
+      self.pointKeys.setdefault(tuple(pointKey), []).append(index)
+      self.cells.setdefault(tuple(cellKey), []).append(index)
+      self.count += 1
+      added += 1
+    if added:
+      self.sortedCells = None
+    return added
+
+  def append(self, point):
+    return self.extend([point])
+
+  def toArrays(self):
+    """ (arrays, metadata) from which fromArrays() builds the same set: the points and their sorted coarse cells """
+    keys, starts, counts, order = self._sortedCells()
+    arrays = {'points': self.array, 'cellKeys': keys, 'cellStarts': starts, 'cellCounts': counts, 'cellOrder': order}
+    return arrays, {'tolerance': self.tolerance, 'cellSize': self.cellSize, 'searchRings': len(self.rings) - 1}
+
+  @classmethod
+  def fromArrays(cls, arrays, metadata):
+    """ The set saved by toArrays(), using the arrays as they are (memory-mapped ones too); the hashes are built when extended """
+    pointSet = cls(metadata['tolerance'], metadata['cellSize'], metadata['searchRings'])
+    pointSet.buffer = arrays['points']
+    pointSet.count = len(pointSet.buffer)
+    if 'cellKeys' in arrays:
+      pointSet.sortedCells = (arrays['cellKeys'], arrays['cellStarts'], arrays['cellCounts'], arrays['cellOrder'])
+    pointSet.pointKeys = None
+    pointSet.cells = None
+    return pointSet
+
+  def memoryBytes(self):
+    """ Bytes held by the points, their sorted cells and the two hashes, the latter estimated per entry """
+    size = self.buffer.nbytes
+    if self.sortedCells is not None:
+      size += sum(array.nbytes for array in self.sortedCells)
+    if self.pointKeys is not None:
+      for hash in (self.pointKeys, self.cells):
+        size += sys.getsizeof(hash) + len(hash) * HASH_KEY_BYTES
+      size += self.count * HASH_INDEX_BYTES
+    return size
+
+  def _buildHashes(self):
+    """ The fine and coarse hashes of a set restored by fromArrays(), built the first time points are added """
+    if self.pointKeys is not None:
+      return
+    self.pointKeys = {}
+    for index, pointKey in enumerate(numpy.floor(self.array / self.tolerance).astype(numpy.int64).tolist()):
+      self.pointKeys.setdefault(tuple(pointKey), []).append(index)
+    keys, starts, counts, order = self._sortedCells()
+    cellKeys = numpy.floor(self.array[order[starts]] / self.cellSize).astype(numpy.int64).tolist()
+    self.cells = dict((tuple(cellKey), indices.tolist()) for cellKey, indices in zip(cellKeys, numpy.split(order, starts[1:])))
+
+  def mergePath(self, pathKey, points):
+    """ Adds the points of a path once; later calls with the same key add nothing """
+    if pathKey in self.mergedPaths:
+      return 0
+    self.mergedPaths.add(pathKey)
+    return self.extend(points)
+
+  def nearest(self, point):
+    """ Index and coordinates of the point closest to point """
+    point = numpy.asarray(point, dtype=numpy.float64)
+    if self.count == 0:
+      return None, None
+    if self.cells is None:
+      indices, points = self.nearestMany(point)
+      return int(indices[0]), points[0]
+    center = numpy.floor(point / self.cellSize).astype(numpy.int64)
+    candidates = []
+    for ring, offsets in enumerate(self.rings):
+      for offset in offsets:
+        candidates.extend(self.cells.get((center[0]+offset[0], center[1]+offset[1], center[2]+offset[2]), ()))
+      if candidates:
+        candidates = numpy.asarray(candidates)
+        distance = ((self.buffer[candidates] - point)**2).sum(axis=1)
+        best = distance.argmin()
+        # every point outside the rings searched is farther than ring * cellSize
+        if distance[best] <= (ring * self.cellSize)**2:
+          index = int(candidates[best])
+          return index, self.buffer[index].copy()
+        candidates = candidates.tolist()
+    distance = ((self.array - point)**2).sum(axis=1)
+    index = int(distance.argmin())
+    return index, self.buffer[index].copy()
+
+  def _cellKeys(self, cells):
+    offset = 1 << (CELL_KEY_BITS - 1)
+    cells = cells + offset
+    return (cells[..., 0] << (2 * CELL_KEY_BITS)) | (cells[..., 1] << CELL_KEY_BITS) | cells[..., 2]
+
+  def _sortedCells(self):
+    """ (keys, starts, counts, order): the coarse cells holding points, sorted by key, and the point indices sorted the same way """
+    if self.sortedCells is None:
+      keys = self._cellKeys(numpy.floor(self.array / self.cellSize).astype(numpy.int64))
+      order = numpy.argsort(keys, kind='mergesort')
+      keys, starts, counts = numpy.unique(keys[order], return_index=True, return_counts=True)
+      self.sortedCells = (keys, starts, counts, order)
+    return self.sortedCells
+
+  def nearestMany(self, points):
+    """ Indices (n,) and coordinates (n, 3) of the points closest to each of points (n, 3) """
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+    if self.count == 0 or len(points) == 0:
+      return numpy.zeros(0, dtype=numpy.int64), numpy.zeros((0, 3))
+    indices, best = self._nearestInCells(points, 1)
+
+    # every point outside the 27 cells is farther than cellSize: look at all points when nothing closer was found
+    missing = numpy.flatnonzero(best > self.cellSize**2)
+    if len(missing):
+      norms = (self.array**2).sum(axis=1)
+      blockSize = max(FALLBACK_BLOCK // self.count, 1)
+      for start in range(0, len(missing), blockSize):
+        block = missing[start:start + blockSize]
+        indices[block] = (norms - 2 * numpy.dot(points[block], self.array.T)).argmin(axis=1)
+    return indices, self.buffer[indices].copy()
+
+  def nearestWithin(self, points, maximumDistance):
+    """ Indices (n,) of the points closest to each of points (n, 3), -1 if none is within maximumDistance, and their distances (n,) """
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+    if self.count == 0 or len(points) == 0:
+      return numpy.full(len(points), -1, dtype=numpy.int64), numpy.full(len(points), numpy.inf)
+    indices, best = self._nearestInCells(points, 1)
+    # every point within maximumDistance is in the cells at most that many rings away; those nearer than cellSize are found
+    rings = int(math.ceil(maximumDistance / self.cellSize))
+    farther = numpy.flatnonzero(best > self.cellSize**2)
+    if rings > 1 and len(farther):
+      indices[farther], best[farther] = self._nearestInCells(points[farther], rings)
+    distances = numpy.sqrt(best)
+    indices[distances > maximumDistance] = -1
+    return indices, distances
+
+  def _nearestInCells(self, points, rings):
+    """ Indices (n,) and squared distances (n,) of the closest of the points in the cells up to rings away, -1 and inf if none """
+    keys, starts, counts, order = self._sortedCells()
+    offsets = self.cubes.get(rings)
+    if offsets is None:
+      offsets = numpy.array(list(itertools.product(range(-rings, rings + 1), repeat=3)), dtype=numpy.int64)
+      self.cubes[rings] = offsets
+
+    # the cells around each probe that hold points
+    neighbours = self._cellKeys(numpy.floor(points / self.cellSize).astype(numpy.int64)[:, numpy.newaxis, :] + offsets).ravel()
+    found = numpy.minimum(numpy.searchsorted(keys, neighbours), len(keys) - 1)
+    occupied = numpy.flatnonzero(keys[found] == neighbours)
+    found = found[occupied]
+    queryOfCell = occupied // len(offsets)
+
+    # every candidate point of every probe, compared at once
+    cellCounts = counts[found]
+    firsts = numpy.cumsum(cellCounts) - cellCounts
+    candidates = order[numpy.repeat(starts[found] - firsts, cellCounts) + numpy.arange(cellCounts.sum())]
+    queries = numpy.repeat(queryOfCell, cellCounts)
+    distances = ((self.buffer[candidates] - points[queries])**2).sum(axis=1)
+    indices = numpy.full(len(points), -1, dtype=numpy.int64)
+    best = numpy.full(len(points), numpy.inf)
+    if len(candidates) == 0:
+      return indices, best
+    # candidates are grouped by probe: the smallest distance of each group, then the first candidate at it
+    groups = numpy.flatnonzero(numpy.concatenate(([True], queries[1:] != queries[:-1])))
+    smallest = numpy.minimum.reduceat(distances, groups)
+    closest = numpy.flatnonzero(distances == numpy.repeat(smallest, numpy.diff(numpy.append(groups, len(queries)))))
+    closest = closest[numpy.concatenate(([True], queries[closest][1:] != queries[closest][:-1]))]
+    indices[queries[closest]] = candidates[closest]
+    best[queries[closest]] = distances[closest]
+    return indices, best
+
+  def _contains(self, point, pointKey):
+    tolerance2 = self.tolerance**2
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+      key = (pointKey[0]+offset[0], pointKey[1]+offset[1], pointKey[2]+offset[2])
+      for index in self.pointKeys.get(key, ()):
+        if ((self.buffer[index] - point)**2).sum() <= tolerance2:
+          return True
+    return False
+
+  def _ring(self, ring):
+    """ Cell offsets at Chebyshev distance ring """
+    if ring == 0:
+      return [(0, 0, 0)]
+    return [offset for offset in itertools.product(range(-ring, ring+1), repeat=3)
+            if max(abs(offset[0]), abs(offset[1]), abs(offset[2])) == ring]
@@ -0,0 +1,335 @@
+"""
+Local OpenIGTLink simulator for the Bronchoscopy module.
+
+Serves synthetic (or recorded) endoscope video as IMAGE messages named
+'Image_Reference' on the port the 'streamingConnector' connects to, and
+pushes TRANSFORM messages named 'ProbeToTracker' to the port the
+'ProbeConnector' server listens on. Only numpy and the standard library
+are needed, so it can be started from any Python interpreter:
+
+  python IGTLSimulator.py --video-fps 30 --tracking-rate 40 --centerline CenterlinePositions.txt
+"""
+
+import argparse
+import json
+import socket
+import struct
+import sys
+import threading
+import time
+
+import numpy
+
+IGTL_HEADER_FORMAT = '>H12s20sQQQ'
+IGTL_IMAGE_HEADER_FORMAT = '>HBBBBHHH12fHHHHHH'
+
+VIDEO_PORT = 18945
+TRACKER_PORT = 18944
+
+#
+# CRC-64/ECMA-182 as used by OpenIGTLink
+#
+
+CRC64_POLYNOMIAL = 0x42F0E1EBA9EA3693
+CRC64_MASK = 0xFFFFFFFFFFFFFFFF
+
+def _crc64Table():
+  table = numpy.zeros(256, dtype=numpy.uint64)
+  for i in range(256):
+    crc = i << 56
+    for bit in range(8):
+      if crc & (1 << 63):
+        crc = ((crc << 1) ^ CRC64_POLYNOMIAL) & CRC64_MASK
+      else:
+        crc = (crc << 1) & CRC64_MASK
+    table[i] = crc
+  return table
+
+CRC64_TABLE = _crc64Table()
+_CRC64_TABLE_LIST = [int(v) for v in CRC64_TABLE]
+
+def _crc64Bytes(crc, data):
+  table = _CRC64_TABLE_LIST
+  for byte in bytearray(data):
+    crc = table[((crc >> 56) ^ byte) & 0xFF] ^ ((crc << 8) & CRC64_MASK)
+  return crc
+
+def _zeroShiftColumns(numberOfBytes):
+  """ Images of the 64 register bits after feeding numberOfBytes zero bytes """
+  # one zero byte
+  columns = [_crc64Bytes(1 << bit, b'\x00') for bit in range(64)]
+  result = [1 << bit for bit in range(64)]
+  while numberOfBytes:
+    if numberOfBytes & 1:
+      result = [_applyColumns(columns, value) for value in result]
+    columns = [_applyColumns(columns, value) for value in columns]
+    numberOfBytes >>= 1
+  return result
+
+def _applyColumns(columns, value):
+  out = 0
+  bit = 0
+  while value:
+    if value & 1:
+      out ^= columns[bit]
+    value >>= 1
+    bit += 1
+  return out
+
+def crc64(data, chunks=1024):
+  """ CRC-64/ECMA-182 of a bytes-like object.
+
+  Large buffers are split into equal chunks whose CRCs are computed side by
+  side with numpy and then combined, which keeps full video frames cheap.
+  """
+  data = numpy.frombuffer(data, dtype=numpy.uint8)
+  chunkLength = len(data) // chunks
+  if chunkLength < 64:
+    return _crc64Bytes(0, data.tobytes())
+
+  blocks = data[:chunks*chunkLength].reshape(chunks, chunkLength)
+  registers = numpy.zeros(chunks, dtype=numpy.uint64)
+  shift56 = numpy.uint64(56)
+  shift8 = numpy.uint64(8)
+  for j in range(chunkLength):
+    index = ((registers >> shift56) ^ blocks[:,j]).astype(numpy.intp)
+    registers = CRC64_TABLE[index] ^ (registers << shift8)
+
+  columns = _zeroShiftColumns(chunkLength)
+  crc = 0
+  for register in registers:
+    crc = _applyColumns(columns, crc) ^ int(register)
+  return _crc64Bytes(crc, data[chunks*chunkLength:].tobytes())
+
+#
+# Message packing
+#
+
+def _timestamp(t):
+  seconds = int(t)
+  fraction = int((t - seconds) * (1 << 32)) & 0xFFFFFFFF
+  return (seconds << 32) | fraction
+
+def packMessage(messageType, deviceName, body, timestamp=None):
+  if timestamp is None:
+    timestamp = time.time()
+  header = struct.pack(IGTL_HEADER_FORMAT, 1, messageType.encode('ascii'), deviceName.encode('ascii'),
+                       _timestamp(timestamp), len(body), crc64(body))
+  return header + body
+
+def packTransform(deviceName, matrix, timestamp=None):
+  """ matrix is a 4x4 array, RAS """
+  matrix = numpy.asarray(matrix, dtype=numpy.float64)
+  values = list(matrix[:3,:3].T.ravel()) + list(matrix[:3,3])
+  body = struct.pack('>12f', *values)
+  return packMessage('TRANSFORM', deviceName, body, timestamp)
+
+def packImageBody(frame):
+  """ frame is a (rows, columns, components) uint8 array """
+  frame = numpy.ascontiguousarray(frame, dtype=numpy.uint8)
+  if frame.ndim == 2:
+    frame = frame[:,:,numpy.newaxis]
+  rows, columns, components = frame.shape
+  matrix = [1.0,0.0,0.0, 0.0,1.0,0.0, 0.0,0.0,1.0, 0.0,0.0,0.0]
+  header = struct.pack(IGTL_IMAGE_HEADER_FORMAT, 1, components, 3, 2, 1, columns, rows, 1,
+                       *(matrix + [0, 0, 0, columns, rows, 1]))
+  return header + frame.tobytes()
+
+#
+# Frame and pose sources
+#
+
+def syntheticFrames(width, height, count=60):
+  """ A looping sequence of moving rings, roughly resembling an airway lumen """
+  y, x = numpy.mgrid[0:height, 0:width]
+  radius = numpy.hypot(x - width/2.0, y - height/2.0)
+  angle = numpy.arctan2(y - height/2.0, x - width/2.0)
+  frames = numpy.empty((count, height, width, 3), dtype=numpy.uint8)
+  for n in range(count):
+    phase = 2*numpy.pi*n/count
+    rings = 0.5 + 0.5*numpy.cos(radius/12.0 - 4*phase)
+    spokes = 0.5 + 0.5*numpy.cos(3*angle + phase)
+    lumen = numpy.exp(-(radius/(0.3*min(width, height)))**2)
+    frames[n,:,:,0] = 255*(0.6*rings + 0.4*lumen)
+    frames[n,:,:,1] = 200*(0.5*rings*spokes + 0.3*lumen)
+    frames[n,:,:,2] = 170*(0.4*spokes)
+  return frames
+
+def loadRecordedFrames(fileName, width=None, height=None):
+  """ Frames stored as an (n, rows, columns, 3) .npy array; cropped to the requested size """
+  frames = numpy.load(fileName, mmap_mode='r')
+  if width and height:
+    frames = frames[:, :height, :width]
+  return frames
+
+def loadCenterlinePositions(fileName):
+  """ Reads the CenterlinePositions.txt written by the module """
+  return numpy.loadtxt(fileName, delimiter=',', ndmin=2)[:,:3]
+
+def trackerPoses(positions):
+  """ Poses walking back and forth along positions, x axis aligned with the motion """
+  positions = numpy.asarray(positions, dtype=numpy.float64)
+  if len(positions) < 2:
+    positions = numpy.array([[0.0,0.0,0.0],[0.0,0.0,-100.0]])
+  path = numpy.concatenate([positions, positions[-2:0:-1]])
+  tangents = numpy.roll(path, -1, axis=0) - path
+  poses = numpy.tile(numpy.eye(4), (len(path),1,1))
+  for i in range(len(path)):
+    t = tangents[i]
+    norm = numpy.linalg.norm(t)
+    t = t / norm if norm > 0 else numpy.array([1.0,0.0,0.0])
+    helper = numpy.array([0.0,0.0,1.0]) if abs(t[2]) < 0.9 else numpy.array([0.0,1.0,0.0])
+    s = numpy.cross(helper, t)
+    s /= numpy.linalg.norm(s)
+    n = numpy.cross(t, s)
+    poses[i,:3,0] = t
+    poses[i,:3,1] = s
+    poses[i,:3,2] = n
+    poses[i,:3,3] = path[i]
+  return poses
+
+#
+# Streaming
+#
+
+class _RateLimitedSender(threading.Thread):
+  """ Sends pre-packed messages at a fixed rate and counts what could not be sent in time """
+  def __init__(self, name, rate, messages):
+    threading.Thread.__init__(self, name=name)
+    self.daemon = True
+    self.rate = float(rate)
+    self.messages = messages
+    self.sent = 0
+    self.skipped = 0
+    self.bytesSent = 0
+    self.stopEvent = threading.Event()
+
+  def connect(self):
+    raise NotImplementedError
+
+  def stop(self):
+    self.stopEvent.set()
+
+  def run(self):
+    period = 1.0 / self.rate
+    while not self.stopEvent.is_set():
+      connection = self.connect()
+      if connection is None:
+        continue
+      index = 0
+      deadline = time.time()
+      try:
+        while not self.stopEvent.is_set():
+          now = time.time()
+          if now < deadline:
+            time.sleep(deadline - now)
+          elif now - deadline > period:
+            # we are late by more than one period: those samples are lost at the source
+            late = int((now - deadline) / period)
+            self.skipped += late
+            index += late
+            deadline += late * period
+          message = self.messages[index % len(self.messages)]
+          connection.sendall(message)
+          self.sent += 1
+          self.bytesSent += len(message)
+          index += 1
+          deadline += period
+      except socket.error:
+        pass
+      finally:
+        connection.close()
+
+  def stats(self):
+    return {'rate': self.rate, 'sent': self.sent, 'skipped': self.skipped, 'bytesSent': self.bytesSent}
+
+class VideoServer(_RateLimitedSender):
+  """ IMAGE server the module's 'streamingConnector' client connects to """
+  def __init__(self, frames, fps, port=VIDEO_PORT, deviceName='Image_Reference'):
+    messages = [packMessage('IMAGE', deviceName, packImageBody(frame)) for frame in frames]
+    _RateLimitedSender.__init__(self, 'IGTLVideoServer', fps, messages)
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.listener.bind(('localhost', port))
+    self.listener.listen(1)
+    self.listener.settimeout(0.5)
+
+  def connect(self):
+    try:
+      connection, address = self.listener.accept()
+    except socket.timeout:
+      return None
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return connection
+
+class TrackerClient(_RateLimitedSender):
+  """ TRANSFORM client pushing to the module's 'ProbeConnector' server """
+  def __init__(self, poses, rate, host='localhost', port=TRACKER_PORT, deviceName='ProbeToTracker'):
+    messages = [packTransform(deviceName, pose) for pose in poses]
+    _RateLimitedSender.__init__(self, 'IGTLTrackerClient', rate, messages)
+    self.address = (host, port)
+
+  def connect(self):
+    try:
+      connection = socket.create_connection(self.address, timeout=0.5)
+    except socket.error:
+      time.sleep(0.5)
+      return None
+    connection.settimeout(None)
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return connection
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='OpenIGTLink video and tracker simulator for the Bronchoscopy module.')
+  parser.add_argument('--video-fps', type=float, default=30.0)
+  parser.add_argument('--tracking-rate', type=float, default=40.0)
+  parser.add_argument('--width', type=int, default=640)
+  parser.add_argument('--height', type=int, default=480)
+  parser.add_argument('--video', help='recorded frames (.npy, n x rows x columns x 3 uint8)')
+  parser.add_argument('--centerline', help='CenterlinePositions.txt to walk the probe along')
+  parser.add_argument('--video-port', type=int, default=VIDEO_PORT)
+  parser.add_argument('--tracker-port', type=int, default=TRACKER_PORT)
+  parser.add_argument('--no-video', action='store_true')
+  parser.add_argument('--no-tracking', action='store_true')
+  parser.add_argument('--duration', type=float, default=0, help='seconds to run, 0 runs until interrupted')
+  parser.add_argument('--stats', help='write send statistics as JSON to this file on exit')
+  args = parser.parse_args(argv)
+
+  senders = []
+  if not args.no_video:
+    if args.video:
+      frames = loadRecordedFrames(args.video, args.width, args.height)
+    else:
+      frames = syntheticFrames(args.width, args.height)
+    senders.append(VideoServer(frames, args.video_fps, args.video_port))
+  if not args.no_tracking:
+    positions = loadCenterlinePositions(args.centerline) if args.centerline else []
+    senders.append(TrackerClient(trackerPoses(positions), args.tracking_rate, port=args.tracker_port))
+
+  for sender in senders:
+    sender.start()
+
+  startTime = time.time()
+  try:
+    while args.duration <= 0 or time.time() - startTime < args.duration:
+      time.sleep(0.2)
+  except KeyboardInterrupt:
+    pass
+  for sender in senders:
+    sender.stop()
+  for sender in senders:
+    sender.join(2)
+
+  elapsed = time.time() - startTime
+  stats = {'elapsed': elapsed}
+  for sender in senders:
+    stats[sender.name] = sender.stats()
+  output = json.dumps(stats, indent=2, sort_keys=True)
+  if args.stats:
+    with open(args.stats, 'w') as f:
+      f.write(output)
+  print(output)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,84 @@
+"""
+Reduction of the airway label map before centerline extraction.
+
+The airway usually fills a small part of the CT field of view. cropLabel
+cuts the label array down to the bounding box of its non-zero voxels plus a
+margin and can resample it to an isotropic spacing (nearest neighbour, as
+for any label). It returns the reduced array with the IJK to RAS matrix of
+the reduced grid, so whatever is extracted from it is already in the RAS
+coordinates of the original volume.
+
+Arrays are indexed (k, j, i), as slicer.util.array returns volumes, and
+matrices are 4x4 nested lists or arrays.
+"""
+
+import math
+
+import numpy
+
+def voxelSpacing(ijkToRAS):
+  """ Spacing along i, j and k: the lengths of the first three columns of the matrix """
+  matrix = numpy.asarray(ijkToRAS, dtype=numpy.float64).reshape(4, 4)
+  return numpy.sqrt((matrix[:3, :3]**2).sum(axis=0))
+
+def labelBoundingBox(labelArray, margin=(0, 0, 0)):
+  """ (low, high) (k, j, i) indices of the non-zero voxels, high exclusive, grown by margin voxels; None if empty """
+  labelArray = numpy.asarray(labelArray)
+  low = []
+  high = []
+  for axis in range(3):
+    others = tuple(a for a in range(3) if a != axis)
+    occupied = numpy.flatnonzero(labelArray.any(axis=others))
+    if len(occupied) == 0:
+      return None
+    low.append(max(occupied[0] - margin[axis], 0))
+    high.append(min(occupied[-1] + 1 + margin[axis], labelArray.shape[axis]))
+  return numpy.array(low), numpy.array(high)
+
+def _resampleIndices(size, scale):
+  """ Source index of each voxel of an axis of size voxels resampled by scale (new spacing / old spacing) """
+  count = max(int(math.ceil(size / scale)), 1)
+  return numpy.minimum(((numpy.arange(count) + 0.5) * scale).astype(numpy.int64), size - 1)
+
+def cropLabel(labelArray, ijkToRAS, margin=5.0, spacing=None):
+  """ The label cut to its bounding box grown by margin mm, optionally resampled to an isotropic spacing in mm.
+
+  Returns (array, ijkToRAS, report). report holds the original and reduced
+  number of voxels, their ratio, the reduced shape and spacing and, under
+  'low', the first (k, j, i) index of the box in the original array.
+  """
+  labelArray = numpy.asarray(labelArray)
+  matrix = numpy.asarray(ijkToRAS, dtype=numpy.float64).reshape(4, 4)
+  # (k, j, i) order, as the array axes
+  originalSpacing = voxelSpacing(matrix)[::-1]
+  marginVoxels = [int(math.ceil(margin / s)) if s > 0 else 0 for s in originalSpacing]
+  box = labelBoundingBox(labelArray, marginVoxels)
+  if box is None:
+    low, high = numpy.zeros(3, dtype=numpy.int64), numpy.array(labelArray.shape)
+  else:
+    low, high = box
+  cropped = labelArray[low[0]:high[0], low[1]:high[1], low[2]:high[2]]
+
+  scale = numpy.ones(3)
+  if spacing:
+    scale = float(spacing) / originalSpacing
+    if numpy.allclose(scale, 1.0):
+      scale = numpy.ones(3)
+    else:
+      indices = [_resampleIndices(cropped.shape[axis], scale[axis]) for axis in range(3)]
+      cropped = cropped[numpy.ix_(*indices)]
+  cropped = numpy.ascontiguousarray(cropped)
+
+  # voxel (k, j, i) of the reduced grid samples the original voxel low + scale * (k, j, i) + (scale - 1) / 2
+  toOriginal = numpy.identity(4)
+  toOriginal[:3, :3] = numpy.diag(scale[::-1])
+  toOriginal[:3, 3] = (low + (scale - 1) / 2.0)[::-1]
+  report = {
+    'originalVoxels': int(labelArray.size),
+    'voxels': int(cropped.size),
+    'ratio': float(cropped.size) / labelArray.size if labelArray.size else 1.0,
+    'shape': list(cropped.shape),
+    'spacing': [float(value) for value in originalSpacing * scale],
+    'low': [int(index) for index in low],
+  }
+  return cropped, numpy.dot(matrix, toOriginal), report
@@ -0,0 +1,75 @@
+"""
+Rigid tracker to CT registration from paired landmarks.
+
+The CT points are the RegistrationMarker fiducials; the tracker points are
+the sensor positions read from the ProbeConnector while the probe touches
+the same landmarks, in the same order. rigidTransform is the closed-form
+least-squares solution (Horn's, computed with an SVD of the cross-covariance
+of the centred point sets, with the reflection case excluded), so a
+registration takes microseconds and needs no external tool.
+
+registerLandmarks rejects outliers (a landmark touched in the wrong place, a
+sensor reading taken while the probe moved) one at a time: the landmark with
+the largest residual is dropped while that residual is above both
+outlierFactor times the median residual and tolerance mm, and at least
+minimumPoints landmarks remain. The fiducial registration error (FRE) is the
+root mean square residual of the landmarks kept.
+"""
+
+import numpy
+
+def rigidTransform(fixed, moving, weights=None):
+  """ 4x4 rotation and translation taking the moving points onto the fixed ones, least squares """
+  fixed = numpy.asarray(fixed, dtype=numpy.float64).reshape(-1, 3)
+  moving = numpy.asarray(moving, dtype=numpy.float64).reshape(-1, 3)
+  if len(fixed) != len(moving):
+    raise ValueError('Landmark registration needs as many fixed as moving points, got %d and %d' % (len(fixed), len(moving)))
+  if len(fixed) < 3:
+    raise ValueError('Landmark registration needs at least 3 point pairs, got %d' % len(fixed))
+  weights = numpy.ones(len(fixed)) if weights is None else numpy.asarray(weights, dtype=numpy.float64)
+  weights = weights / weights.sum()
+  fixedCentre = numpy.dot(weights, fixed)
+  movingCentre = numpy.dot(weights, moving)
+  covariance = numpy.dot((moving - movingCentre).T * weights, fixed - fixedCentre)
+  u, s, vt = numpy.linalg.svd(covariance)
+  # a proper rotation, even for (nearly) coplanar points where the best orthogonal matrix is a reflection
+  correction = numpy.diag([1.0, 1.0, numpy.sign(numpy.linalg.det(numpy.dot(vt.T, u.T))) or 1.0])
+  rotation = numpy.dot(vt.T, numpy.dot(correction, u.T))
+  matrix = numpy.identity(4)
+  matrix[:3, :3] = rotation
+  matrix[:3, 3] = fixedCentre - numpy.dot(rotation, movingCentre)
+  return matrix
+
+def residuals(matrix, fixed, moving):
+  """ Distance from each fixed point to its moving point once transformed """
+  fixed = numpy.asarray(fixed, dtype=numpy.float64).reshape(-1, 3)
+  moving = numpy.asarray(moving, dtype=numpy.float64).reshape(-1, 3)
+  transformed = numpy.dot(moving, matrix[:3, :3].T) + matrix[:3, 3]
+  return numpy.sqrt(((transformed - fixed)**2).sum(axis=1))
+
+def registerLandmarks(fixed, moving, outlierFactor=3.0, tolerance=1.0, minimumPoints=3):
+  """ Rigid registration of moving (tracker) onto fixed (CT) landmarks with outlier rejection.
+
+  Returns (matrix, inliers, report): inliers is a boolean mask of the
+  landmarks used, and report holds the FRE of the inliers, the residual of
+  every landmark and the indices of the rejected ones.
+  """
+  fixed = numpy.asarray(fixed, dtype=numpy.float64).reshape(-1, 3)
+  moving = numpy.asarray(moving, dtype=numpy.float64).reshape(-1, 3)
+  inliers = numpy.ones(len(fixed), dtype=bool)
+  matrix = rigidTransform(fixed, moving)
+  while inliers.sum() > minimumPoints:
+    errors = residuals(matrix, fixed[inliers], moving[inliers])
+    worst = errors.argmax()
+    if errors[worst] <= max(outlierFactor * numpy.median(errors), tolerance):
+      break
+    inliers[numpy.flatnonzero(inliers)[worst]] = False
+    matrix = rigidTransform(fixed[inliers], moving[inliers])
+
+  errors = residuals(matrix, fixed, moving)
+  report = {
+    'fre': float(numpy.sqrt((errors[inliers]**2).mean())),
+    'errors': [float(error) for error in errors],
+    'outliers': [int(index) for index in numpy.flatnonzero(~inliers)],
+  }
+  return matrix, inliers, report
@@ -0,0 +1,153 @@
+"""
+Load-test harness for the Bronchoscopy module.
+
+Runs the local OpenIGTLink simulator (IGTLSimulator.py) in a separate process,
+counts the updates that actually reach the 'Image_Reference' and
+'ProbeToTracker' nodes and the time the module spends in each tracking tick,
+and compares them with what the simulator sent. Meant to be used from the
+Slicer Python console:
+
+  from BronchoscopyLib.LoadTest import runLoadTest
+  runLoadTest(slicer.modules.BronchoscopyWidget, videoFps=60, trackingRate=240, duration=30)
+"""
+
+import json
+import os
+import subprocess
+import tempfile
+import time
+
+import numpy
+
+from __main__ import slicer
+
+from . import Parallel
+
+class StreamLoadMonitor(object):
+  """ Records arrival times of node updates and per-tick processing times """
+  def __init__(self):
+    self.arrivals = {}
+    self.processing = {}
+    self.observers = []
+
+  def observeNode(self, streamName, node, event):
+    self.arrivals.setdefault(streamName, [])
+    tag = node.AddObserver(event, lambda caller, eventId, name=streamName: self.recordArrival(name))
+    self.observers.append((node, tag))
+
+  def removeObservers(self):
+    for node, tag in self.observers:
+      node.RemoveObserver(tag)
+    self.observers = []
+
+  def recordArrival(self, streamName):
+    self.arrivals.setdefault(streamName, []).append(time.time())
+
+  def recordProcessing(self, streamName, seconds):
+    self.processing.setdefault(streamName, []).append(seconds)
+
+  def report(self, sentCounts=None):
+    """ Summary per stream; drops are computed against sentCounts when they are known """
+    sentCounts = sentCounts or {}
+    report = {}
+    for name, times in self.arrivals.items():
+      times = numpy.asarray(times)
+      entry = {'received': len(times)}
+      if len(times) > 1:
+        intervals = numpy.diff(times)
+        entry['rate'] = (len(times) - 1) / (times[-1] - times[0])
+        entry['intervalMean'] = float(intervals.mean())
+        entry['intervalP95'] = float(numpy.percentile(intervals, 95))
+        entry['intervalMax'] = float(intervals.max())
+      if name in sentCounts:
+        sent = sentCounts[name]
+        entry['sent'] = sent
+        entry['dropped'] = max(sent - len(times), 0)
+        entry['dropRatio'] = entry['dropped'] / float(sent) if sent else 0.0
+      report[name] = entry
+    for name, durations in self.processing.items():
+      durations = numpy.asarray(durations)
+      entry = report.setdefault(name, {})
+      entry['ticks'] = len(durations)
+      if len(durations):
+        entry['processingMean'] = float(durations.mean())
+        entry['processingP95'] = float(numpy.percentile(durations, 95))
+        entry['processingMax'] = float(durations.max())
+    return report
+
+def _waitForNode(name, timeout):
+  endTime = time.time() + timeout
+  while time.time() < endTime:
+    node = slicer.util.getNode(name)
+    if node:
+      return node
+    slicer.app.processEvents()
+    time.sleep(0.001)
+  return None
+
+def _processEventsFor(seconds):
+  endTime = time.time() + seconds
+  while time.time() < endTime:
+    slicer.app.processEvents()
+    time.sleep(0.0005)
+
+def runLoadTest(widget, videoFps=30, trackingRate=40, duration=20, width=640, height=480,
+                centerlineFile=None, videoFile=None, track=True, pythonExecutable=None):
+  """ Stream from the simulator into the module and report throughput and frame drops """
+  statsFile = os.path.join(tempfile.gettempdir(), 'BronchoscopyLoadTest.json')
+  if os.path.exists(statsFile):
+    os.remove(statsFile)
+  simulator = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'IGTLSimulator.py')
+  # PythonSlicer when available, so that the simulator finds numpy
+  command = [pythonExecutable or Parallel.pythonExecutable(), simulator,
+             '--video-fps', str(videoFps), '--tracking-rate', str(trackingRate),
+             '--width', str(width), '--height', str(height),
+             '--duration', str(duration), '--stats', statsFile]
+  if centerlineFile:
+    command += ['--centerline', centerlineFile]
+  if videoFile:
+    command += ['--video', videoFile]
+  process = subprocess.Popen(command)
+
+  monitor = StreamLoadMonitor()
+  widget.loadMonitor = monitor
+  widget.viewState.monitor = monitor
+  try:
+    widget.VideoRegistrationButton.checked = True
+    if track and widget.ProbeTrackButton.enabled:
+      widget.ProbeTrackButton.checked = True
+
+    videoNode = _waitForNode('Image_Reference', 10)
+    if videoNode:
+      monitor.observeNode('video', videoNode, slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent)
+    trackerNode = _waitForNode('ProbeToTracker', 10) if widget.ProbeTrackButton.checked else None
+    if trackerNode:
+      monitor.observeNode('tracking', trackerNode, slicer.vtkMRMLTransformNode.TransformModifiedEvent)
+
+    while process.poll() is None:
+      _processEventsFor(0.1)
+    # let the last messages reach the scene
+    _processEventsFor(0.5)
+  finally:
+    monitor.removeObservers()
+    widget.loadMonitor = None
+    widget.viewState.monitor = None
+    widget.ProbeTrackButton.checked = False
+    widget.VideoRegistrationButton.checked = False
+    if process.poll() is None:
+      process.terminate()
+
+  sentCounts = {}
+  if os.path.exists(statsFile):
+    with open(statsFile) as f:
+      stats = json.load(f)
+    if 'IGTLVideoServer' in stats:
+      sentCounts['video'] = stats['IGTLVideoServer']['sent']
+    if 'IGTLTrackerClient' in stats:
+      sentCounts['tracking'] = stats['IGTLTrackerClient']['sent']
+
+  report = monitor.report(sentCounts)
+  report['configuration'] = {'videoFps': videoFps, 'trackingRate': trackingRate,
+                             'duration': duration, 'width': width, 'height': height}
+  print(json.dumps(report, indent=2, sort_keys=True))
+  return report
@@ -0,0 +1,64 @@
+"""
+Bookkeeping for VTK/MRML observers and coalescing of bursts of events.
+
+ObserverManager registers each (object, event, callback) once, however many
+times it is asked to, and removes observers per object or all at once.
+CoalescedCall turns any number of requests made before control returns to
+the event loop into a single call of its callback.
+"""
+
+class ObserverManager(object):
+  def __init__(self):
+    self.observers = {}
+
+  def _key(self, caller, event, callback):
+    # the manager keeps a reference to caller, so its id stays valid while observed
+    return (id(caller), event, callback)
+
+  def addObserver(self, caller, event, callback, priority=0.0):
+    """ Observes event on caller with callback, unless it is already observed; returns the tag """
+    key = self._key(caller, event, callback)
+    if key not in self.observers:
+      tag = caller.AddObserver(event, callback, priority)
+      self.observers[key] = (caller, tag)
+    return self.observers[key][1]
+
+  def hasObserver(self, caller, event, callback):
+    return self._key(caller, event, callback) in self.observers
+
+  def removeObserver(self, caller, event, callback):
+    entry = self.observers.pop(self._key(caller, event, callback), None)
+    if entry:
+      entry[0].RemoveObserver(entry[1])
+
+  def removeObservers(self, caller=None):
+    """ Removes the observers on caller, or all of them """
+    for key, (observed, tag) in list(self.observers.items()):
+      if caller is None or observed is caller:
+        observed.RemoveObserver(tag)
+        del self.observers[key]
+
+class CoalescedCall(object):
+  """ Calls callback once on the next event-loop iteration, however often it is requested before that """
+  def __init__(self, callback, schedule=None):
+    self.callback = callback
+    self.schedule = schedule
+    self.pending = False
+    self.requests = 0
+    self.calls = 0
+
+  def request(self, *args):
+    """ Can be used directly as an observer callback; the arguments are ignored """
+    self.requests += 1
+    if self.pending:
+      return
+    self.pending = True
+    if self.schedule is None:
+      from __main__ import qt
+      self.schedule = qt.QTimer.singleShot
+    self.schedule(0, self._call)
+
+  def _call(self):
+    self.pending = False
+    self.calls += 1
+    self.callback()
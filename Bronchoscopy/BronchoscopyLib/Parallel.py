@@ -0,0 +1,32 @@
+"""
+Process pools that also work from inside Slicer.
+
+Within Slicer sys.executable is the application itself, so child processes
+are started with the PythonSlicer launcher that sits next to it when
+available. Work functions must live in importable modules (i.e. in
+BronchoscopyLib), not in Bronchoscopy.py, which needs the Slicer main module.
+"""
+
+import multiprocessing
+import os
+import sys
+
+def pythonExecutable():
+  directory = os.path.dirname(sys.executable)
+  for name in ('PythonSlicer', 'PythonSlicer.exe'):
+    candidate = os.path.join(directory, name)
+    if os.path.exists(candidate):
+      return candidate
+  return sys.executable
+
+def defaultProcessCount():
+  try:
+    return max(multiprocessing.cpu_count() - 1, 1)
+  except NotImplementedError:
+    return 1
+
+def createProcessPool(processes=None, initializer=None, initargs=()):
+  executable = pythonExecutable()
+  if executable != sys.executable:
+    multiprocessing.set_executable(executable)
+  return multiprocessing.Pool(processes or defaultProcessCount(), initializer, initargs)
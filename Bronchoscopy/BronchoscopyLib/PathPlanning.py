@@ -0,0 +1,104 @@
+"""
+Planning of the paths to the ROIs, recomputing only what changed.
+
+The path to a ROI goes through stages: the airway centerline from the start
+of the centerline to the ROI (VMTK, the slowest), the Hermite curve through
+the ROI's added waypoints, the two merged and the merge smoothed, which the
+path model shows. PlanningCache keeps the output of each stage of each ROI
+with the key of its inputs: a hash of the arrays it is computed from and of
+the keys of the stages it depends on. A stage runs again only when its key
+changes, so moving a waypoint of one ROI runs the Hermite, merge and
+smoothing stages of that ROI only, and every other path stays as it was.
+
+The Hermite curve is itself kept by segment (SegmentedHermitePath): a segment
+depends only on its two control points and their tangents, so moving one
+waypoint recomputes the few segments around it.
+"""
+
+import hashlib
+
+import numpy
+
+from . import CenterlineEngine
+
+def inputKey(*inputs):
+  """ Hash of the inputs of a stage: arrays and numbers by value, strings (keys of other stages, node IDs) and None """
+  digest = hashlib.sha1()
+  for value in inputs:
+    if value is None:
+      digest.update(b'n')
+    elif isinstance(value, str):
+      digest.update(b's' + value.encode('utf-8'))
+    else:
+      array = numpy.ascontiguousarray(value, dtype=numpy.float64)
+      digest.update(('a%r' % (array.shape,)).encode('ascii'))
+      digest.update(array.tobytes())
+  return digest.hexdigest()
+
+class SegmentedHermitePath(object):
+  """ CenterlineEngine.hermitePath through changing control points, reusing the segments that did not change """
+  def __init__(self, dl=0.5):
+    self.dl = dl
+    self.segments = {}
+    # segments computed by the last update
+    self.computed = 0
+
+  def update(self, controlPoints):
+    p = numpy.asarray(controlPoints, dtype=numpy.float64).reshape(-1, 3)
+    self.computed = 0
+    if len(p) < 2:
+      self.segments = {}
+      return p.copy()
+    m = CenterlineEngine.hermiteTangents(p)
+    segments = {}
+    pieces = []
+    for k in range(len(p) - 1):
+      key = numpy.concatenate((p[k], p[k+1], m[k], m[k+1])).tobytes()
+      piece = self.segments.get(key)
+      if piece is None:
+        piece = CenterlineEngine.hermiteSegment(p[k], p[k+1], m[k], m[k+1], self.dl)
+        self.computed += 1
+      segments[key] = piece
+      pieces.append(piece)
+    # segments no longer in the path are dropped
+    self.segments = segments
+    return numpy.concatenate(pieces + [p[-1:]])
+
+class PlanningCache(object):
+  """ Output of each planning stage of each ROI, kept with the key of the inputs it was computed from """
+  def __init__(self, dl=0.5):
+    self.dl = dl
+    self.entries = {}
+    self.hermitePaths = {}
+    # (roi, stage) of every stage run, for reports and tests
+    self.computed = []
+
+  def stage(self, roi, name, inputs, compute):
+    """ (key, output) of stage name of roi: the output kept if inputs have the same key, compute() otherwise """
+    key = inputKey(*inputs)
+    entry = self.entries.get((roi, name))
+    if entry is None or entry[0] != key:
+      entry = (key, compute())
+      self.entries[(roi, name)] = entry
+      self.computed.append((roi, name))
+    return entry
+
+  def hermitePath(self, roi, controlPoints):
+    """ (key, points) of the Hermite stage of roi, recomputing only the segments whose control points moved """
+    if roi not in self.hermitePaths:
+      self.hermitePaths[roi] = SegmentedHermitePath(self.dl)
+    return self.stage(roi, 'hermite', [controlPoints, self.dl], lambda: self.hermitePaths[roi].update(controlPoints))
+
+  def retain(self, rois):
+    """ Forgets the stages of the ROIs not in rois """
+    rois = set(rois)
+    for roi, name in list(self.entries):
+      if roi not in rois:
+        del self.entries[(roi, name)]
+    for roi in list(self.hermitePaths):
+      if roi not in rois:
+        del self.hermitePaths[roi]
+
+  def clear(self):
+    self.entries = {}
+    self.hermitePaths = {}
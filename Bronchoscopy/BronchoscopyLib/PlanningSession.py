@@ -0,0 +1,167 @@
+"""
+Path-planning session file.
+
+Everything needed to start navigating a planned case without re-running the
+centerline extraction and the path planning: the centerline points, the ROIs
+(ROIFiducials) with their labels, the label points (LabelPoints), the
+waypoints of every ROI (AddedPathPointsList-N) and the planned path
+polylines with their cumulative lengths.
+
+The file is an uncompressed zip of .npy arrays plus metadata.json (i.e. a
+.npz that numpy.load can also read). Because members are stored, not
+deflated, load() memory-maps each array straight out of the archive.
+"""
+
+import io
+import json
+import struct
+import time
+import zipfile
+
+import numpy
+from numpy.lib import format as npyformat
+
+FORMAT_VERSION = 1
+
+# zip local file header: fixed part, then file name and extra field
+LOCAL_HEADER_SIZE = 30
+LOCAL_HEADER_NAME_LENGTH_OFFSET = 26
+
+def cumulativeLengths(points):
+  """ Arc length from the first point to each point """
+  points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+  lengths = numpy.zeros(len(points))
+  if len(points) > 1:
+    numpy.cumsum(numpy.sqrt((numpy.diff(points, axis=0)**2).sum(axis=1)), out=lengths[1:])
+  return lengths
+
+def _concatenate(arrays, columns, dtype):
+  """ Arrays stacked into one, and the offsets of each of them """
+  offsets = numpy.zeros(len(arrays) + 1, dtype=numpy.int64)
+  offsets[1:] = numpy.cumsum([len(array) for array in arrays])
+  if arrays:
+    stacked = numpy.concatenate([numpy.asarray(array, dtype=dtype).reshape((-1,) + columns) for array in arrays])
+  else:
+    stacked = numpy.zeros((0,) + columns, dtype=dtype)
+  return stacked, offsets
+
+def _split(stacked, offsets):
+  return [stacked[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)]
+
+def _memoryMapMember(fileName, info):
+  """ Array stored uncompressed in the archive, memory-mapped in place """
+  with open(fileName, 'rb') as f:
+    f.seek(info.header_offset + LOCAL_HEADER_NAME_LENGTH_OFFSET)
+    nameLength, extraLength = struct.unpack('<HH', f.read(4))
+    f.seek(info.header_offset + LOCAL_HEADER_SIZE + nameLength + extraLength)
+    version = npyformat.read_magic(f)
+    if version == (1, 0):
+      shape, fortranOrder, dtype = npyformat.read_array_header_1_0(f)
+    else:
+      shape, fortranOrder, dtype = npyformat.read_array_header_2_0(f)
+    offset = f.tell()
+  if int(numpy.prod(shape)) == 0:
+    return numpy.zeros(shape, dtype=dtype)
+  return numpy.memmap(fileName, dtype=dtype, mode='r', offset=offset, shape=shape,
+                      order='F' if fortranOrder else 'C')
+
+class PlanningSession(object):
+  def __init__(self):
+    self.centerline = numpy.zeros((0, 3))
+    self.rois = numpy.zeros((0, 3))
+    self.roiLabels = []
+    self.labelPoints = numpy.zeros((0, 3))
+    # one (k, 3) array per ROI
+    self.waypoints = []
+    # planned paths: model name, points, legacy VTK line connectivity and cumulative lengths
+    self.pathNames = []
+    self.paths = []
+    self.pathLines = []
+    self.pathLengths = []
+    self.metadata = {}
+
+  def addPath(self, name, points, lines=None):
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+    if lines is None:
+      lines = numpy.concatenate(([len(points)], numpy.arange(len(points))))
+    self.pathNames.append(name)
+    self.paths.append(points)
+    self.pathLines.append(numpy.asarray(lines, dtype=numpy.int64))
+    self.pathLengths.append(cumulativeLengths(points))
+
+  def toArrays(self):
+    """ (arrays, metadata): the session as the arrays and the JSON metadata saved in the file """
+    waypoints, waypointOffsets = _concatenate(self.waypoints, (3,), numpy.float64)
+    pathPoints, pathOffsets = _concatenate(self.paths, (3,), numpy.float64)
+    pathLines, pathLineOffsets = _concatenate(self.pathLines, (), numpy.int64)
+    pathLengths, _ = _concatenate(self.pathLengths, (), numpy.float64)
+    arrays = {
+      'centerline': numpy.asarray(self.centerline, dtype=numpy.float64).reshape(-1, 3),
+      'rois': numpy.asarray(self.rois, dtype=numpy.float64).reshape(-1, 3),
+      'labelPoints': numpy.asarray(self.labelPoints, dtype=numpy.float64).reshape(-1, 3),
+      'waypoints': waypoints,
+      'waypointOffsets': waypointOffsets,
+      'pathPoints': pathPoints,
+      'pathOffsets': pathOffsets,
+      'pathLines': pathLines,
+      'pathLineOffsets': pathLineOffsets,
+      'pathLengths': pathLengths,
+    }
+    metadata = dict(self.metadata)
+    metadata.update({
+      'version': FORMAT_VERSION,
+      'roiLabels': list(self.roiLabels),
+      'pathNames': list(self.pathNames),
+      'pathTotalLengths': [float(lengths[-1]) if len(lengths) else 0.0 for lengths in self.pathLengths],
+    })
+    return arrays, metadata
+
+  @classmethod
+  def fromArrays(cls, arrays, metadata):
+    session = cls()
+    session.metadata = metadata
+    session.centerline = arrays['centerline']
+    session.rois = arrays['rois']
+    session.roiLabels = metadata.get('roiLabels', [])
+    session.labelPoints = arrays['labelPoints']
+    session.waypoints = _split(arrays['waypoints'], arrays['waypointOffsets'])
+    session.pathNames = metadata.get('pathNames', [])
+    session.paths = _split(arrays['pathPoints'], arrays['pathOffsets'])
+    session.pathLines = _split(arrays['pathLines'], arrays['pathLineOffsets'])
+    session.pathLengths = _split(arrays['pathLengths'], arrays['pathOffsets'])
+    return session
+
+  def save(self, fileName):
+    arrays, metadata = self.toArrays()
+    metadata['saved'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    archive = zipfile.ZipFile(fileName, 'w', zipfile.ZIP_STORED, allowZip64=True)
+    try:
+      for name in sorted(arrays):
+        buffer = io.BytesIO()
+        npyformat.write_array(buffer, numpy.ascontiguousarray(arrays[name]))
+        archive.writestr(name + '.npy', buffer.getvalue())
+      archive.writestr('metadata.json', json.dumps(metadata, indent=2, sort_keys=True))
+    finally:
+      archive.close()
+
+  @classmethod
+  def load(cls, fileName, memoryMap=True):
+    """ Session read from fileName; arrays are memory-mapped unless memoryMap is False """
+    archive = zipfile.ZipFile(fileName, 'r')
+    try:
+      metadata = json.loads(archive.read('metadata.json').decode('utf-8'))
+      if metadata.get('version', 0) > FORMAT_VERSION:
+        raise ValueError('Planning session %s has unsupported version %s' % (fileName, metadata.get('version')))
+      arrays = {}
+      for info in archive.infolist():
+        if not info.filename.endswith('.npy'):
+          continue
+        name = info.filename[:-4]
+        if memoryMap and info.compress_type == zipfile.ZIP_STORED:
+          arrays[name] = _memoryMapMember(fileName, info)
+        else:
+          arrays[name] = npyformat.read_array(io.BytesIO(archive.read(info)))
+    finally:
+      archive.close()
+    return cls.fromArrays(arrays, metadata)
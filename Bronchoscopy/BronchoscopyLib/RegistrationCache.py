@@ -0,0 +1,77 @@
+"""
+Cache of recent image-registration solutions.
+
+Entries are keyed by the bifurcation the probe is passing and by the camera
+pose, quantized so that small tracking noise maps to the same key. Each entry
+keeps the absolute camera roll found by the registration together with a
+compact signature of the video frame it was computed on; when the probe comes
+back to the same bifurcation with the same pose and the video still looks the
+same, the cached roll can be reused instead of running the registration again.
+"""
+
+import collections
+
+import numpy
+
+def imageSignature(image, size=16):
+  """ Zero-mean, unit-norm vector of size x size block means of a 2D image """
+  image = numpy.asarray(image, dtype=numpy.float32)
+  rows = image.shape[0] // size * size
+  columns = image.shape[1] // size * size
+  if rows == 0 or columns == 0:
+    blocks = image.ravel()
+  else:
+    blocks = image[:rows,:columns].reshape(size, rows//size, size, columns//size).mean(axis=(1,3)).ravel()
+  blocks = blocks - blocks.mean()
+  norm = numpy.linalg.norm(blocks)
+  return blocks / norm if norm > 0 else blocks
+
+def signatureSimilarity(first, second):
+  """ Normalized cross-correlation of two signatures, 1 for identical frames """
+  if first is None or second is None or first.shape != second.shape:
+    return -1.0
+  return float(numpy.dot(first, second))
+
+class RegistrationCache(object):
+  """ LRU cache of camera roll angles keyed by bifurcation and quantized pose """
+  def __init__(self, capacity=64, positionStep=2.0, directionBins=4, similarityThreshold=0.98):
+    self.capacity = capacity
+    self.positionStep = float(positionStep)
+    self.directionBins = directionBins
+    self.similarityThreshold = similarityThreshold
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def key(self, bifurcationIndex, position, direction):
+    position = numpy.asarray(position, dtype=numpy.float64)
+    direction = numpy.asarray(direction, dtype=numpy.float64)
+    norm = numpy.linalg.norm(direction)
+    if norm > 0:
+      direction = direction / norm
+    positionKey = numpy.floor(position / self.positionStep).astype(int)
+    directionKey = numpy.round(direction * self.directionBins).astype(int)
+    return (int(bifurcationIndex),) + tuple(positionKey.tolist()) + tuple(directionKey.tolist())
+
+  def lookup(self, key, signature):
+    """ Cached roll for key if the frame signature is unchanged, else None """
+    entry = self.entries.get(key)
+    if entry is not None and signatureSimilarity(entry[1], signature) >= self.similarityThreshold:
+      del self.entries[key]
+      self.entries[key] = entry
+      self.hits += 1
+      return entry[0]
+    self.misses += 1
+    return None
+
+  def store(self, key, roll, signature):
+    if key in self.entries:
+      del self.entries[key]
+    self.entries[key] = (float(roll), signature)
+    while len(self.entries) > self.capacity:
+      self.entries.popitem(last=False)
+
+  def clear(self):
+    self.entries.clear()
+    self.hits = 0
+    self.misses = 0
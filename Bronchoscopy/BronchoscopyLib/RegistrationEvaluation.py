@@ -0,0 +1,488 @@
+"""
+Offline evaluation of the image registration over a recorded procedure.
+
+A recorded session is a directory holding:
+
+  frames.npy            (n, rows, columns, 3) uint8 video frames
+  tracker.npy           (n, 4, 4) ProbeToTracker matrices, one per frame
+  CenterlinePositions.txt or centerline.npy   centerline points
+  bifurcations.txt      bifurcation points, one 'x,y,z' per line
+  airway.vtk/.vtp/.stl  airway model used to render the virtual views
+  roll.txt or roll.npy  ground-truth camera roll per frame in degrees (nan if unknown)
+
+Optionally virtual.npy, (n, rows, columns, 3) pre-rendered virtual frames, in
+which case nothing is rendered.
+
+Every bifurcation encounter (frames where the snapped probe is 20-30 mm^2
+from a bifurcation, as in the live tracking loop) is rendered once, then
+registered for every combination of angles number, endoscope crop and
+resolution. The registration is the one run in the clinic: the
+imageregistrationcli module, through BronchoscopyLogic.registerImages, in
+Slicer applications started with --no-main-window, the encounters being
+split between them. Example, from the module directory:
+
+  python -m BronchoscopyLib.RegistrationEvaluation session/ --slicer /opt/Slicer/Slicer --angles 18 36 72
+
+ProxyRollSearch is a NumPy imitation of the CLI's exhaustive roll search,
+which needs no Slicer (--method proxy). What is tuned with it is the proxy,
+not the CLI: --method both runs the two on the same frames and reports how
+often the proxy roll is within tolerance of the CLI one; the evaluation
+fails if that happens for less than --min-agreement of the encounters.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+
+from .CenterlineFrames import CenterlineFrames
+from .Parallel import createProcessPool, defaultProcessCount
+from .VideoPreprocessing import FramePreprocessor, ENDOSCOPE_CROP_REGIONS, DEFAULT_ENDOSCOPE_MODEL
+
+# camera placed by BronchoscopyWidget.CheckCurrentPosition
+CAMERA_VIEW_ANGLE = 50
+CAMERA_FOCAL_DISTANCE = 4.0
+# |tangent . sensor z| above which the view direction follows the sensor
+VIEW_DIRECTION_ALIGNMENT = 0.25
+
+BIFURCATION_DISTANCE_RANGE = (20, 30)
+
+METHODS = ('cli', 'proxy')
+
+# run by each Slicer worker: package directory, task file, result file
+WORKER_CODE = ("import sys; sys.path.insert(0, %r); "
+               "from BronchoscopyLib.RegistrationEvaluation import runSlicerWorker; "
+               "sys.exit(runSlicerWorker(%r, %r))")
+
+#
+# Session loading
+#
+
+class RecordedSession(object):
+  def __init__(self, directory):
+    self.directory = directory
+    self.frames = numpy.load(self._path('frames.npy'), mmap_mode='r')
+    self.tracker = numpy.load(self._path('tracker.npy'), mmap_mode='r')
+    self.centerline = self._loadPoints(('centerline.npy', 'CenterlinePositions.txt'))
+    self.bifurcations = self._loadPoints(('bifurcations.npy', 'bifurcations.txt'))
+    self.roll = self._loadOptional(('roll.npy', 'roll.txt'))
+    virtualPath = self._path('virtual.npy')
+    self.virtual = numpy.load(virtualPath, mmap_mode='r') if os.path.exists(virtualPath) else None
+    self.airwayModel = None
+    for name in ('airway.vtp', 'airway.vtk', 'airway.stl'):
+      if os.path.exists(self._path(name)):
+        self.airwayModel = self._path(name)
+        break
+
+  def _path(self, name):
+    return os.path.join(self.directory, name)
+
+  def _loadPoints(self, names):
+    points = self._loadOptional(names)
+    if points is None:
+      raise IOError('None of %s found in %s' % (', '.join(names), self.directory))
+    return numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+
+  def _loadOptional(self, names):
+    for name in names:
+      path = self._path(name)
+      if os.path.exists(path):
+        if name.endswith('.npy'):
+          return numpy.load(path)
+        return numpy.loadtxt(path, delimiter=',' if name != 'roll.txt' else None, ndmin=1)
+    return None
+
+def nearestPoints(points, queries, chunk=1024):
+  """ Index of the nearest of points for every query """
+  points = numpy.asarray(points, dtype=numpy.float64)
+  queries = numpy.asarray(queries, dtype=numpy.float64)
+  result = numpy.empty(len(queries), dtype=numpy.intp)
+  pointsSquared = (points**2).sum(axis=1)
+  for start in range(0, len(queries), chunk):
+    block = queries[start:start+chunk]
+    distances = pointsSquared[numpy.newaxis,:] - 2*numpy.dot(block, points.T)
+    result[start:start+chunk] = distances.argmin(axis=1)
+  return result
+
+def cameraPoses(tracker, centerline, indices):
+  """ Camera position, focal point and view up per frame, as CheckCurrentPosition places the navigation camera
+
+  The camera is at the snapped centerline point indices, looking along the
+  centerline frame tangent, turned the way the sensor z axis points, with the
+  frame normal as view up (before any roll found by registration).
+  """
+  frames = CenterlineFrames()
+  frames.update(centerline)
+  positions = frames.points[indices]
+  tangents = frames.tangents[indices]
+  viewUps = frames.normals[indices].copy()
+  alignments = (tangents * numpy.asarray(tracker, dtype=numpy.float64)[:,:3,2]).sum(axis=1)
+  # the last direction is kept while the sensor is across the centerline
+  sign = 1.0
+  for index, alignment in enumerate(alignments):
+    if abs(alignment) > VIEW_DIRECTION_ALIGNMENT:
+      sign = 1.0 if alignment > 0 else -1.0
+    tangents[index] *= sign
+  focalPoints = positions + CAMERA_FOCAL_DISTANCE * tangents
+  return positions, focalPoints, viewUps
+
+def bifurcationEncounters(snapped, bifurcations):
+  """ (frame, bifurcation) pairs, first frame of each run within the registration distance """
+  encounters = []
+  previous = None
+  for frameIndex, point in enumerate(snapped):
+    distances = ((bifurcations - point)**2).sum(axis=1)
+    bifurcationIndex = int(distances.argmin())
+    inRange = BIFURCATION_DISTANCE_RANGE[0] <= distances[bifurcationIndex] <= BIFURCATION_DISTANCE_RANGE[1]
+    current = bifurcationIndex if inRange else None
+    if current is not None and current != previous:
+      encounters.append((frameIndex, bifurcationIndex))
+    previous = current
+  return encounters
+
+#
+# Registration
+#
+
+def resizeNearest(image, size):
+  rows = (numpy.arange(size) * image.shape[0] // size)
+  columns = (numpy.arange(size) * image.shape[1] // size)
+  return image[rows[:,numpy.newaxis], columns[numpy.newaxis,:]]
+
+class CLIRegistration(object):
+  """ Roll found by the registration CLI, through BronchoscopyLogic.registerImages; runs inside Slicer only.
+
+  The images are passed as the module passes them: single-slice uint8 scalar
+  volumes with unit spacing, in VTK row order.
+  """
+  def __init__(self):
+    from __main__ import slicer, vtk
+    from Bronchoscopy import BronchoscopyLogic
+    self.slicer = slicer
+    self.vtk = vtk
+    self.logic = BronchoscopyLogic()
+    self.fixedVolume = self._volume('fixedScalarImage')
+    self.movingVolume = self._volume('movingScalarImage')
+
+  def _volume(self, name):
+    volumeNode = self.slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetName(name)
+    self.slicer.mrmlScene.AddNode(volumeNode)
+    return volumeNode
+
+  def _setImage(self, volumeNode, image):
+    from vtk.util.numpy_support import numpy_to_vtk
+    image = numpy.ascontiguousarray(image, dtype=numpy.uint8)
+    imageData = self.vtk.vtkImageData()
+    imageData.SetDimensions(image.shape[1], image.shape[0], 1)
+    scalars = numpy_to_vtk(image.ravel(), deep=True)
+    imageData.GetPointData().SetScalars(scalars)
+    volumeNode.SetAndObserveImageData(imageData)
+
+  def __call__(self, fixed, moving, anglesNumber, resolution):
+    if resolution:
+      fixed = resizeNearest(fixed, resolution)
+      moving = resizeNearest(moving, resolution)
+    self._setImage(self.fixedVolume, fixed)
+    self._setImage(self.movingVolume, moving)
+    return wrapAngle(self.logic.registerImages(self.fixedVolume, self.movingVolume, anglesNumber))
+
+class ProxyRollSearch(object):
+  """ NumPy imitation of the CLI: exhaustive search of the in-plane rotation that best matches two square images.
+
+  anglesNumber rotations evenly spaced over 360 degrees, as the CLI's
+  parameter, are scored by normalized cross correlation inside the inscribed
+  circle. Not the registration used in the clinic: see --method both.
+  """
+  def __init__(self, size, anglesNumber):
+    self.size = size
+    self.angles = numpy.arange(anglesNumber) * 360.0 / anglesNumber
+    center = (size - 1) / 2.0
+    y, x = numpy.mgrid[0:size, 0:size] - center
+    mask = x**2 + y**2 <= center**2
+    self.maskIndices = numpy.flatnonzero(mask)
+    x = x[mask]
+    y = y[mask]
+    radians = numpy.radians(self.angles)[:,numpy.newaxis]
+    sourceX = numpy.rint(numpy.cos(radians)*x - numpy.sin(radians)*y + center).astype(numpy.intp)
+    sourceY = numpy.rint(numpy.sin(radians)*x + numpy.cos(radians)*y + center).astype(numpy.intp)
+    numpy.clip(sourceX, 0, size-1, out=sourceX)
+    numpy.clip(sourceY, 0, size-1, out=sourceY)
+    self.sourceIndices = sourceY * size + sourceX
+
+  def __call__(self, fixed, moving):
+    """ Camera roll in degrees that maps moving onto fixed """
+    fixedValues = fixed.ravel()[self.maskIndices].astype(numpy.float64)
+    fixedValues -= fixedValues.mean()
+    rotated = moving.ravel()[self.sourceIndices].astype(numpy.float64)
+    rotated -= rotated.mean(axis=1)[:,numpy.newaxis]
+    scores = numpy.dot(rotated, fixedValues)
+    norms = numpy.sqrt((rotated**2).sum(axis=1) * (fixedValues**2).sum())
+    scores /= numpy.where(norms > 0, norms, 1)
+    return wrapAngle(self.angles[scores.argmax()])
+
+def wrapAngle(angle):
+  return (angle + 180.0) % 360.0 - 180.0
+
+def _proxyRoll(fixed, moving, anglesNumber, resolution):
+  # without a resolution, the side of the smaller image
+  size = resolution or min(fixed.shape + moving.shape)
+  search = _worker['searches'].get((size, anglesNumber))
+  if search is None:
+    search = ProxyRollSearch(size, anglesNumber)
+    _worker['searches'][(size, anglesNumber)] = search
+  return search(resizeNearest(fixed, size), resizeNearest(moving, size))
+
+#
+# Rendering
+#
+
+class VirtualViewRenderer(object):
+  """ Off-screen VTK rendering of the airway model from the navigation camera """
+  def __init__(self, modelFileName, width, height):
+    import vtk
+    from vtk.util.numpy_support import vtk_to_numpy
+    self.vtk_to_numpy = vtk_to_numpy
+    extension = os.path.splitext(modelFileName)[1].lower()
+    reader = {'.vtp': vtk.vtkXMLPolyDataReader, '.stl': vtk.vtkSTLReader}.get(extension, vtk.vtkPolyDataReader)()
+    reader.SetFileName(modelFileName)
+    mapper = vtk.vtkPolyDataMapper()
+    mapper.SetInputConnection(reader.GetOutputPort())
+    actor = vtk.vtkActor()
+    actor.SetMapper(mapper)
+    # same appearance as the airway model in the module
+    actor.GetProperty().SetColor(1.0, 0.8, 0.7)
+    actor.GetProperty().FrontfaceCullingOn()
+    actor.GetProperty().SetAmbient(0.08)
+    actor.GetProperty().SetDiffuse(0.90)
+    actor.GetProperty().SetSpecular(0.17)
+    self.renderer = vtk.vtkRenderer()
+    self.renderer.AddActor(actor)
+    self.renderWindow = vtk.vtkRenderWindow()
+    self.renderWindow.SetOffScreenRendering(1)
+    self.renderWindow.SetSize(width, height)
+    self.renderWindow.AddRenderer(self.renderer)
+    self.grabber = vtk.vtkWindowToImageFilter()
+    self.grabber.SetInput(self.renderWindow)
+    self.camera = self.renderer.GetActiveCamera()
+    self.camera.SetViewAngle(CAMERA_VIEW_ANGLE)
+
+  def render(self, position, focalPoint, viewUp):
+    self.camera.SetPosition(*position)
+    self.camera.SetFocalPoint(*focalPoint)
+    self.camera.SetViewUp(*viewUp)
+    self.camera.SetClippingRange(0.7081381565016212, 708.1381565016211)
+    self.renderWindow.Render()
+    self.grabber.Modified()
+    self.grabber.Update()
+    image = self.grabber.GetOutput()
+    dims = image.GetDimensions()
+    scalars = self.vtk_to_numpy(image.GetPointData().GetScalars())
+    return scalars.reshape(dims[1], dims[0], -1)[:,:,:3].copy()
+
+#
+# Workers
+#
+
+_worker = {}
+
+def _initializeWorker(directory, renderSize, configurations, methods):
+  session = RecordedSession(directory)
+  _worker['session'] = session
+  _worker['configurations'] = configurations
+  _worker['renderer'] = None
+  if session.virtual is None:
+    if session.airwayModel is None:
+      raise IOError('Neither virtual.npy nor an airway model found in %s' % directory)
+    _worker['renderer'] = VirtualViewRenderer(session.airwayModel, renderSize[0], renderSize[1])
+  _worker['searches'] = {}
+  _worker['preprocessors'] = {}
+  _worker['registrations'] = {}
+  for method in methods:
+    _worker['registrations'][method] = CLIRegistration() if method == 'cli' else _proxyRoll
+
+def _evaluateEncounter(task):
+  frameIndex, bifurcationIndex, position, focalPoint, viewUp = task
+  session = _worker['session']
+  if session.virtual is not None:
+    virtual = numpy.asarray(session.virtual[frameIndex])
+  else:
+    virtual = _worker['renderer'].render(position, focalPoint, viewUp)
+  frame = numpy.asarray(session.frames[frameIndex])
+  rendered = FramePreprocessor(None)(virtual).copy()
+
+  # per configuration, method: (roll, seconds)
+  results = []
+  for anglesNumber, endoscopeModel, resolution in _worker['configurations']:
+    preprocessor = _worker['preprocessors'].get(endoscopeModel)
+    if preprocessor is None:
+      preprocessor = FramePreprocessor(ENDOSCOPE_CROP_REGIONS[endoscopeModel])
+      _worker['preprocessors'][endoscopeModel] = preprocessor
+    fixed = preprocessor(frame)
+    rolls = {}
+    for method, register in _worker['registrations'].items():
+      startTime = time.time()
+      roll = register(fixed, rendered, anglesNumber, resolution)
+      rolls[method] = (float(roll), time.time() - startTime)
+    results.append(rolls)
+  return frameIndex, bifurcationIndex, results
+
+def runSlicerWorker(taskFile, resultFile):
+  """ Entry point of the Slicer workers started by evaluateSession: evaluates the encounters of taskFile """
+  with open(taskFile) as f:
+    job = json.load(f)
+  _initializeWorker(job['directory'], job['renderSize'], [tuple(c) for c in job['configurations']], job['methods'])
+  outcomes = [_evaluateEncounter(task) for task in job['tasks']]
+  with open(resultFile, 'w') as f:
+    json.dump(outcomes, f)
+  return 0
+
+def slicerExecutable(path=None):
+  """ Slicer application to run the registration CLI in: path, $SLICER_EXECUTABLE, or the Slicer next to this Python """
+  candidates = [path, os.environ.get('SLICER_EXECUTABLE')]
+  directory = os.path.dirname(sys.executable)
+  for parent in (directory, os.path.dirname(directory)):
+    candidates += [os.path.join(parent, 'Slicer'), os.path.join(parent, 'Slicer.exe')]
+  for candidate in candidates:
+    if candidate and os.path.isfile(candidate):
+      return candidate
+  raise IOError('Slicer not found: the registration CLI runs only inside Slicer; pass --slicer or set SLICER_EXECUTABLE')
+
+def _runSlicerWorkers(slicer, directory, renderSize, configurations, methods, tasks, processes):
+  """ Outcomes of the tasks, split between Slicer applications started with --no-main-window """
+  if not tasks:
+    return []
+  processes = min(processes or defaultProcessCount(), len(tasks))
+  packageDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  workDirectory = tempfile.mkdtemp(prefix='BronchoscopyRegistrationEvaluation')
+  try:
+    workers = []
+    for index in range(processes):
+      taskFile = os.path.join(workDirectory, 'tasks-%d.json' % index)
+      resultFile = os.path.join(workDirectory, 'results-%d.json' % index)
+      with open(taskFile, 'w') as f:
+        json.dump({'directory': os.path.abspath(directory), 'renderSize': list(renderSize),
+                   'configurations': configurations, 'methods': list(methods),
+                   'tasks': [[int(task[0]), int(task[1])] + [[float(x) for x in vector] for vector in task[2:]]
+                             for task in tasks[index::processes]]}, f)
+      command = [slicer, '--no-splash', '--no-main-window', '--python-code', WORKER_CODE % (packageDirectory, taskFile, resultFile)]
+      workers.append((subprocess.Popen(command), resultFile))
+    statuses = [worker.wait() for worker, resultFile in workers]
+    outcomes = []
+    for status, (worker, resultFile) in zip(statuses, workers):
+      if status != 0 or not os.path.exists(resultFile):
+        raise RuntimeError('A Slicer registration worker failed with exit status %s' % status)
+      with open(resultFile) as f:
+        outcomes.extend(json.load(f))
+  finally:
+    shutil.rmtree(workDirectory, ignore_errors=True)
+  outcomes.sort(key=lambda outcome: outcome[0])
+  return outcomes
+
+def _errorStatistics(errors, tolerance):
+  return {'evaluated': len(errors),
+          'meanError': float(errors.mean()),
+          'medianError': float(numpy.median(errors)),
+          'p95Error': float(numpy.percentile(errors, 95)),
+          'maxError': float(errors.max()),
+          'withinTolerance': float((errors <= tolerance).mean())}
+
+def evaluateSession(directory, anglesNumbers=(36,), endoscopeModels=(DEFAULT_ENDOSCOPE_MODEL,),
+                    resolutions=(0,), renderSize=(640, 480), processes=None, tolerance=10.0,
+                    methods=('cli',), slicer=None):
+  """ Registers every bifurcation encounter with each of methods and returns the report dictionary.
+
+  A resolution of 0 registers the preprocessed frames at their own size, as
+  the module does. 'cli' needs Slicer (see slicerExecutable).
+  """
+  for method in methods:
+    if method not in METHODS:
+      raise ValueError('Unknown registration method %s, expected one of %s' % (method, ', '.join(METHODS)))
+  session = RecordedSession(directory)
+  indices = nearestPoints(session.centerline, session.tracker[:,:3,3])
+  snapped = session.centerline[indices]
+  positions, focalPoints, viewUps = cameraPoses(session.tracker, session.centerline, indices)
+  encounters = bifurcationEncounters(snapped, session.bifurcations)
+  configurations = list(itertools.product(anglesNumbers, endoscopeModels, resolutions))
+  tasks = [(f, b, positions[f], focalPoints[f], viewUps[f]) for f, b in encounters]
+
+  startTime = time.time()
+  if 'cli' in methods:
+    outcomes = _runSlicerWorkers(slicerExecutable(slicer), directory, renderSize, configurations, methods, tasks, processes)
+  else:
+    pool = createProcessPool(processes, _initializeWorker, (directory, renderSize, configurations, methods))
+    try:
+      outcomes = pool.map(_evaluateEncounter, tasks)
+    finally:
+      pool.close()
+      pool.join()
+  wallTime = time.time() - startTime
+
+  report = {'session': os.path.abspath(directory), 'frames': len(session.frames), 'methods': list(methods),
+            'encounters': len(encounters), 'wallTime': wallTime, 'configurations': []}
+  truth = None
+  if session.roll is not None:
+    truth = numpy.array([session.roll[outcome[0]] for outcome in outcomes], dtype=numpy.float64)
+  for c, (anglesNumber, endoscopeModel, resolution) in enumerate(configurations):
+    entry = {'anglesNumber': anglesNumber, 'endoscopeModel': endoscopeModel, 'resolution': resolution}
+    rolls = {}
+    for method in methods:
+      rolls[method] = numpy.array([outcome[2][c][method][0] for outcome in outcomes])
+      seconds = numpy.array([outcome[2][c][method][1] for outcome in outcomes])
+      result = {'secondsPerEncounter': float(seconds.mean()) if len(seconds) else None}
+      if len(seconds) and seconds.sum() > 0:
+        result['encountersPerSecond'] = float(len(seconds) / seconds.sum())
+      if truth is not None and len(rolls[method]):
+        known = ~numpy.isnan(truth)
+        if known.any():
+          result.update(_errorStatistics(numpy.abs(wrapAngle(rolls[method][known] - truth[known])), tolerance))
+      entry[method] = result
+    if 'cli' in methods and 'proxy' in methods and len(outcomes):
+      # how far the imitation is from the registration it stands for, on the same frames
+      entry['proxyAgreement'] = _errorStatistics(numpy.abs(wrapAngle(rolls['proxy'] - rolls['cli'])), tolerance)
+    report['configurations'].append(entry)
+  return report
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Evaluate the image registration over a recorded bronchoscopy session.')
+  parser.add_argument('session', help='directory holding the recorded session')
+  parser.add_argument('--angles', type=int, nargs='+', default=[36], help='anglesNumber values to compare')
+  parser.add_argument('--endoscope', nargs='+', default=[DEFAULT_ENDOSCOPE_MODEL], choices=sorted(ENDOSCOPE_CROP_REGIONS.keys()))
+  parser.add_argument('--resolution', type=int, nargs='+', default=[0], help='side of the square images registered, 0 for the preprocessed frames as they are')
+  parser.add_argument('--render-size', type=int, nargs=2, default=[640, 480])
+  parser.add_argument('--processes', type=int, default=None)
+  parser.add_argument('--tolerance', type=float, default=10.0, help='degrees counted as a successful registration')
+  parser.add_argument('--method', choices=('cli', 'proxy', 'both'), default='cli',
+                      help='registration CLI run in Slicer, its NumPy proxy, or both to check the proxy against the CLI')
+  parser.add_argument('--slicer', help='Slicer executable running the registration CLI')
+  parser.add_argument('--min-agreement', type=float, default=0.9,
+                      help='with --method both, fraction of encounters where the proxy roll must be within tolerance of the CLI one')
+  parser.add_argument('--output', help='write the JSON report to this file')
+  args = parser.parse_args(argv)
+
+  methods = METHODS if args.method == 'both' else (args.method,)
+  report = evaluateSession(args.session, args.angles, args.endoscope, args.resolution,
+                           tuple(args.render_size), args.processes, args.tolerance, methods, args.slicer)
+  output = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(output)
+  print(output)
+  for entry in report['configurations']:
+    agreement = entry.get('proxyAgreement')
+    if agreement is not None and agreement['withinTolerance'] < args.min_agreement:
+      sys.stderr.write('The proxy roll is within %g degrees of the CLI roll for only %.0f%% of the encounters '
+                       '(anglesNumber %s, %s, resolution %s)\n' % (args.tolerance, 100 * agreement['withinTolerance'],
+                       entry['anglesNumber'], entry['endoscopeModel'], entry['resolution']))
+      return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
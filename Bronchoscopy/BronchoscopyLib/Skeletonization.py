@@ -0,0 +1,301 @@
+"""
+In-process centerline extraction by thinning the airway label map.
+
+skeletonize thins a binary mask down to one-voxel-wide curves while keeping
+its topology (26-connected foreground, 6-connected background). Voxels are
+peeled off from the outside in, by depth: their 3-4-5 chamfer distance to
+the background. At each depth, the voxels not deeper are peeled in passes of
+six border directions until none can be removed, and within each direction
+in eight subfields, the voxels of one parity class of (k, j, i). No two
+voxels of a subfield are 26-neighbours, so all the simple voxels of a
+subfield can be removed at once and the result is the same as removing them
+one by one. The simple-point test of the candidates is vectorized with NumPy
+and split between threads. Curve end voxels, found again before each
+direction, are kept, so branches do not shrink.
+
+Peeling by depth thins a tube towards its axis whatever its orientation and
+whatever the parity of the voxels. Peeled by direction only, an oblique tube
+first became a medial surface, and the parity classes left its edges as a
+comb of curve ends across the tube.
+
+skeletonBranches turns the skeleton into branches between end and junction
+voxels, pruning the short spurs left by bumps of the airway wall, and
+centerlineFromMask orders them depth first from the trachea, giving the
+centerline points, the branch topology and the bifurcations directly, in
+RAS, without going through a centerline volume and a surface model.
+"""
+
+import itertools
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+from .Parallel import defaultProcessCount
+
+# the 26 neighbours of a voxel, as (k, j, i) offsets
+OFFSETS = numpy.array([offset for offset in itertools.product((-1, 0, 1), repeat=3) if offset != (0, 0, 0)])
+# neighbours sharing a face with the voxel, and the 18 sharing a face or an edge
+FACES = numpy.abs(OFFSETS).sum(axis=1) == 1
+N18 = numpy.abs(OFFSETS).sum(axis=1) <= 2
+# 26-adjacency of the neighbours among themselves, and 6-adjacency within the 18-neighbourhood
+ADJACENT26 = (numpy.abs(OFFSETS[:, numpy.newaxis] - OFFSETS[numpy.newaxis]).max(axis=2) == 1).astype(numpy.float32)
+ADJACENT6 = ((numpy.abs(OFFSETS[:, numpy.newaxis] - OFFSETS[numpy.newaxis]).sum(axis=2) == 1)
+             & N18[:, numpy.newaxis] & N18[numpy.newaxis]).astype(numpy.float32)
+# BRIDGES[a, b]: neighbour b is adjacent to neighbour a by a step shorter than a, and is nearer than a; a skeleton
+# voxel joined to a through such a b is a corner of a 26-adjacency triangle, which the curve goes around through b
+_LENGTHS = (OFFSETS**2).sum(axis=1)
+_STEPS = OFFSETS[:, numpy.newaxis] - OFFSETS[numpy.newaxis]
+BRIDGES = ((numpy.abs(_STEPS).max(axis=2) == 1) & ((_STEPS**2).sum(axis=2) < _LENGTHS[:, numpy.newaxis])
+           & (_LENGTHS[numpy.newaxis] < _LENGTHS[:, numpy.newaxis])).astype(numpy.float32)
+
+# candidates tested per thread task
+CHUNK_SIZE = 8192
+
+def _propagate(reach, allowed, adjacency):
+  """ Grows reach through the allowed neighbours until it stops changing """
+  while True:
+    grown = reach | (allowed & (numpy.dot(reach.astype(numpy.float32), adjacency) > 0))
+    if (grown == reach).all():
+      return reach
+    reach = grown
+
+def _connectedFrom(members, seedMask, adjacency):
+  """ Whether the members of each row form one component reached from its first seed; False without seed """
+  seeds = members & seedMask
+  hasSeed = seeds.any(axis=1)
+  reach = numpy.zeros(members.shape, dtype=bool)
+  reach[numpy.arange(len(members)), seeds.argmax(axis=1)] = hasSeed
+  reach = _propagate(reach, members, adjacency)
+  return hasSeed, reach
+
+def isSimple(neighbourhoods):
+  """ Whether removing the centre of each (n, 26) neighbourhood keeps the topology of the image.
+
+  A voxel is simple when its foreground 26-neighbours form a single
+  26-connected component and the background voxels of its 18-neighbourhood
+  that touch a face of it form a single 6-connected component.
+  """
+  neighbourhoods = numpy.asarray(neighbourhoods, dtype=bool)
+  hasForeground, reach = _connectedFrom(neighbourhoods, True, ADJACENT26)
+  foregroundConnected = hasForeground & ~(neighbourhoods & ~reach).any(axis=1)
+  background = ~neighbourhoods & N18
+  hasFace, reach = _connectedFrom(background, FACES, ADJACENT6)
+  backgroundConnected = hasFace & ~(background & FACES & ~reach).any(axis=1)
+  return foregroundConnected & backgroundConnected
+
+def _flatOffsets(shape):
+  return numpy.dot(OFFSETS, [shape[1] * shape[2], shape[2], 1])
+
+def _chamferDepths(volume, foreground, offsets):
+  """ 3-4-5 chamfer distance of the foreground voxels of a padded flat volume to the background """
+  weights = numpy.array([3, 4, 5])[numpy.abs(OFFSETS).sum(axis=1) - 1]
+  distances = numpy.where(volume, numpy.iinfo(numpy.int32).max // 2, 0).astype(numpy.int32)
+  neighbours = foreground[:, numpy.newaxis] + offsets
+  while True:
+    depths = numpy.minimum((distances[neighbours] + weights).min(axis=1), distances[foreground])
+    if (depths == distances[foreground]).all():
+      return depths
+    distances[foreground] = depths
+
+def skeletonize(mask, threads=None):
+  """ One voxel wide skeleton (boolean array) of the non-zero voxels of a 3D mask """
+  mask = numpy.asarray(mask) != 0
+  skeleton = numpy.zeros(mask.shape, dtype=bool)
+  if not mask.any():
+    return skeleton
+  # work on the bounding box of the mask, padded by one background voxel on each side
+  low = numpy.array([axis.min() for axis in mask.nonzero()])
+  high = numpy.array([axis.max() for axis in mask.nonzero()]) + 1
+  box = tuple(slice(l, h) for l, h in zip(low, high))
+  volume = numpy.pad(mask[box], 1, mode='constant').ravel()
+  shape = tuple(high - low + 2)
+  offsets = _flatOffsets(shape)
+
+  foreground = volume.nonzero()[0]
+  depths = _chamferDepths(volume, foreground, offsets)
+  k, j, i = numpy.unravel_index(foreground, shape)
+  subfields = (k % 2) * 4 + (j % 2) * 2 + i % 2
+  pool = ThreadPool(threads or defaultProcessCount())
+  try:
+    for depth in numpy.unique(depths):
+      removed = True
+      while removed:
+        removed = False
+        for direction in offsets[FACES]:
+          # border voxels not deeper than depth; curve ends (and isolated voxels) stay
+          selected = numpy.flatnonzero((depths <= depth) & ~volume[foreground + direction])
+          selected = selected[volume[foreground[selected, numpy.newaxis] + offsets].sum(axis=1) > 1]
+          for subfield in range(8):
+            candidates = foreground[selected[subfields[selected] == subfield]]
+            if len(candidates) == 0:
+              continue
+            neighbourhoods = volume[candidates[:, numpy.newaxis] + offsets]
+            chunks = [neighbourhoods[start:start + CHUNK_SIZE] for start in range(0, len(candidates), CHUNK_SIZE)]
+            simple = numpy.concatenate(pool.map(isSimple, chunks))
+            if simple.any():
+              volume[candidates[simple]] = False
+              removed = True
+          remaining = volume[foreground]
+          foreground = foreground[remaining]
+          subfields = subfields[remaining]
+          depths = depths[remaining]
+  finally:
+    pool.close()
+    pool.join()
+
+  skeleton[box] = volume.reshape(shape)[1:-1, 1:-1, 1:-1]
+  return skeleton
+
+def _traceBranches(volume, shape):
+  """ Branches of a padded flat skeleton as lists of flat indices, from node to node; and the voxel degrees """
+  offsets = _flatOffsets(shape)
+  voxels = volume.nonzero()[0]
+  neighbours = voxels[:, numpy.newaxis] + offsets
+  present = volume[neighbours]
+  # the longest side of a triangle is not a step of the curve, so the three voxels are not junctions
+  present &= ~(numpy.dot(present.astype(numpy.float32), BRIDGES.T) > 0)
+  degree = dict(zip(voxels.tolist(), present.sum(axis=1).tolist()))
+  adjacency = dict((voxel, row[mask].tolist()) for voxel, row, mask in zip(voxels.tolist(), neighbours, present))
+
+  branches = []
+  visited = set()
+  def walk(start, step):
+    branch = [start, step]
+    previous, current = start, step
+    while degree[current] == 2 and current not in visited:
+      visited.add(current)
+      following = [voxel for voxel in adjacency[current] if voxel != previous]
+      if not following:
+        break
+      previous, current = current, following[0]
+      branch.append(current)
+    return branch
+
+  nodes = [voxel for voxel in voxels.tolist() if degree[voxel] != 2]
+  edges = set()
+  for node in nodes:
+    for step in adjacency[node]:
+      if (node, step) in edges:
+        continue
+      branch = walk(node, step)
+      edges.add((branch[-1], branch[-2]))
+      branches.append(branch)
+  # closed loops without any node
+  for voxel in voxels.tolist():
+    if voxel not in visited and degree[voxel] == 2:
+      visited.add(voxel)
+      branches.append(walk(voxel, adjacency[voxel][0]))
+  return branches, degree
+
+def skeletonBranches(skeleton, minimumBranchLength=5):
+  """ Branches of a skeleton as (n, 3) arrays of (k, j, i) indices, each running from node to node, and their end nodes.
+
+  Branches ending in a curve end, shorter than minimumBranchLength voxels
+  and attached to a junction are removed as spurs. Junction voxels at most
+  two steps apart are one node, and the short links between them are not
+  branches. Nodes are given as the (k, j, i) tuple of one of their voxels;
+  the second list holds the (first, last) nodes of each branch.
+  """
+  skeleton = numpy.asarray(skeleton) != 0
+  shape = tuple(numpy.array(skeleton.shape) + 2)
+  volume = numpy.pad(skeleton, 1, mode='constant').ravel()
+  while True:
+    branches, degree = _traceBranches(volume, shape)
+    spurs = [branch for branch in branches if len(branch) - 1 < minimumBranchLength
+             and min(degree[branch[0]], degree[branch[-1]]) == 1 and max(degree[branch[0]], degree[branch[-1]]) > 2]
+    if not spurs:
+      break
+    for branch in spurs:
+      tip = branch if degree[branch[-1]] == 1 else branch[::-1]
+      volume[tip[1:]] = False
+
+  representative = {}
+  def find(voxel):
+    while representative.get(voxel, voxel) != voxel:
+      voxel = representative[voxel]
+    return voxel
+  isLink = lambda branch: len(branch) <= 3 and degree[branch[0]] > 2 and degree[branch[-1]] > 2
+  for branch in branches:
+    if isLink(branch) and find(branch[0]) != find(branch[-1]):
+      representative[find(branch[0])] = find(branch[-1])
+  branches = [branch for branch in branches if not (isLink(branch) and find(branch[0]) == find(branch[-1]))]
+
+  toIndices = lambda voxels: numpy.column_stack(numpy.unravel_index(voxels, shape)) - 1
+  nodes = [tuple(tuple(index) for index in toIndices([find(branch[0]), find(branch[-1])]).tolist()) for branch in branches]
+  return [toIndices(branch) for branch in branches], nodes
+
+def _smoothBranch(points, smoothing):
+  """ Moving average over 2 * smoothing + 1 points, keeping the two end points """
+  if smoothing < 1 or len(points) < 3:
+    return points
+  window = numpy.ones(2 * smoothing + 1) / (2 * smoothing + 1)
+  padded = numpy.vstack((points[:1].repeat(smoothing, axis=0), points, points[-1:].repeat(smoothing, axis=0)))
+  smoothed = numpy.column_stack([numpy.convolve(padded[:, axis], window, mode='valid') for axis in range(3)])
+  smoothed[0] = points[0]
+  smoothed[-1] = points[-1]
+  return smoothed
+
+def centerlineFromMask(mask, ijkToRAS=None, threads=None, minimumBranchLength=5, smoothing=2, rootPosition=None):
+  """ Ordered centerline points, branch topology and bifurcations of the airway mask, in RAS.
+
+  mask is indexed (k, j, i), as slicer.util.array returns volumes, and
+  ijkToRAS is the 4x4 IJK to RAS matrix of the volume (identity by default).
+  The branches are visited depth first from the curve end highest in S (the
+  trachea), or from the curve end closest to rootPosition, and their points are concatenated in that order, each branch
+  after the first leaving out the junction point it shares with its parent.
+  Returns (points, branches, bifurcations): branches holds a
+  (start, stop, parent) row per branch, points[start:stop] being its points
+  and parent the row of the branch it comes from (-1 for the trachea), and
+  bifurcations the junctions where a branch splits.
+  """
+  matrix = numpy.identity(4) if ijkToRAS is None else numpy.asarray(ijkToRAS, dtype=numpy.float64).reshape(4, 4)
+  def toRAS(kji):
+    ijk = numpy.asarray(kji, dtype=numpy.float64).reshape(-1, 3)[:, ::-1]
+    return numpy.dot(ijk, matrix[:3, :3].T) + matrix[:3, 3]
+
+  branches, ends = skeletonBranches(skeletonize(mask, threads), minimumBranchLength)
+  if not branches:
+    voxels = numpy.transpose(numpy.nonzero(numpy.asarray(mask) != 0))
+    points = toRAS(voxels[:1])
+    return points, numpy.array([[0, len(points), -1]]).reshape(-1, 3), numpy.zeros((0, 3))
+
+  # node -> branches meeting there
+  incident = {}
+  for index, (first, last) in enumerate(ends):
+    incident.setdefault(first, []).append(index)
+    incident.setdefault(last, []).append(index)
+  endVoxels = [node for node, indices in incident.items() if len(indices) == 1]
+  if rootPosition is None:
+    root = max(endVoxels or incident, key=lambda node: toRAS(node)[0][2])
+  else:
+    root = min(endVoxels or incident, key=lambda node: ((toRAS(node)[0] - rootPosition)**2).sum())
+
+  points = []
+  rows = []
+  bifurcations = []
+  count = 0
+  done = set()
+  # (node, parent row) to continue from
+  stack = [(root, -1)]
+  while stack:
+    node, parent = stack.pop()
+    children = [index for index in incident[node] if index not in done]
+    if parent >= 0 and len(children) > 1:
+      bifurcations.append(toRAS(node)[0])
+    for index in children:
+      done.add(index)
+      forward = ends[index][0] == node
+      branch = branches[index] if forward else branches[index][::-1]
+      branchPoints = _smoothBranch(toRAS(branch), smoothing)
+      if rows:
+        branchPoints = branchPoints[1:]
+      if len(children) == 1 and parent >= 0 and parent == len(rows) - 1:
+        # the node only joins two pieces of the same branch
+        start, stop, grandparent = rows[parent]
+        rows[parent] = (start, stop + len(branchPoints), grandparent)
+      else:
+        rows.append((count, count + len(branchPoints), parent))
+      points.append(branchPoints)
+      count += len(branchPoints)
+      stack.append((ends[index][1] if forward else ends[index][0], len(rows) - 1))
+  return numpy.concatenate(points), numpy.array(rows, dtype=numpy.int64).reshape(-1, 3), numpy.asarray(bifurcations).reshape(-1, 3)
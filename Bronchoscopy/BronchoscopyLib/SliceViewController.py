@@ -0,0 +1,77 @@
+"""
+Red/Yellow/Green slice views following a position.
+
+The three slice logics are looked up in the layout manager once and kept.
+setOffsets moves the Yellow, Green and Red slices to the R, A and S
+coordinates of a point in one batch: the slice nodes' Modified events are
+held until all three offsets are set, so each view reslices and renders once,
+and offsets that do not change are not written at all. followPosition is the
+throttled variant used by probe tracking, so the slices can follow the probe
+at a lower rate than the 3D cameras are updated.
+"""
+
+import time
+
+# slice view and the RAS coordinate its offset follows
+SLICE_VIEW_AXES = (('Yellow', 0), ('Green', 1), ('Red', 2))
+
+class SliceViewController(object):
+  """ Cached slice logics of the Red, Yellow and Green views.
+
+  followInterval is the minimum time in seconds between two followPosition
+  updates; 0 follows every call.
+  """
+  def __init__(self, layoutManager, followInterval=0.0):
+    self.layoutManager = layoutManager
+    self.followInterval = followInterval
+    self.logics = {}
+    self.lastFollow = None
+    self.pendingPosition = None
+    self.updates = 0
+    self.skipped = 0
+
+  def sliceLogics(self, viewNames=None):
+    """ (logic, axis) pairs of the views (all three by default); a logic is looked up again only if its view was removed """
+    logics = []
+    for name, axis in SLICE_VIEW_AXES:
+      if viewNames is not None and name not in viewNames:
+        continue
+      logic = self.logics.get(name)
+      if logic is None or logic.GetSliceNode() is None:
+        logic = self.logics[name] = self.layoutManager.sliceWidget(name).sliceLogic()
+      logics.append((logic, axis))
+    return logics
+
+  def setOffsets(self, position, viewNames=None):
+    """ Moves the slices to position in one batch; returns how many views moved """
+    changed = []
+    for logic, axis in self.sliceLogics(viewNames):
+      if logic.GetSliceOffset() != position[axis]:
+        sliceNode = logic.GetSliceNode()
+        changed.append((sliceNode, sliceNode.StartModify()))
+        logic.SetSliceOffset(position[axis])
+    for sliceNode, wasModifying in changed:
+      sliceNode.EndModify(wasModifying)
+    self.pendingPosition = None
+    self.updates += 1
+    return len(changed)
+
+  def followPosition(self, position, now=None):
+    """ setOffsets, at most once per followInterval; returns False when the update was deferred """
+    now = time.time() if now is None else now
+    if self.lastFollow is not None and now - self.lastFollow < self.followInterval:
+      self.pendingPosition = (position[0], position[1], position[2])
+      self.skipped += 1
+      return False
+    self.lastFollow = now
+    self.setOffsets(position)
+    return True
+
+  def flush(self):
+    """ Applies the last deferred followPosition, if any """
+    if self.pendingPosition is not None:
+      self.setOffsets(self.pendingPosition)
+
+  def fitToBackground(self):
+    for logic, axis in self.sliceLogics():
+      logic.FitSliceToBackground(1,1)
@@ -0,0 +1,241 @@
+"""
+Centerline extraction of whole airway trees, one subtree per process.
+
+splitAirwayTree finds the main bifurcations on a quick skeleton of the label
+resampled to a coarse spacing. Every branch of generation depth (the lobar
+bronchi for depth 2: trachea 0, main bronchi 1) roots a subtree. The label
+voxels then go to the subtree of the coarse centerline point closest to
+them, and the trachea and the bronchi above the split form the central part.
+The central part also takes the first JUNCTION_MARGIN junction radii of
+each subtree: a crop shortens the skeleton by about a radius at the cut, so
+cutting the central part right at the junction would end its branches short
+of their bifurcations.
+
+extractCenterlineParallel skeletonizes and smooths the central part and each
+subtree in separate processes (Parallel.createProcessPool), each subtree
+ordered from its end closest to the junction. trimCentral cuts the central
+centerline where it enters a subtree, and stitchCenterlines joins them.
+Every subtree hangs from the central branch ending closest to its root,
+through a straight bridge across the cut; a central end where two or more
+subtrees start is a bifurcation. With fewer than two subtrees the label is
+extracted in one piece, as by Skeletonization.centerlineFromMask.
+"""
+
+import time
+
+import numpy
+
+from . import LabelMapCropping
+from . import Skeletonization
+from .Parallel import createProcessPool
+
+# voxel to coarse centerline point distances computed at once, when assigning voxels to subtrees
+ASSIGNMENT_BLOCK = 1 << 23
+# how far the central part reaches into each subtree, in radii of the airway at the junction
+JUNCTION_MARGIN = 2.0
+
+def _toRAS(ijkToRAS, kji):
+  matrix = numpy.asarray(ijkToRAS, dtype=numpy.float64).reshape(4, 4)
+  return numpy.dot(numpy.asarray(kji, dtype=numpy.float64).reshape(-1, 3)[:, ::-1], matrix[:3, :3].T) + matrix[:3, 3]
+
+def branchGenerations(branches):
+  """ Generation of each (start, stop, parent) branch row: 0 for the root, parent's generation + 1 for the others """
+  generations = numpy.zeros(len(branches), dtype=numpy.int64)
+  for row, (start, stop, parent) in enumerate(branches):
+    # parents always come before their children
+    generations[row] = generations[parent] + 1 if parent >= 0 else 0
+  return generations
+
+def _wallPoints(coarse, coarseToRAS):
+  """ RAS points of the background voxels next to the coarse label """
+  label = numpy.pad(numpy.asarray(coarse) != 0, 1, mode='constant')
+  grown = label.copy()
+  for axis in range(3):
+    grown |= numpy.roll(label, 1, axis) | numpy.roll(label, -1, axis)
+  return _toRAS(coarseToRAS, numpy.transpose(numpy.nonzero(grown & ~label)) - 1)
+
+def splitAirwayTree(labelArray, ijkToRAS, depth=2, coarseSpacing=2.0):
+  """ The label split into subtrees at the branches of generation depth.
+
+  Returns (regions, roots): regions[0] is the central part and regions[s]
+  the subtree s, each a (low, mask, ijkToRAS) crop of the label; roots[s-1]
+  is the RAS point where subtree s leaves the central part. The central part
+  overlaps the start of each subtree.
+  """
+  labelArray = numpy.asarray(labelArray)
+  coarse, coarseToRAS, report = LabelMapCropping.cropLabel(labelArray, ijkToRAS, 0.0, coarseSpacing)
+  points, branches, bifurcations = Skeletonization.centerlineFromMask(coarse, coarseToRAS, threads=1)
+
+  # subtree of each branch: the generation depth ancestor it descends from, 0 above them
+  generations = branchGenerations(branches)
+  subtreeOfBranch = numpy.zeros(len(branches), dtype=numpy.int64)
+  roots = []
+  for row, (start, stop, parent) in enumerate(branches):
+    if generations[row] == depth:
+      roots.append(points[start])
+      subtreeOfBranch[row] = len(roots)
+    elif generations[row] > depth:
+      subtreeOfBranch[row] = subtreeOfBranch[parent]
+  subtreeOfPoint = numpy.zeros(len(points), dtype=numpy.int64)
+  for row, (start, stop, parent) in enumerate(branches):
+    subtreeOfPoint[start:stop] = subtreeOfBranch[row]
+
+  voxels = numpy.transpose(numpy.nonzero(labelArray))
+  if len(roots) < 2:
+    return [_region(labelArray.shape, voxels, ijkToRAS)], []
+
+  # the central part keeps the subtree points close to the junctions too
+  centralPoint = subtreeOfPoint == 0
+  wall = _wallPoints(coarse, coarseToRAS)
+  for root in roots:
+    radius = numpy.sqrt(((wall - root)**2).sum(axis=1).min())
+    centralPoint |= ((points - root)**2).sum(axis=1) < (JUNCTION_MARGIN * radius)**2
+
+  # each voxel goes where the closest coarse centerline point belongs
+  closest = numpy.empty(len(voxels), dtype=numpy.int64)
+  blockSize = max(ASSIGNMENT_BLOCK // len(points), 1)
+  for start in range(0, len(voxels), blockSize):
+    block = _toRAS(ijkToRAS, voxels[start:start + blockSize])
+    distance = (block**2).sum(axis=1)[:, numpy.newaxis] - 2 * numpy.dot(block, points.T) + (points**2).sum(axis=1)
+    closest[start:start + blockSize] = distance.argmin(axis=1)
+  assignment = subtreeOfPoint[closest]
+  regions = [_region(labelArray.shape, voxels[centralPoint[closest]], ijkToRAS)]
+  regions.extend(_region(labelArray.shape, voxels[assignment == subtree], ijkToRAS) for subtree in range(1, len(roots) + 1))
+  return regions, roots
+
+def _region(shape, voxels, ijkToRAS):
+  """ (low, mask, ijkToRAS) of the smallest box holding voxels, with one background voxel around them """
+  if len(voxels) == 0:
+    return numpy.zeros(3, dtype=numpy.int64), numpy.zeros((0, 0, 0), dtype=bool), ijkToRAS
+  low = numpy.maximum(voxels.min(axis=0) - 1, 0)
+  high = numpy.minimum(voxels.max(axis=0) + 2, shape)
+  mask = numpy.zeros(high - low, dtype=bool)
+  local = voxels - low
+  mask[local[:, 0], local[:, 1], local[:, 2]] = True
+  matrix = numpy.array(ijkToRAS, dtype=numpy.float64).reshape(4, 4)
+  matrix[:3, 3] = _toRAS(ijkToRAS, low)[0]
+  return low, mask, matrix
+
+def _extractRegion(task):
+  """ Process pool work function: centerline of one region and the time it took """
+  mask, ijkToRAS, rootPosition, minimumBranchLength, smoothing = task
+  start = time.time()
+  centerline = Skeletonization.centerlineFromMask(mask, ijkToRAS, 1, minimumBranchLength, smoothing, rootPosition)
+  return centerline, time.time() - start
+
+def trimCentral(central, subtreeRegions):
+  """ The (points, branches, bifurcations) central centerline cut where it enters one of the (low, mask, ijkToRAS) regions.
+
+  Each branch keeps its points up to the first one inside a region, unless
+  it starts at a bifurcation where every branch enters a region: the
+  subtrees then take them over from the junction, and they are dropped. The
+  branches after a cut are dropped too, and the bifurcations are the branch
+  ends left with two or more children.
+  """
+  points, branches = central[0], numpy.asarray(central[1]).reshape(-1, 3)
+  inside = numpy.zeros(len(points), dtype=bool)
+  for low, mask, matrix in subtreeRegions:
+    inverse = numpy.linalg.inv(numpy.asarray(matrix, dtype=numpy.float64).reshape(4, 4))
+    kji = numpy.rint(numpy.dot(points, inverse[:3, :3].T) + inverse[:3, 3])[:, ::-1].astype(numpy.int64)
+    within = numpy.all((kji >= 0) & (kji < mask.shape), axis=1)
+    inside[within] |= mask[tuple(kji[within].T)]
+
+  # the branches of a junction where every branch enters a subtree
+  parents = branches[:, 2] + 1
+  entering = numpy.array([inside[start:stop].any() for start, stop, parent in branches], dtype=numpy.float64)
+  children = numpy.bincount(parents, minlength=len(branches) + 1)[parents]
+  atSplit = (children > 1) & (numpy.bincount(parents, entering, len(branches) + 1)[parents] == children)
+  kept, rows = [], []
+  # new row of each kept branch, and whether it kept all its points
+  newRow, whole = {}, {-1: True}
+  count = 0
+  for row, (start, stop, parent) in enumerate(branches):
+    if not whole.get(parent, False):
+      continue
+    cut = numpy.flatnonzero(inside[start:stop])
+    length = cut[0] if len(cut) else stop - start
+    if length == 0 or atSplit[row]:
+      continue
+    newRow[row], whole[row] = len(rows), length == stop - start
+    rows.append((count, count + length, newRow.get(parent, -1)))
+    kept.append(points[start:start + length])
+    count += length
+  rows = numpy.array(rows, dtype=numpy.int64).reshape(-1, 3)
+  points = numpy.concatenate(kept).reshape(-1, 3) if kept else numpy.zeros((0, 3))
+  children = numpy.bincount(rows[rows[:, 2] >= 0, 2], minlength=len(rows))
+  return points, rows, points[rows[children > 1, 1] - 1].reshape(-1, 3)
+
+def stitchCenterlines(central, subtrees, spacing=1.0):
+  """ One centerline from the central part and the subtrees, each a (points, branches, bifurcations) tuple.
+
+  The first point of each subtree is joined to the closest end of a central
+  branch by a bridge of points spacing mm apart, which becomes the start of
+  the subtree's first branch.
+  """
+  points, branches, bifurcations = [central[0]], [numpy.asarray(central[1]).reshape(-1, 3)], [central[2]]
+  centralEnds = numpy.array([central[0][stop - 1] for start, stop, parent in central[1]]).reshape(-1, 3)
+  attached = numpy.zeros(len(centralEnds), dtype=numpy.int64)
+  count = len(central[0])
+  rowCount = len(central[1])
+  for subtreePoints, subtreeBranches, subtreeBifurcations in subtrees:
+    if len(subtreePoints) == 0:
+      continue
+    subtreeBranches = numpy.array(subtreeBranches, dtype=numpy.int64).reshape(-1, 3)
+    end = int(((centralEnds - subtreePoints[0])**2).sum(axis=1).argmin()) if len(centralEnds) else -1
+    bridge = numpy.zeros((0, 3))
+    if end >= 0:
+      attached[end] += 1
+      gap = subtreePoints[0] - centralEnds[end]
+      steps = int(numpy.linalg.norm(gap) // spacing)
+      bridge = centralEnds[end] + gap * (numpy.arange(1, steps + 1) / float(steps + 1))[:, numpy.newaxis]
+    # the bridge goes before the subtree's first branch; later rows shift by its length
+    subtreeBranches[:, :2] += count + len(bridge)
+    subtreeBranches[0, 0] -= len(bridge)
+    subtreeBranches[:, 2] = numpy.where(subtreeBranches[:, 2] >= 0, subtreeBranches[:, 2] + rowCount, end)
+    points.extend((bridge, subtreePoints))
+    branches.append(subtreeBranches)
+    bifurcations.append(subtreeBifurcations)
+    count += len(bridge) + len(subtreePoints)
+    rowCount += len(subtreeBranches)
+  bifurcations.append(centralEnds[attached > 1])
+  return (numpy.concatenate(points).reshape(-1, 3), numpy.concatenate(branches).reshape(-1, 3),
+          numpy.concatenate([numpy.asarray(b).reshape(-1, 3) for b in bifurcations]))
+
+def extractCenterlineParallel(labelArray, ijkToRAS, depth=2, processes=None, coarseSpacing=2.0,
+                              minimumBranchLength=5, smoothing=2):
+  """ Centerline of the airway label extracted per subtree in parallel; returns (points, branches, bifurcations, report).
+
+  The result has the form of Skeletonization.centerlineFromMask. report
+  holds the number of subtrees, the split, extraction and stitching times,
+  and the extraction time of each region.
+  """
+  start = time.time()
+  regions, roots = splitAirwayTree(labelArray, ijkToRAS, depth, coarseSpacing)
+  splitSeconds = time.time() - start
+
+  tasks = [(mask, matrix, None, minimumBranchLength, smoothing) for low, mask, matrix in regions[:1]]
+  tasks.extend((mask, matrix, root, minimumBranchLength, smoothing) for (low, mask, matrix), root in zip(regions[1:], roots))
+  start = time.time()
+  if len(tasks) > 1:
+    pool = createProcessPool(min(processes or len(tasks), len(tasks)))
+    try:
+      outcomes = pool.map(_extractRegion, tasks)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    outcomes = [_extractRegion(tasks[0])]
+  extractionSeconds = time.time() - start
+
+  start = time.time()
+  spacing = float(LabelMapCropping.voxelSpacing(ijkToRAS).min())
+  central = trimCentral(outcomes[0][0], regions[1:]) if len(outcomes) > 1 else outcomes[0][0]
+  points, branches, bifurcations = stitchCenterlines(central, [outcome[0] for outcome in outcomes[1:]], spacing)
+  report = {
+    'subtrees': len(roots),
+    'splitSeconds': splitSeconds,
+    'extractionSeconds': extractionSeconds,
+    'stitchSeconds': time.time() - start,
+    'regionSeconds': [outcome[1] for outcome in outcomes],
+  }
+  return points, branches, bifurcations, report
@@ -0,0 +1,195 @@
+"""
+Continuous refinement of the tracker registration on the airway centerline.
+
+While the probe moves through the airways its raw positions (ProbeToTracker
+in CT coordinates, before any correction) trace the centerline, up to the
+drift of the registration with breathing and patient motion.
+TrajectoryRefinement keeps the recent positions, one every minimumStep mm,
+and a background thread periodically registers them to the centerline
+points with ICP: closest points on the centerline polyline, then the
+closed-form rigid fit of LandmarkRegistration, until the RMS distance stops
+improving. Closest points are looked up in the sorted coarse cells of a
+CenterlinePointSet (nearestWithin), which TrajectoryRefinement builds once
+over its copy of the centerline, then refined on the segments to their
+neighbours.
+
+A correction is published only when the trajectory spans minimumExtent mm
+(a short straight trajectory can slide along the airway), most positions
+have a centerline point within maximumDistance, and it is no larger than
+maximumTranslation mm and maximumAngle degrees. It replaces the previous
+one as a single (generation, matrix, report) tuple, so the tracking loop,
+which only calls add() and reads published, never waits for the ICP and
+never sees half of an update.
+"""
+
+import math
+import threading
+import time
+
+import numpy
+
+from .CenterlinePointSet import CenterlinePointSet
+from .LandmarkRegistration import rigidTransform
+
+def centerlineIndex(targets):
+  """ targets as a CenterlinePointSet to look closest points up in; an array of points is used as it is, without hashing it """
+  if isinstance(targets, CenterlinePointSet):
+    return targets
+  targets = numpy.asarray(targets, dtype=numpy.float64).reshape(-1, 3)
+  return CenterlinePointSet.fromArrays({'points': targets}, {'tolerance': 1e-3, 'cellSize': 4.0, 'searchRings': 2})
+
+def closestPoints(queries, targets, maximumDistance=None):
+  """ (index, distance) of the target closest to each query; index -1 beyond maximumDistance
+
+  targets is a CenterlinePointSet or an array of points (see centerlineIndex).
+  """
+  queries = numpy.asarray(queries, dtype=numpy.float64).reshape(-1, 3)
+  index = centerlineIndex(targets)
+  if len(index) == 0:
+    return numpy.full(len(queries), -1, dtype=numpy.int64), numpy.full(len(queries), numpy.inf)
+  if maximumDistance is not None:
+    return index.nearestWithin(queries, maximumDistance)
+  closest, points = index.nearestMany(queries)
+  return closest, numpy.sqrt(((points - queries)**2).sum(axis=1))
+
+def _projectOnSegments(points, targets, closest, segmentLength):
+  """ Closest points to points on the segments from their closest target to the previous and next targets.
+
+  Segments longer than segmentLength (between branches, not along one) are
+  not used. Matching to the polyline rather than to its points lets ICP
+  converge below the spacing of the centerline points.
+  """
+  projections = targets[closest]
+  best = ((points - projections)**2).sum(axis=1)
+  for neighbour in (numpy.maximum(closest - 1, 0), numpy.minimum(closest + 1, len(targets) - 1)):
+    segment = targets[neighbour] - targets[closest]
+    lengthSquared = (segment**2).sum(axis=1)
+    usable = (lengthSquared > 0) & (lengthSquared <= segmentLength**2)
+    fraction = numpy.clip(((points - targets[closest]) * segment).sum(axis=1) / numpy.maximum(lengthSquared, 1e-12), 0, 1)
+    candidates = targets[closest] + fraction[:, numpy.newaxis] * segment
+    distances = ((points - candidates)**2).sum(axis=1)
+    better = usable & (distances < best)
+    projections[better] = candidates[better]
+    best[better] = distances[better]
+  return projections, numpy.sqrt(best)
+
+def icp(moving, targets, initial=None, iterations=20, maximumDistance=10.0, tolerance=1e-3):
+  """ Rigid transform of the moving points onto the target polyline by ICP, from initial.
+
+  targets is a CenterlinePointSet, or its points (see centerlineIndex):
+  consecutive points a few spacings apart at most are joined by segments.
+
+  Returns (matrix, report); report holds the RMS distance of the matched
+  points, the fraction of points matched within maximumDistance and the
+  iterations run.
+  """
+  moving = numpy.asarray(moving, dtype=numpy.float64).reshape(-1, 3)
+  index = centerlineIndex(targets)
+  targets = index.array
+  matrix = numpy.identity(4) if initial is None else numpy.array(initial, dtype=numpy.float64).reshape(4, 4)
+  segmentLength = 3.0 * float(numpy.median(numpy.sqrt((numpy.diff(targets, axis=0)**2).sum(axis=1)))) if len(targets) > 1 else 0.0
+  rms = numpy.inf
+  matched = numpy.zeros(len(moving), dtype=bool)
+  iteration = 0
+  for iteration in range(1, iterations + 1):
+    transformed = numpy.dot(moving, matrix[:3, :3].T) + matrix[:3, 3]
+    closest, distances = closestPoints(transformed, index, maximumDistance)
+    matched = closest >= 0
+    if matched.sum() < 3:
+      break
+    projections, distances = _projectOnSegments(transformed[matched], targets, closest[matched], segmentLength)
+    previous = rms
+    rms = float(numpy.sqrt((distances**2).mean()))
+    if previous - rms < tolerance:
+      break
+    matrix = rigidTransform(projections, moving[matched])
+  report = {
+    'rms': rms,
+    'matchedFraction': float(matched.mean()) if len(moving) else 0.0,
+    'iterations': iteration,
+  }
+  return matrix, report
+
+def rotationAngle(matrix):
+  """ Angle in degrees of the rotation part of a 4x4 matrix """
+  cosine = (numpy.trace(numpy.asarray(matrix)[:3, :3]) - 1) / 2.0
+  return math.degrees(math.acos(min(max(cosine, -1.0), 1.0)))
+
+class TrajectoryRefinement(object):
+  """ Drift correction of the tracker registration, refined in a background thread from the recent probe positions """
+  def __init__(self, centerline, capacity=500, minimumStep=1.0, interval=0.5, maximumDistance=10.0,
+               minimumExtent=20.0, maximumTranslation=10.0, maximumAngle=10.0, iterations=20):
+    self.centerline = numpy.array(centerline, dtype=numpy.float64).reshape(-1, 3)
+    # a copy of the centerline index, which the tracking loop does not change while the thread reads it
+    self.index = centerlineIndex(self.centerline)
+    self.minimumStep = float(minimumStep)
+    self.interval = float(interval)
+    self.maximumDistance = float(maximumDistance)
+    self.minimumExtent = float(minimumExtent)
+    self.maximumTranslation = float(maximumTranslation)
+    self.maximumAngle = float(maximumAngle)
+    self.iterations = iterations
+    self.positions = numpy.zeros((capacity, 3))
+    self.count = 0
+    self.last = None
+    self.lock = threading.Lock()
+    self.published = (0, numpy.identity(4), None)
+    self.rejected = 0
+    self.stopEvent = threading.Event()
+    self.thread = None
+
+  def add(self, position):
+    """ Records a raw probe position (tracking loop); positions closer than minimumStep to the last one are skipped """
+    position = numpy.asarray(position, dtype=numpy.float64)
+    if self.last is not None and numpy.dot(position - self.last, position - self.last) < self.minimumStep**2:
+      return
+    self.last = position
+    with self.lock:
+      self.positions[self.count % len(self.positions)] = position
+      self.count += 1
+
+  def trajectory(self):
+    with self.lock:
+      return self.positions[:min(self.count, len(self.positions))].copy()
+
+  @property
+  def correction(self):
+    """ Latest published correction matrix, to apply to the raw positions """
+    return self.published[1]
+
+  def refine(self):
+    """ One ICP run on the current trajectory, from the published correction; publishes it if acceptable and returns whether it did """
+    trajectory = self.trajectory()
+    if len(trajectory) < 3 or numpy.linalg.norm(trajectory.max(axis=0) - trajectory.min(axis=0)) < self.minimumExtent:
+      return False
+    generation, current, report = self.published
+    matrix, report = icp(trajectory, self.index, current, self.iterations, self.maximumDistance)
+    # how far the correction moves the trajectory, rather than the origin
+    centre = trajectory.mean(axis=0)
+    shift = numpy.linalg.norm(numpy.dot(matrix[:3, :3], centre) + matrix[:3, 3] - centre)
+    if report['matchedFraction'] < 0.5 or shift > self.maximumTranslation or rotationAngle(matrix) > self.maximumAngle:
+      self.rejected += 1
+      return False
+    report['positions'] = len(trajectory)
+    report['time'] = time.time()
+    self.published = (generation + 1, matrix, report)
+    return True
+
+  def start(self):
+    if self.thread is not None:
+      return
+    self.stopEvent.clear()
+    self.thread = threading.Thread(target=self._run, name='TrajectoryRefinement')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    if self.thread is None:
+      return
+    self.stopEvent.set()
+    self.thread.join()
+    self.thread = None
+
+  def _run(self):
+    while not self.stopEvent.wait(self.interval):
+      self.refine()
@@ -0,0 +1,154 @@
+"""
+Crop / flip / luminance preprocessing shared by video display and image registration.
+
+The VTK stage keeps its filters (and its output volume node) for the whole
+session, so each registration only re-executes the pipeline instead of
+allocating a new one. FramePreprocessor is the equivalent NumPy kernel for
+frames that are already arrays (recordings, offline evaluation).
+"""
+
+import numpy
+import vtk
+
+# Region of the video frame that shows the airway, as (xmin, xmax, ymin, ymax)
+# in pixels (inclusive, VTK image coordinates). None keeps the whole frame.
+ENDOSCOPE_CROP_REGIONS = {
+  'Default': (180, 571, 58, 430),
+  'Full Frame': None,
+}
+
+DEFAULT_ENDOSCOPE_MODEL = 'Default'
+
+# weights used by vtkImageLuminance
+LUMINANCE_WEIGHTS = numpy.array([0.30, 0.59, 0.11], dtype=numpy.float64)
+
+def cropRegionForModel(endoscopeModel):
+  return ENDOSCOPE_CROP_REGIONS.get(endoscopeModel, ENDOSCOPE_CROP_REGIONS[DEFAULT_ENDOSCOPE_MODEL])
+
+class FramePreprocessor(object):
+  """ NumPy version of the stage, writing into preallocated buffers.
+
+  Frames are (rows, columns, components) arrays in VTK row order, i.e. what
+  vtk_to_numpy returns for the image scalars reshaped to (dims[1], dims[0], -1).
+  """
+  def __init__(self, cropRegion=None, flip=True):
+    self.cropRegion = cropRegion
+    self.flip = flip
+    self.work = None
+    self.scratch = None
+    self.output = None
+
+  def outputShape(self, frameShape):
+    if self.cropRegion is None:
+      return frameShape[:2]
+    xmin, xmax, ymin, ymax = self.cropRegion
+    return (min(ymax, frameShape[0]-1) - ymin + 1, min(xmax, frameShape[1]-1) - xmin + 1)
+
+  def __call__(self, frame):
+    """ Returns the preprocessed uint8 image; the buffer is reused by the next call """
+    shape = self.outputShape(frame.shape)
+    if self.output is None or self.output.shape != shape:
+      self.work = numpy.empty(shape, dtype=numpy.float64)
+      self.scratch = numpy.empty(shape, dtype=numpy.float64)
+      self.output = numpy.empty(shape, dtype=numpy.uint8)
+
+    if self.cropRegion is not None:
+      xmin, xmax, ymin, ymax = self.cropRegion
+      frame = frame[ymin:ymin+shape[0], xmin:xmin+shape[1]]
+    if self.flip:
+      frame = frame[:, ::-1]
+
+    # vtkImageLuminance weights, truncated back to uint8 (matches VTK to within one grey level)
+    numpy.multiply(frame[:,:,0], LUMINANCE_WEIGHTS[0], out=self.work)
+    for component in (1, 2):
+      numpy.multiply(frame[:,:,component], LUMINANCE_WEIGHTS[component], out=self.scratch)
+      self.work += self.scratch
+    self.output[...] = self.work
+    return self.output
+
+class ImagePreprocessingStage(object):
+  """ Persistent VTK pipeline: optional crop, RGB extraction, luminance and flip about x """
+  def __init__(self, cropRegion=None, flip=True):
+    self.extractVOI = vtk.vtkExtractVOI()
+    self.extractComponents = vtk.vtkImageExtractComponents()
+    self.extractComponents.SetComponents(0,1,2)
+    self.luminance = vtk.vtkImageLuminance()
+    self.luminance.SetInputConnection(self.extractComponents.GetOutputPort())
+    self.imageFlip = vtk.vtkImageFlip()
+    self.imageFlip.SetFilteredAxis(0)
+
+    self.inputConnection = None
+    self.cropRegion = None
+    self.flip = flip
+    self.volumeNode = None
+    self.displayNode = None
+
+    self.setCropRegion(cropRegion)
+
+  def setInputConnection(self, inputConnection):
+    if inputConnection is not self.inputConnection:
+      self.inputConnection = inputConnection
+      self._connect()
+
+  def setCropRegion(self, cropRegion):
+    self.cropRegion = tuple(cropRegion) if cropRegion is not None else None
+    if self.cropRegion is not None:
+      xmin, xmax, ymin, ymax = self.cropRegion
+      self.extractVOI.SetVOI(xmin, xmax, ymin, ymax, 0, 0)
+    self._connect()
+
+  def setEndoscopeModel(self, endoscopeModel):
+    self.setCropRegion(cropRegionForModel(endoscopeModel))
+
+  def _connect(self):
+    if self.inputConnection is None:
+      return
+    if self.cropRegion is not None:
+      self.extractVOI.SetInputConnection(self.inputConnection)
+      self.extractComponents.SetInputConnection(self.extractVOI.GetOutputPort())
+    else:
+      self.extractComponents.SetInputConnection(self.inputConnection)
+    if self.flip:
+      self.imageFlip.SetInputConnection(self.luminance.GetOutputPort())
+
+  def outputPort(self):
+    return self.imageFlip.GetOutputPort() if self.flip else self.luminance.GetOutputPort()
+
+  def croppedPort(self):
+    """ Colour frame after cropping only, for display """
+    return self.extractVOI.GetOutputPort() if self.cropRegion is not None else self.inputConnection
+
+  def update(self):
+    """ Re-executes only the filters whose input changed """
+    if self.flip:
+      self.imageFlip.Update()
+      return self.imageFlip.GetOutput()
+    self.luminance.Update()
+    return self.luminance.GetOutput()
+
+  def updateVolumeNode(self, name):
+    """ Scalar volume node (created once, hidden from editors) holding the preprocessed frame """
+    self.update()
+    self.volumeNode = self._volumeNodeForPort(self.volumeNode, name, self.outputPort())
+    return self.volumeNode
+
+  def updateDisplayNode(self, name):
+    """ Volume node holding the cropped colour frame, for the RealView slice view """
+    self.displayNode = self._volumeNodeForPort(self.displayNode, name, self.croppedPort())
+    return self.displayNode
+
+  def _volumeNodeForPort(self, volumeNode, name, port):
+    from __main__ import slicer
+    if volumeNode is None or not slicer.mrmlScene.IsNodePresent(volumeNode):
+      volumeNode = slicer.vtkMRMLScalarVolumeNode()
+      volumeNode.SetName(name)
+      volumeNode.HideFromEditorsOn()
+      slicer.mrmlScene.AddNode(volumeNode)
+      volumeNode.CreateDefaultDisplayNodes()
+    if vtk.VTK_MAJOR_VERSION <= 5:
+      port.GetProducer().Update()
+      volumeNode.SetAndObserveImageData(port.GetProducer().GetOutputDataObject(port.GetIndex()))
+    else:
+      volumeNode.SetImageDataConnection(port)
+    volumeNode.Modified()
+    return volumeNode
@@ -0,0 +1,222 @@
+"""
+Recording of the incoming video frames to disk.
+
+The caller (the Image_Reference observer) only copies the frame into one of a
+fixed set of preallocated buffers and queues it; a background thread writes
+the buffers out. When no buffer is free the frame is dropped and counted, so
+the display path is never blocked by the disk.
+
+Two layouts are written in the recording directory:
+
+  preallocated  frames.npy (capacity, rows, columns, components) uint8 and
+                timestamps.npy (capacity,) float64, memory-mapped and filled
+                in place; shrunk to the recorded length when the recorder is
+                closed. This is the layout read by RegistrationEvaluation.
+  chunked       frames_00000.npy, timestamps_00000.npy, ... with at most
+                chunkFrames frames each, for recordings of unknown length.
+
+VideoRecording reads either layout back as a lazily loaded array.
+"""
+
+import glob
+import os
+import threading
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+import numpy
+from numpy.lib import format as npyformat
+
+def _rewriteShape(fileName, shape):
+  """ Changes the shape stored in a .npy header in place, keeping the header length """
+  with open(fileName, 'r+b') as f:
+    version = npyformat.read_magic(f)
+    if version == (1, 0):
+      _, fortranOrder, dtype = npyformat.read_array_header_1_0(f)
+      lengthBytes = 2
+    else:
+      _, fortranOrder, dtype = npyformat.read_array_header_2_0(f)
+      lengthBytes = 4
+    dataOffset = f.tell()
+    header = "{'descr': %r, 'fortran_order': %r, 'shape': %r, }" % (
+      npyformat.dtype_to_descr(dtype), fortranOrder, tuple(shape))
+    headerLength = dataOffset - npyformat.MAGIC_LEN - lengthBytes
+    f.seek(npyformat.MAGIC_LEN + lengthBytes)
+    f.write((header.ljust(headerLength - 1) + '\n').encode('latin1'))
+    f.truncate(dataOffset + int(numpy.prod(shape)) * dtype.itemsize)
+
+class VideoRecorder(object):
+  """ Writes frames and their timestamps from a background thread.
+
+  capacity is the number of frames preallocated in frames.npy; when it is
+  None frames are written in chunks of chunkFrames. buffers is the number of
+  frames that can wait for the writer before new frames are dropped.
+  """
+  def __init__(self, directory, capacity=None, chunkFrames=300, buffers=32):
+    self.directory = directory
+    self.capacity = capacity
+    self.chunkFrames = chunkFrames
+    self.bufferCount = buffers
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+    self.frameShape = None
+    self.freeBuffers = queue.Queue()
+    self.pending = queue.Queue()
+    self.thread = None
+
+    self.frames = None
+    self.timestamps = None
+    self.chunkIndex = 0
+    self.chunkCount = 0
+
+    self.queued = 0
+    self.written = 0
+    self.dropped = 0
+
+  def addFrame(self, frame, timestamp):
+    """ Copies frame for the writer; returns False if it had to be dropped """
+    if self.frameShape is None:
+      self._start(frame.shape)
+    elif frame.shape != self.frameShape:
+      self.dropped += 1
+      return False
+    if self.capacity is not None and self.queued >= self.capacity:
+      self.dropped += 1
+      return False
+    try:
+      buffer = self.freeBuffers.get_nowait()
+    except queue.Empty:
+      self.dropped += 1
+      return False
+    buffer[...] = frame
+    self.pending.put((buffer, timestamp))
+    self.queued += 1
+    return True
+
+  def close(self):
+    """ Flushes the queued frames and finalizes the files """
+    if self.thread is None:
+      return
+    self.pending.put(None)
+    self.thread.join()
+    self.thread = None
+    if self.capacity is not None:
+      self.frames.flush()
+      self.timestamps.flush()
+      self.frames = None
+      self.timestamps = None
+      _rewriteShape(os.path.join(self.directory, 'frames.npy'), (self.written,) + self.frameShape)
+      _rewriteShape(os.path.join(self.directory, 'timestamps.npy'), (self.written,))
+    else:
+      self._writeChunk()
+
+  def stats(self):
+    return {'written': self.written, 'dropped': self.dropped, 'queued': self.queued - self.written}
+
+  def _start(self, frameShape):
+    self.frameShape = tuple(frameShape)
+    for i in range(self.bufferCount):
+      self.freeBuffers.put(numpy.empty(self.frameShape, dtype=numpy.uint8))
+    if self.capacity is not None:
+      self.frames = npyformat.open_memmap(os.path.join(self.directory, 'frames.npy'), mode='w+',
+                                          dtype=numpy.uint8, shape=(self.capacity,) + self.frameShape)
+      self.timestamps = npyformat.open_memmap(os.path.join(self.directory, 'timestamps.npy'), mode='w+',
+                                              dtype=numpy.float64, shape=(self.capacity,))
+    else:
+      self.frames = numpy.empty((self.chunkFrames,) + self.frameShape, dtype=numpy.uint8)
+      self.timestamps = numpy.empty(self.chunkFrames, dtype=numpy.float64)
+    self.thread = threading.Thread(target=self._write, name='VideoRecorder')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _write(self):
+    while True:
+      item = self.pending.get()
+      if item is None:
+        return
+      buffer, timestamp = item
+      if self.capacity is not None:
+        self.frames[self.written] = buffer
+        self.timestamps[self.written] = timestamp
+      else:
+        self.frames[self.chunkCount] = buffer
+        self.timestamps[self.chunkCount] = timestamp
+        self.chunkCount += 1
+        if self.chunkCount == self.chunkFrames:
+          self._writeChunk()
+      self.written += 1
+      self.freeBuffers.put(buffer)
+
+  def _writeChunk(self):
+    if self.chunkCount == 0:
+      return
+    suffix = '_%05d.npy' % self.chunkIndex
+    numpy.save(os.path.join(self.directory, 'frames' + suffix), self.frames[:self.chunkCount])
+    numpy.save(os.path.join(self.directory, 'timestamps' + suffix), self.timestamps[:self.chunkCount])
+    self.chunkIndex += 1
+    self.chunkCount = 0
+
+class VideoRecording(object):
+  """ Recording written by VideoRecorder; frames are read from disk only when indexed """
+  def __init__(self, directory):
+    self.directory = directory
+    framesFile = os.path.join(directory, 'frames.npy')
+    if os.path.exists(framesFile):
+      frameFiles = [framesFile]
+      timestampFiles = [os.path.join(directory, 'timestamps.npy')]
+    else:
+      frameFiles = sorted(glob.glob(os.path.join(directory, 'frames_*.npy')))
+      timestampFiles = sorted(glob.glob(os.path.join(directory, 'timestamps_*.npy')))
+    self.chunks = [numpy.load(fileName, mmap_mode='r') for fileName in frameFiles]
+    self.offsets = numpy.cumsum([0] + [len(chunk) for chunk in self.chunks])
+    if timestampFiles:
+      self.timestamps = numpy.concatenate([numpy.load(fileName) for fileName in timestampFiles])
+    else:
+      self.timestamps = numpy.zeros(0)
+
+  @property
+  def shape(self):
+    if not self.chunks:
+      return (0,)
+    return (int(self.offsets[-1]),) + self.chunks[0].shape[1:]
+
+  @property
+  def dtype(self):
+    return self.chunks[0].dtype if self.chunks else numpy.dtype(numpy.uint8)
+
+  def __len__(self):
+    return int(self.offsets[-1])
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      indices = numpy.arange(len(self))[index]
+      return self.take(indices)
+    if numpy.ndim(index):
+      return self.take(numpy.asarray(index))
+    index = int(index)
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError('frame index out of range')
+    chunk = numpy.searchsorted(self.offsets, index, side='right') - 1
+    return self.chunks[chunk][index - self.offsets[chunk]]
+
+  def take(self, indices):
+    """ Frames at the given indices, copied into one array """
+    indices = numpy.asarray(indices, dtype=numpy.int64)
+    indices = numpy.where(indices < 0, indices + len(self), indices)
+    output = numpy.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+    chunkIndices = numpy.searchsorted(self.offsets, indices, side='right') - 1
+    for chunk in numpy.unique(chunkIndices):
+      selected = chunkIndices == chunk
+      output[selected] = self.chunks[chunk][indices[selected] - self.offsets[chunk]]
+    return output
+
+  def frameAt(self, timestamp):
+    """ Frame recorded closest to timestamp """
+    index = int(numpy.abs(self.timestamps - timestamp).argmin())
+    return self[index]
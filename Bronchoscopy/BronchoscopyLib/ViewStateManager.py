@@ -0,0 +1,109 @@
+"""
+View state of the Bronchoscopy layout: layout, 3D cameras and CT window/level.
+
+Every change is applied only when the requested state differs from the
+current one. Switching layouts tears down and rebuilds the view widgets, so
+a layout is set only when it is not already shown (or when its description
+was re-registered, see setLayout's force). The 3D cameras are reset, all in
+one pass, only after the layout changed or the content they frame changed,
+and the window/level is written only when the display node does not already
+have it, inside a single modify batch.
+
+refresh() is what updateGUI runs; each call is timed and the durations are
+summarized by report().
+"""
+
+import time
+
+# Layout switched to in order to force a rebuild of the target layout
+REBUILD_LAYOUT_ID = 19
+
+# CT window/level used for the airway volumes
+CT_WINDOW = 1400
+CT_LEVEL = -500
+
+# camera key of a view that was never reset
+_NOT_RESET = object()
+
+class ViewStateManager(object):
+  """ Applies layout, camera and window/level changes only when they change something.
+
+  viewAxis is the axis the 3D views look from after a camera reset
+  (ctkAxesWidget.Anterior). When monitor is set (a LoadTest.StreamLoadMonitor)
+  refresh durations are also recorded there as 'guiRefresh'.
+  """
+  def __init__(self, layoutManager, viewAxis, monitor=None, slowRefresh=0.25):
+    self.layoutManager = layoutManager
+    self.viewAxis = viewAxis
+    self.monitor = monitor
+    self.slowRefresh = slowRefresh
+    self.cameraKeys = {}
+    self.durations = []
+    self.layoutChanges = 0
+    self.cameraResets = 0
+    self.windowLevelChanges = 0
+
+  def setLayout(self, layoutId, force=False):
+    """ Shows layoutId unless it is already shown; force rebuilds it (after its description changed) """
+    if self.layoutManager.layout == layoutId and not force:
+      return False
+    if self.layoutManager.layout == layoutId:
+      self.layoutManager.setLayout(REBUILD_LAYOUT_ID)
+    self.layoutManager.setLayout(layoutId)
+    self.layoutChanges += 1
+    # the view widgets of the new layout have not been framed yet
+    self.cameraKeys = {}
+    return True
+
+  def resetCameras(self, views, cameraKey=None):
+    """ Resets the focal point of the views whose camera was not yet reset for cameraKey """
+    views = [view for view in views if view is not None and self.cameraKeys.get(id(view), _NOT_RESET) != cameraKey]
+    for view in views:
+      view.resetFocalPoint()
+      view.lookFromViewAxis(self.viewAxis)
+      self.cameraKeys[id(view)] = cameraKey
+    self.cameraResets += len(views)
+    return len(views)
+
+  def setWindowLevel(self, volumeNode, window=CT_WINDOW, level=CT_LEVEL):
+    """ Sets a fixed window/level on the volume unless it already has it """
+    displayNode = volumeNode.GetDisplayNode() if volumeNode else None
+    if displayNode is None:
+      return False
+    if (not displayNode.GetAutoWindowLevel() and displayNode.GetWindow() == window
+        and displayNode.GetLevel() == level):
+      return False
+    wasModifying = displayNode.StartModify()
+    displayNode.SetAutoWindowLevel(0)
+    displayNode.SetWindowLevel(window, level)
+    displayNode.EndModify(wasModifying)
+    self.windowLevelChanges += 1
+    return True
+
+  def refresh(self, layoutId, views, cameraKey=None, volumeNode=None):
+    """ Brings layout, cameras and window/level to the requested state; returns the time it took """
+    start = time.time()
+    layoutChanged = self.setLayout(layoutId)
+    self.resetCameras(views, cameraKey)
+    if volumeNode is not None:
+      self.setWindowLevel(volumeNode)
+    duration = time.time() - start
+    self.durations.append(duration)
+    if self.monitor:
+      self.monitor.recordProcessing('guiRefresh', duration)
+    if self.slowRefresh is not None and duration > self.slowRefresh:
+      print('GUI refresh took %.3f s (layout changed: %s)' % (duration, layoutChanged))
+    return duration
+
+  def report(self):
+    """ Number of refreshes, their mean and max duration and how many changes were actually applied """
+    report = {
+      'refreshes': len(self.durations),
+      'layoutChanges': self.layoutChanges,
+      'cameraResets': self.cameraResets,
+      'windowLevelChanges': self.windowLevelChanges,
+    }
+    if self.durations:
+      report['refreshMean'] = sum(self.durations) / len(self.durations)
+      report['refreshMax'] = max(self.durations)
+    return report
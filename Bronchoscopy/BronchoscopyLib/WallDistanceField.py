@@ -0,0 +1,165 @@
+"""
+Signed distance from the airway wall, precomputed from the label map.
+
+The field holds, for every voxel of the airway bounding box grown by band
+mm, the Euclidean distance in mm to the airway wall: positive inside the
+lumen, negative outside, and clamped at -band further out. It is computed
+once per label with a separable exact distance transform on NumPy arrays
+(a scan along the first axis, then a windowed lower envelope of parabolas
+along the other two, each window bounded by the largest distance the pass
+can give, about the largest airway radius), saved as .npy next to a small
+.json with its geometry, and memory-mapped when loaded again. A tracker sample is then
+looked up with one trilinear interpolation, whatever the size of the
+airway tree, to tell whether the probe is in the lumen and how far it is
+from the wall.
+"""
+
+import hashlib
+import json
+import math
+import os
+
+import numpy
+
+from . import LabelMapCropping
+
+FORMAT_VERSION = 1
+
+def _swap(array, axis):
+  return array.swapaxes(0, axis)
+
+def _scanDistances(mask, spacing, limit):
+  """ Squared distance (mm^2) along the first axis from each voxel to the nearest voxel outside mask, at most limit """
+  count = mask.shape[0]
+  index = numpy.arange(count, dtype=numpy.float32).reshape((count,) + (1,) * (mask.ndim - 1))
+  far = count + limit / spacing
+  previous = numpy.maximum.accumulate(numpy.where(mask, -far, index), axis=0)
+  following = numpy.minimum.accumulate(numpy.where(mask, count + far, index)[::-1], axis=0)[::-1]
+  distance = numpy.minimum(numpy.minimum(index - previous, following - index) * spacing, limit)
+  return (distance**2).astype(numpy.float32)
+
+def _envelope(squared, axis, spacing, bound):
+  """ Squared distances after a lower envelope pass along axis: min over y of squared[y] + ((x - y) * spacing)^2.
+
+  bound is the largest squared distance the pass can give: no y further
+  from x than its square root needs looking at.
+  """
+  source = _swap(squared, axis)
+  result = source.copy()
+  window = int(math.ceil(math.sqrt(float(bound)) / spacing))
+  for step in range(1, min(window, source.shape[0] - 1) + 1):
+    cost = numpy.float32((step * spacing)**2)
+    numpy.minimum(result[step:], source[:-step] + cost, out=result[step:])
+    numpy.minimum(result[:-step], source[step:] + cost, out=result[:-step])
+  return _swap(result, axis)
+
+def squaredDistanceTransform(mask, spacing=(1.0, 1.0, 1.0), limit=None):
+  """ Squared Euclidean distance (mm^2) from each voxel of mask to the nearest voxel outside it, at most limit mm.
+
+  mask and spacing are in (k, j, i) order. Voxels with no voxel outside the
+  mask within limit get limit^2; without limit, the mask must have some
+  voxel outside it.
+  """
+  mask = numpy.asarray(mask, dtype=bool)
+  if limit is None:
+    limit = float(sum(size * s for size, s in zip(mask.shape, spacing)))
+  if mask.size == 0:
+    return numpy.zeros(mask.shape, dtype=numpy.float32)
+  squared = _scanDistances(mask, spacing[0], limit)
+  for axis in (1, 2):
+    # the pass gives at most the distance along axis alone, which bounds its window
+    along = _swap(_scanDistances(_swap(mask, axis), spacing[axis], limit), axis)
+    squared = _envelope(squared, axis, spacing[axis], numpy.minimum(squared, along).max())
+  return numpy.minimum(squared, numpy.float32(limit**2))
+
+def labelKey(labelArray, ijkToRAS, band):
+  """ Hash of the label content, geometry and band, naming the cached field """
+  labelArray = numpy.ascontiguousarray(labelArray)
+  digest = hashlib.sha1()
+  digest.update(json.dumps([FORMAT_VERSION, list(labelArray.shape), str(labelArray.dtype), float(band)]).encode('ascii'))
+  digest.update(numpy.asarray(ijkToRAS, dtype=numpy.float64).tobytes())
+  digest.update((labelArray != 0).view(numpy.uint8).data)
+  return digest.hexdigest()
+
+class WallDistanceField(object):
+  """ Signed wall distances (k, j, i) in mm and the IJK to RAS matrix of their grid """
+  def __init__(self, distances, ijkToRAS, band):
+    self.distances = distances
+    self.ijkToRAS = numpy.asarray(ijkToRAS, dtype=numpy.float64).reshape(4, 4)
+    self.rasToIJK = numpy.linalg.inv(self.ijkToRAS)
+    self.band = float(band)
+
+  @classmethod
+  def build(cls, labelArray, ijkToRAS, band=10.0):
+    """ Field of the non-zero voxels of labelArray, over their bounding box grown by band mm """
+    spacing = LabelMapCropping.voxelSpacing(ijkToRAS)
+    mask, boxToRAS, report = LabelMapCropping.cropLabel(labelArray, ijkToRAS, band + spacing.max())
+    mask = numpy.pad(mask != 0, 1, mode='constant')
+    boxToRAS = numpy.dot(boxToRAS, [[1, 0, 0, -1], [0, 1, 0, -1], [0, 0, 1, -1], [0, 0, 0, 1]])
+    kjiSpacing = spacing[::-1]
+    inside = numpy.sqrt(squaredDistanceTransform(mask, kjiSpacing))
+    outside = numpy.sqrt(squaredDistanceTransform(~mask, kjiSpacing, band))
+    # the wall lies half a voxel from the centres of the voxels on either side of it
+    halfVoxel = numpy.float32(spacing.min() / 2.0)
+    distances = numpy.where(mask, inside - halfVoxel, halfVoxel - outside).astype(numpy.float32)
+    numpy.maximum(distances, numpy.float32(-band), out=distances)
+    return cls(distances, boxToRAS, band)
+
+  @classmethod
+  def load(cls, path):
+    """ Field saved by save(), memory-mapped """
+    with open(path + '.json') as f:
+      metadata = json.load(f)
+    if metadata.get('version') != FORMAT_VERSION:
+      raise ValueError('Unsupported wall distance field version: %s' % metadata.get('version'))
+    return cls(numpy.load(path + '.npy', mmap_mode='r'), metadata['ijkToRAS'], metadata['band'])
+
+  def save(self, path):
+    """ Writes path.npy and path.json """
+    numpy.save(path + '.npy', numpy.ascontiguousarray(self.distances, dtype=numpy.float32))
+    with open(path + '.json', 'w') as f:
+      json.dump({'version': FORMAT_VERSION, 'ijkToRAS': self.ijkToRAS.tolist(), 'band': self.band}, f)
+
+  def toArrays(self):
+    """ (arrays, metadata) from which fromArrays() restores the field """
+    return {'distances': self.distances}, {'ijkToRAS': self.ijkToRAS.tolist(), 'band': self.band}
+
+  @classmethod
+  def fromArrays(cls, arrays, metadata):
+    return cls(arrays['distances'], metadata['ijkToRAS'], metadata['band'])
+
+  @classmethod
+  def cached(cls, labelArray, ijkToRAS, directory, band=10.0):
+    """ Field of the label from directory, built and saved there first if it is not there yet """
+    path = os.path.join(directory, 'WallDistance-' + labelKey(labelArray, ijkToRAS, band))
+    if not (os.path.exists(path + '.npy') and os.path.exists(path + '.json')):
+      if not os.path.isdir(directory):
+        os.makedirs(directory)
+      cls.build(labelArray, ijkToRAS, band).save(path)
+    return cls.load(path)
+
+  def distance(self, position):
+    """ Signed distance (mm) from the wall at a RAS position, or at each row of an (n, 3) array: > 0 in the lumen """
+    positions = numpy.asarray(position, dtype=numpy.float64)
+    points = positions.reshape(-1, 3)
+    ijk = numpy.dot(points, self.rasToIJK[:3, :3].T) + self.rasToIJK[:3, 3]
+    kji = ijk[:, ::-1]
+    shape = numpy.array(self.distances.shape)
+    low = numpy.floor(kji).astype(numpy.int64)
+    valid = ((low >= 0) & (low < shape - 1)).all(axis=1)
+    result = numpy.empty(len(points))
+    result[~valid] = -self.band
+    if valid.any():
+      low = low[valid]
+      fraction = kji[valid] - low
+      values = numpy.zeros(len(low))
+      for corner in range(8):
+        offset = numpy.array([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1])
+        weight = numpy.where(offset, fraction, 1 - fraction).prod(axis=1)
+        corners = low + offset
+        values += weight * self.distances[corners[:, 0], corners[:, 1], corners[:, 2]]
+      result[valid] = values
+    return float(result[0]) if positions.ndim == 1 else result
+
+  def isInside(self, position):
+    return self.distance(position) > 0
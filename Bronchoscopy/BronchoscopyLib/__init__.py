@@ -0,0 +1,27 @@
+"""
+Helpers for the Bronchoscopy scripted module.
+
+Only modules that need nothing beyond numpy and the standard library are
+imported here, so the package can be used outside Slicer. Modules that talk
+to the MRML scene (e.g. LoadTest) are imported explicitly where needed.
+"""
+
+from .CaseCache import CaseCache, caseKey
+from .CenterlineEngine import smoothCenterline, hermitePath
+from .CenterlineFrames import CenterlineFrames
+from .CenterlineIO import writeCenterlineFiles, readCenterline
+from .CenterlinePointSet import CenterlinePointSet
+from .IGTLSimulator import VideoServer, TrackerClient, crc64
+from .LabelMapCropping import cropLabel
+from .LandmarkRegistration import rigidTransform, registerLandmarks
+from .ObserverManager import ObserverManager, CoalescedCall
+from .PathPlanning import PlanningCache, SegmentedHermitePath
+from .PlanningSession import PlanningSession
+from .RegistrationCache import RegistrationCache, imageSignature
+from .Skeletonization import skeletonize, centerlineFromMask
+from .SliceViewController import SliceViewController
+from .SubtreeExtraction import extractCenterlineParallel
+from .TrajectoryRegistration import TrajectoryRefinement, icp
+from .VideoRecorder import VideoRecorder, VideoRecording
+from .ViewStateManager import ViewStateManager
+from .WallDistanceField import WallDistanceField
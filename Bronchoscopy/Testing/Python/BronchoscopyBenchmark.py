@@ -0,0 +1,348 @@
+"""
+Benchmarks of the computational kernels of the Bronchoscopy module.
+
+Each kernel runs on synthetic airway trees of increasing size (number of
+centerline points, or pixels for the video preprocessing). The best time of
+its runs, the peak memory traced in Python and NumPy and the maximum resident
+size of the process are reported as JSON, with sorted keys and results
+ordered by kernel and size so reports can be diffed:
+
+  python BronchoscopyBenchmark.py --sizes 1000 10000 100000 1000000 --output benchmark.json
+
+With --baseline, the run fails (exit code 1) when a kernel is more than
+--tolerance times slower than in the baseline report, times under
+MINIMUM_SECONDS counting as MINIMUM_SECONDS. Only NumPy is needed;
+the kernels that use VTK are reported as skipped without it. In
+the build tree the benchmark runs headless through ctest (see CMakeLists.txt)
+against BronchoscopyBenchmarkBaseline.json, a report of the ctest run
+checked in next to this script. Its times depend on the machine that made
+it, so ctest only catches slowdowns several times over; regenerate it with
+the ctest arguments when a kernel gets faster or slower on purpose.
+"""
+
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import sys
+import time
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+try:
+  import resource
+except ImportError:
+  resource = None
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from BronchoscopyLib import CenterlineEngine
+from BronchoscopyLib.CenterlineFrames import CenterlineFrames
+from BronchoscopyLib.CenterlinePointSet import CenterlinePointSet
+
+REPORT_VERSION = 1
+
+# baseline times below this (seconds) are mostly timer and first-call noise
+MINIMUM_SECONDS = 0.01
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+# probe positions looked up by the snapping and bifurcation kernels
+QUERIES = 1000
+
+# points of each planned path merged into the centerline (a 50 cm path)
+PATH_POINTS = 1000
+
+#
+# Synthetic data
+#
+
+def _rotate(vector, axis, angle):
+  """ vector rotated by angle about the unit axis (Rodrigues) """
+  return (vector * math.cos(angle) + numpy.cross(axis, vector) * math.sin(angle)
+          + axis * numpy.dot(axis, vector) * (1 - math.cos(angle)))
+
+def syntheticAirwayTree(numberOfPoints, spacing=0.5, seed=0):
+  """ Centerline points of a binary airway tree, branch by branch, and its bifurcation points.
+
+  The number of generations grows with numberOfPoints so that every branch
+  has about 50 points; points are spacing mm apart with a little noise.
+  """
+  random = numpy.random.RandomState(seed)
+  generations = max(1, min(16, int(math.log(max(numberOfPoints / 50.0, 1), 2)) + 1))
+  numberOfBranches = 2**generations - 1
+  pointsPerBranch = numberOfPoints // numberOfBranches
+  # the trunk takes the points left over
+  trunkPoints = numberOfPoints - pointsPerBranch * (numberOfBranches - 1)
+
+  branches = []
+  bifurcations = []
+  # (start, direction, generation) of the branches still to grow
+  pending = [(numpy.zeros(3), numpy.array([0.0, 0.0, -1.0]), 0)]
+  while pending:
+    start, direction, generation = pending.pop(0)
+    count = pointsPerBranch if branches else trunkPoints
+    steps = numpy.arange(1, count + 1)[:, numpy.newaxis] * spacing
+    branch = start + steps * direction + random.normal(0, 0.05 * spacing, (count, 3))
+    branches.append(branch)
+    if generation + 1 < generations:
+      end = start + count * spacing * direction
+      bifurcations.append(end)
+      axis = numpy.cross(direction, [1.0, 0.0, 0.0] if abs(direction[0]) < 0.9 else [0.0, 1.0, 0.0])
+      axis /= numpy.linalg.norm(axis)
+      axis = _rotate(axis, direction, generation * math.pi / 2)
+      for sign in (1, -1):
+        pending.append((end, _rotate(direction, axis, sign * math.radians(35)), generation + 1))
+  return numpy.concatenate(branches), numpy.asarray(bifurcations).reshape(-1, 3)
+
+def syntheticPath(numberOfPoints, spacing=0.5):
+  """ Points spacing mm apart along a helix descending through the lungs, about numberOfPoints long """
+  # radius 20 mm, 40 mm per turn: the arc length per radian is sqrt(20**2 + (40 / 2 / pi)**2)
+  angle = numpy.arange(numberOfPoints) * spacing / math.sqrt(20**2 + (40 / 2 / math.pi)**2)
+  return numpy.column_stack((20 * numpy.cos(angle), 20 * numpy.sin(angle), -40 / 2 / math.pi * angle))
+
+def _queries(points, seed=1):
+  """ Probe positions near the centerline """
+  random = numpy.random.RandomState(seed)
+  return points[random.randint(0, len(points), QUERIES)] + random.normal(0, 1.0, (QUERIES, 3))
+
+#
+# Kernels: each prepares its input for a size and returns the function to time
+#
+
+def smoothingKernel(size):
+  points, bifurcations = syntheticAirwayTree(size)
+  return lambda: CenterlineEngine.smoothCenterline(points, 3)
+
+def snappingKernel(size):
+  # lookups of the probe on a centerline of size points, as on every tracking update
+  points, bifurcations = syntheticAirwayTree(size)
+  queries = _queries(points)
+  pointSet = CenterlinePointSet()
+  pointSet.extend(points)
+  def run():
+    for query in queries:
+      pointSet.nearest(query)
+  return run
+
+def batchSnappingKernel(size):
+  # the same lookups, for four sensors tracked together
+  points, bifurcations = syntheticAirwayTree(size)
+  queries = _queries(points).reshape(-1, 4, 3)
+  pointSet = CenterlinePointSet()
+  pointSet.extend(points)
+  pointSet.nearestMany(queries[0])
+  def run():
+    for sensors in queries:
+      pointSet.nearestMany(sensors)
+  return run
+
+def hermiteKernel(size):
+  # waypoints every 10 mm, so the sampled path has about size points 0.5 mm apart
+  waypoints = syntheticPath(size)[::20]
+  return lambda: CenterlineEngine.hermitePath(waypoints, 0.5)
+
+def polyDataKernel(size):
+  from BronchoscopyLib import CenterlineIO
+  points, bifurcations = syntheticAirwayTree(size)
+  def run():
+    polyData = CenterlineIO.centerlinePolyData(points)
+    CenterlineIO.polyDataPoints(polyData)
+  return run
+
+def mergeKernel(size):
+  # the centerline of size points is built, then ten planned paths along it are merged as when they
+  # are selected, each twice
+  points, bifurcations = syntheticAirwayTree(size)
+  random = numpy.random.RandomState(2)
+  paths = []
+  for i in range(10):
+    end = random.randint(0, len(points)) + 1
+    paths.append(points[max(0, end - PATH_POINTS):end])
+  def run():
+    pointSet = CenterlinePointSet()
+    pointSet.extend(points)
+    for i, path in enumerate(paths):
+      pointSet.mergePath(('Path', i), path)
+      pointSet.mergePath(('Path', i), path)
+  return run
+
+def bifurcationKernel(size):
+  points, bifurcations = syntheticAirwayTree(size)
+  queries = _queries(points)
+  def run():
+    for query in queries:
+      index, distance = CenterlineEngine.nearestBifurcation(bifurcations, query)
+  return run
+
+def cameraFramesKernel(size):
+  # the camera frames computed for the whole centerline when tracking starts
+  points, bifurcations = syntheticAirwayTree(size)
+  return lambda: CenterlineFrames().update(points)
+
+def _frames(size):
+  """ Four random RGB frames of about size pixels (4:3) and a crop region keeping their centre """
+  rows = max(int(math.sqrt(size * 3 / 4.0)), 1)
+  columns = max(size // rows, 1)
+  random = numpy.random.RandomState(3)
+  frames = [random.randint(0, 256, (rows, columns, 3)).astype(numpy.uint8) for i in range(4)]
+  return frames, (columns // 8, columns - 1 - columns // 8, rows // 8, rows - 1 - rows // 8)
+
+def preprocessingKernel(size):
+  # offline preprocessing (RegistrationEvaluation) of video frames of size pixels
+  from BronchoscopyLib.VideoPreprocessing import FramePreprocessor
+  frames, cropRegion = _frames(size)
+  preprocessor = FramePreprocessor(cropRegion)
+  def run():
+    for frame in frames:
+      preprocessor(frame)
+  return run
+
+def preprocessingPipelineKernel(size):
+  # the VTK stage run on the live video before each registration
+  import vtk
+  from vtk.util.numpy_support import numpy_to_vtk
+  from BronchoscopyLib.VideoPreprocessing import ImagePreprocessingStage
+  frames, cropRegion = _frames(size)
+  images = []
+  for frame in frames:
+    image = vtk.vtkImageData()
+    image.SetDimensions(frame.shape[1], frame.shape[0], 1)
+    image.GetPointData().SetScalars(numpy_to_vtk(frame.reshape(-1, 3), deep=True))
+    images.append(image)
+  producer = vtk.vtkTrivialProducer()
+  stage = ImagePreprocessingStage(cropRegion)
+  stage.setInputConnection(producer.GetOutputPort())
+  def run():
+    for image in images:
+      producer.SetOutput(image)
+      stage.update()
+  return run
+
+# name: (kernel, largest size it is run at, modules it needs); smoothing is quadratic and the
+# Hermite sampling, the point set and the camera frames are Python loops over the points, so they are capped
+KERNELS = {
+  'smoothing': (smoothingKernel, 10000, ()),
+  'snapping': (snappingKernel, None, ()),
+  'batchSnapping': (batchSnappingKernel, None, ()),
+  'hermitePath': (hermiteKernel, 100000, ()),
+  'polyData': (polyDataKernel, None, ('vtk',)),
+  'pathMerge': (mergeKernel, 100000, ()),
+  'bifurcation': (bifurcationKernel, None, ()),
+  'cameraFrames': (cameraFramesKernel, 100000, ()),
+  'preprocessing': (preprocessingKernel, None, ('vtk',)),
+  'preprocessingPipeline': (preprocessingPipelineKernel, None, ('vtk',)),
+}
+
+#
+# Measurement
+#
+
+def _available(module):
+  try:
+    __import__(module)
+    return True
+  except ImportError:
+    return False
+
+def _maxRSS():
+  if resource is None:
+    return None
+  # kilobytes on Linux, bytes on macOS
+  scale = 1 if sys.platform == 'darwin' else 1024
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+def measure(run, repeat, budget):
+  """ Best time of up to repeat runs (fewer once budget seconds are spent) and the peak memory of one more run.
+
+  Memory is traced in a separate run because tracing slows Python code down
+  several times.
+  """
+  times = []
+  while len(times) < repeat and (not times or sum(times) < budget):
+    gc.collect()
+    start = time.time()
+    run()
+    times.append(time.time() - start)
+  peak = None
+  if tracemalloc is not None:
+    gc.collect()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+  return {'seconds': min(times), 'meanSeconds': sum(times) / len(times), 'runs': len(times), 'peakBytes': peak}
+
+def runBenchmarks(sizes, kernels=None, repeat=3, budget=5.0):
+  results = []
+  for name in sorted(kernels or KERNELS):
+    kernel, maxSize, modules = KERNELS[name]
+    for size in sorted(sizes):
+      entry = {'kernel': name, 'size': size}
+      missing = [module for module in modules if not _available(module)]
+      if missing:
+        entry['skipped'] = 'requires ' + ', '.join(missing)
+      elif maxSize is not None and size > maxSize:
+        entry['skipped'] = 'larger than %d' % maxSize
+      else:
+        entry.update(measure(kernel(size), repeat, budget))
+        entry['maxRSSBytes'] = _maxRSS()
+      results.append(entry)
+  return {
+    'version': REPORT_VERSION,
+    'python': platform.python_version(),
+    'numpy': numpy.__version__,
+    'repeat': repeat,
+    'results': results,
+  }
+
+def compareWithBaseline(report, baseline, tolerance, minimumSeconds=MINIMUM_SECONDS):
+  """ Messages for the kernels more than tolerance times slower than in baseline, or than minimumSeconds """
+  baselineTimes = dict(((entry['kernel'], entry['size']), entry['seconds'])
+                       for entry in baseline.get('results', []) if 'seconds' in entry)
+  regressions = []
+  for entry in report['results']:
+    key = (entry['kernel'], entry['size'])
+    if 'seconds' in entry and key in baselineTimes and entry['seconds'] > tolerance * max(baselineTimes[key], minimumSeconds):
+      regressions.append('%s at %d: %.4f s, baseline %.4f s' % (key[0], key[1], entry['seconds'], baselineTimes[key]))
+  return regressions
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark the computational kernels of the Bronchoscopy module.')
+  parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='numbers of centerline points (pixels for preprocessing)')
+  parser.add_argument('--kernels', nargs='+', choices=sorted(KERNELS), help='kernels to run, all by default')
+  parser.add_argument('--repeat', type=int, default=3, help='runs per kernel and size, the best one is reported')
+  parser.add_argument('--budget', type=float, default=5.0, help='seconds after which a kernel is not run again')
+  parser.add_argument('--output', help='write the JSON report to this file')
+  parser.add_argument('--baseline', help='JSON report to compare with')
+  parser.add_argument('--tolerance', type=float, default=2.0, help='slowdown over the baseline counted as a regression')
+  args = parser.parse_args(argv)
+
+  report = runBenchmarks(args.sizes, args.kernels, args.repeat, args.budget)
+  output = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    outputDirectory = os.path.dirname(os.path.abspath(args.output))
+    if not os.path.isdir(outputDirectory):
+      os.makedirs(outputDirectory)
+    with open(args.output, 'w') as f:
+      f.write(output)
+  print(output)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions = compareWithBaseline(report, json.load(f), args.tolerance)
+    for regression in regressions:
+      print('Regression: ' + regression)
+    if regressions:
+      return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())